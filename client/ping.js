@@ -17,6 +17,8 @@ var COLOR_BLACK_PLACEMENT = 0x333333;
 var PLAYER_NAME_WHITE = 'white';
 var PLAYER_NAME_BLACK = 'black';
 
+var RECONNECT_DELAY_MS = 1000;
+
 var renderer = PIXI.autoDetectRenderer(WIDTH, HEIGHT);
 
 var font = {font:"25px Courier New", stroke:"#00CC00", fill:"#00CC00", align: "center"};
@@ -40,11 +42,23 @@ function openWebSocket(wsUri, game) {
     }
     
     webSocket.onopen = function(e) {
-        this.game.join();
+        if (this.game.resumeToken !== null) {
+            this.game.resume();
+        } else {
+            this.game.join();
+        }
     };
 
     webSocket.onclose = function(e) {
        console.log(e.reason);
+       // the server holds our seat for a while if we drop out mid-game
+       var game = this.game;
+       if (e.reason === "unknown token") {
+           game.resumeToken = null;
+       }
+       if (game.started && !game.gameOver && game.resumeToken !== null) {
+           setTimeout(function() { game.connect(); }, RECONNECT_DELAY_MS);
+       }
     };
 
     webSocket.onerror = function(e) {
@@ -52,15 +66,20 @@ function openWebSocket(wsUri, game) {
     };
 
     webSocket.onmessage = function(e) {
-        var data = JSON.parse(e.data);
+        var data = this.game.codec.decode(e.data);
         switch (data.type) {
         case "joined":
+            this.game.codec.boardWidth = data.board_width;
             this.game.headerText.setText("Waiting...");
             this.game.board = new Board(data.board_width, data.moves_per_turn);
             break;
         case "start":
         case "update":
-            if (data.your_color !== undefined) {
+            if (data.resume_token !== undefined) {
+                this.game.resumeToken = data.resume_token;
+            }
+            // a start after resuming only brings the board up to date
+            if (data.your_color !== undefined && this.game.shapeUI === null) {
                 this.game.headerText.setText(" You:");
                 this.game.headerText.x -= this.game.board.GRID_WIDTH;
                 this.game.player = data.your_color;
@@ -107,7 +126,13 @@ function openWebSocket(wsUri, game) {
             if (this.game.shapeUI !== null) {
                 this.game.shapeUI.enabled = (this.game.player === this.game.turn);
             }
-            this.game.update(data.board);
+
+            var boardSpec = this.game.applyBoard(data);
+            if (boardSpec === null) {
+                this.game.resync();
+                return;
+            }
+            this.game.update(boardSpec);
             break;
         case "end":
             this.game.gameOver = true;
@@ -133,6 +158,308 @@ function openWebSocket(wsUri, game) {
     return webSocket;
 };
 
+// Message codecs. "binary" packs messages as described in
+// server/protocol.py; MESSAGES has to match message_schema() there.
+var PROTOCOL = "binary";
+
+function ByteReader(buffer) {
+    this.view = new DataView(buffer);
+    this.offset = 0;
+}
+
+ByteReader.prototype.u8 = function() {
+    return this.view.getUint8(this.offset++);
+};
+
+ByteReader.prototype.u16 = function() {
+    var value = this.view.getUint16(this.offset);
+    this.offset += 2;
+    return value;
+};
+
+ByteReader.prototype.u32 = function() {
+    var value = this.view.getUint32(this.offset);
+    this.offset += 4;
+    return value;
+};
+
+function ByteWriter() {
+    this.bytes = [];
+}
+
+ByteWriter.prototype.u8 = function(value) {
+    this.bytes.push(value & 0xff);
+};
+
+ByteWriter.prototype.u16 = function(value) {
+    this.u8(value >> 8);
+    this.u8(value);
+};
+
+ByteWriter.prototype.u32 = function(value) {
+    this.u16(value >>> 16);
+    this.u16(value);
+};
+
+// Each kind reads msg[name] from a ByteReader or writes it to a ByteWriter.
+// Points need the board width, which the codec passes along.
+var Kind = {};
+
+Kind.u8 = {
+    read: function(r, msg, name) { msg[name] = r.u8(); },
+    write: function(w, msg, name) { w.u8(msg[name]); }
+};
+
+Kind.u32 = {
+    read: function(r, msg, name) { msg[name] = r.u32(); },
+    write: function(w, msg, name) { w.u32(msg[name]); }
+};
+
+Kind.bool = {
+    read: function(r, msg, name) { msg[name] = r.u8() !== 0; },
+    write: function(w, msg, name) { w.u8(msg[name] ? 1 : 0); }
+};
+
+Kind.enumOf = function(values) {
+    return {
+        read: function(r, msg, name) { msg[name] = values[r.u8()]; },
+        write: function(w, msg, name) { w.u8(values.indexOf(msg[name])); }
+    };
+};
+
+Kind.str = {
+    read: function(r, msg, name) {
+        var length = r.u16();
+        var bytes = "";
+        for (var i = 0; i < length; i++) {
+            bytes += String.fromCharCode(r.u8());
+        }
+        msg[name] = decodeURIComponent(escape(bytes));
+    },
+    write: function(w, msg, name) {
+        var bytes = unescape(encodeURIComponent(msg[name]));
+        w.u16(bytes.length);
+        for (var i = 0; i < bytes.length; i++) {
+            w.u8(bytes.charCodeAt(i));
+        }
+    }
+};
+
+Kind.point = {
+    read: function(r, msg, name) { msg[name] = [r.u8(), r.u8()]; },
+    write: function(w, msg, name) { w.u8(msg[name][0]); w.u8(msg[name][1]); }
+};
+
+Kind.maybePoint = {
+    read: function(r, msg, name) {
+        var tag = r.u8();
+        if (tag === 1) {
+            msg[name] = null;
+        } else if (tag === 2) {
+            Kind.point.read(r, msg, name);
+        }
+    }
+};
+
+Kind.points = {
+    read: function(r, msg, name, width) {
+        var points = [];
+        if (r.u8() === 0) {
+            var count = r.u16();
+            for (var i = 0; i < count; i++) {
+                points.push([r.u8(), r.u8()]);
+            }
+        } else {
+            var size = Math.floor((width * width + 7) / 8);
+            for (var i = 0; i < size; i++) {
+                var byte = r.u8();
+                for (var bit = 0; byte !== 0; bit++, byte >>= 1) {
+                    if (byte & 1) {
+                        var pos = i * 8 + bit;
+                        points.push([pos % width, Math.floor(pos / width)]);
+                    }
+                }
+            }
+        }
+        msg[name] = points;
+    }
+};
+
+Kind.shapes = {
+    read: function(r, msg, name) {
+        var shapes = [];
+        var count = r.u8();
+        for (var i = 0; i < count; i++) {
+            var points = [];
+            var numPoints = r.u8();
+            for (var j = 0; j < numPoints; j++) {
+                points.push([r.u8(), r.u8()]);
+            }
+            shapes.push(points);
+        }
+        msg[name] = shapes;
+    }
+};
+
+Kind.struct = function(fields) {
+    return {
+        read: function(r, msg, name, width) {
+            var value = {};
+            readFields(r, value, fields, width);
+            msg[name] = value;
+        }
+    };
+};
+
+// Exactly one of fields is in the message, used with a null name.
+Kind.oneOf = function(fields) {
+    return {
+        read: function(r, msg, name, width) {
+            var field = fields[r.u8()];
+            field[1].read(r, msg, field[0], width);
+        }
+    };
+};
+
+// A u8 count of messages, each written as its id and fields as if it were
+// sent on its own.
+Kind.actions = {
+    write: function(w, msg, name) {
+        var actions = msg[name];
+        w.u8(actions.length);
+        for (var i = 0; i < actions.length; i++) {
+            for (var j = 0; j < MESSAGES.length; j++) {
+                if (MESSAGES[j][0] === actions[i].type) {
+                    w.u8(MESSAGES[j][1]);
+                    writeFields(w, actions[i], MESSAGES[j][2]);
+                    break;
+                }
+            }
+        }
+    }
+};
+
+function readFields(r, msg, fields, width) {
+    for (var i = 0; i < fields.length; i++) {
+        fields[i][1].read(r, msg, fields[i][0], width);
+    }
+}
+
+function writeFields(w, msg, fields) {
+    for (var i = 0; i < fields.length; i++) {
+        fields[i][1].write(w, msg, fields[i][0]);
+    }
+}
+
+var DIRECTION = Kind.enumOf(["N", "S", "E", "W"]);
+var COLOR = Kind.enumOf(["white", "black"]);
+var BLOCKS = Kind.struct([
+    ["white_block", Kind.points],
+    ["black_block", Kind.points]
+]);
+var BOARD = Kind.oneOf([
+    ["board", Kind.struct([
+        ["white_player", Kind.maybePoint],
+        ["black_player", Kind.maybePoint],
+        ["white_block", Kind.points],
+        ["black_block", Kind.points]
+    ])],
+    ["board_delta", Kind.struct([
+        ["base_version", Kind.u32],
+        ["added", BLOCKS],
+        ["removed", BLOCKS],
+        ["white_player", Kind.maybePoint],
+        ["black_player", Kind.maybePoint]
+    ])]
+]);
+
+// [type, id, fields]
+var MESSAGES = [
+    ["move", 1, [["direction", DIRECTION]]],
+    ["shoot", 2, [["direction", DIRECTION]]],
+    ["place", 3, [["shape_index", Kind.u8], ["origin", Kind.point]]],
+    ["ping", 4, []],
+    ["resync", 5, []],
+    ["ack", 6, [["version", Kind.u32]]],
+    ["batch", 7, [["actions", Kind.actions]]],
+
+    ["joined", 64, [["board_width", Kind.u8], ["moves_per_turn", Kind.u8]]],
+    ["start", 65, [
+        ["turn", COLOR],
+        ["turn_number", Kind.u32],
+        ["moves_remaining", Kind.u8],
+        ["your_color", COLOR],
+        ["opponent", Kind.str],
+        ["resume_token", Kind.str],
+        ["version", Kind.u32],
+        ["shapes", Kind.shapes],
+        ["placement_zone", Kind.struct([
+            ["upperleft", Kind.point],
+            ["width", Kind.u8],
+            ["height", Kind.u8]
+        ])],
+        [null, BOARD]
+    ]],
+    ["update", 66, [
+        ["turn", COLOR],
+        ["turn_number", Kind.u32],
+        ["moves_remaining", Kind.u8],
+        ["ping_saw_opponent", Kind.bool],
+        ["version", Kind.u32],
+        [null, BOARD]
+    ]],
+    ["end", 67, [["result", Kind.enumOf(["win", "loss"])], ["reason", Kind.str]]],
+    ["watching", 68, [
+        ["white", Kind.str],
+        ["black", Kind.str],
+        ["view", Kind.enumOf(["master", "white", "black"])]
+    ]]
+];
+
+function JsonCodec() {
+    this.name = "json";
+}
+
+JsonCodec.prototype.encode = function(msg) {
+    return JSON.stringify(msg);
+};
+
+JsonCodec.prototype.decode = function(data) {
+    return JSON.parse(data);
+};
+
+function BinaryCodec() {
+    this.name = "binary";
+    // set once the server says how wide the board is
+    this.boardWidth = 0;
+    this.byType = {};
+    this.byId = {};
+    for (var i = 0; i < MESSAGES.length; i++) {
+        this.byType[MESSAGES[i][0]] = MESSAGES[i];
+        this.byId[MESSAGES[i][1]] = MESSAGES[i];
+    }
+}
+
+BinaryCodec.prototype.encode = function(msg) {
+    var message = this.byType[msg.type];
+    var w = new ByteWriter();
+    w.u8(message[1]);
+    writeFields(w, msg, message[2]);
+    return new Uint8Array(w.bytes).buffer;
+};
+
+BinaryCodec.prototype.decode = function(data) {
+    if (typeof data === "string") {
+        return JSON.parse(data);
+    }
+
+    var r = new ByteReader(data);
+    var message = this.byId[r.u8()];
+    var msg = {type: message[0]};
+    readFields(r, msg, message[2], this.boardWidth);
+    return msg;
+};
+
 function ShapeUI(shapes, color, tile_width, border_width, offset, board, drawFunc, placeFunc) {
     //this.shapes = shapes;
     this.tiles = [];
@@ -296,12 +623,24 @@ function Game(name) {
     this.gameOver = false;
     this.placement_zone = null;
 
+    // last board received from the server, for applying deltas
+    this.boardVersion = 0;
+    this.boardState = null;
+
+    if (PROTOCOL === "binary") {
+        this.codec = new BinaryCodec();
+    } else {
+        this.codec = new JsonCodec();
+    }
+
+    // sent in place of join when reconnecting mid-game
+    this.resumeToken = null;
+
     // websocket stuff
     var hostname = window.location.hostname;
     var port = "9001";
-    var wsUri = "wss://" + hostname + ":" + port + "/";
-    this.ws = openWebSocket(wsUri, this);
-    this.ws.binaryType = "arraybuffer";
+    this.wsUri = "wss://" + hostname + ":" + port + "/";
+    this.connect();
 
     // graphics stuff
     this.graphics = new PIXI.Graphics();
@@ -358,44 +697,77 @@ Game.prototype.onKeyUp = function(e) {
     this.pressed[e.keyCode] = false;
 }
 
+Game.prototype.connect = function() {
+    this.ws = openWebSocket(this.wsUri, this);
+    this.ws.binaryType = "arraybuffer";
+};
+
+Game.prototype.resume = function() {
+    var str = JSON.stringify({
+        "type": "resume",
+        "token": this.resumeToken,
+        "version": this.boardVersion,
+        "protocol": this.codec.name
+    });
+    this.ws.send(str);
+};
+
 Game.prototype.join = function() {
     var str = JSON.stringify({
         "type": "join",
-        "name": this.name
+        "name": this.name,
+        "protocol": this.codec.name
     });
     this.ws.send(str);
 };
 
 Game.prototype.move = function(dir) {
-    var str = JSON.stringify({
+    var data = this.codec.encode({
         "type": "move",
         "direction": dir
     });
-    this.ws.send(str);
+    this.ws.send(data);
 };
 
 Game.prototype.shoot = function(dir) {
-    var str = JSON.stringify({
+    var data = this.codec.encode({
         "type": "shoot",
         "direction": dir
     });
-    this.ws.send(str);
+    this.ws.send(data);
 };
 
 Game.prototype.ping = function(dir) {
-    var str = JSON.stringify({
+    var data = this.codec.encode({
         "type": "ping"
     });
-    this.ws.send(str);
+    this.ws.send(data);
+};
+
+// Sends actions, a list of move/place/shoot/ping messages for this turn,
+// as one message that gets one update back.
+Game.prototype.batch = function(actions) {
+    var data = this.codec.encode({
+        "type": "batch",
+        "actions": actions
+    });
+    this.ws.send(data);
+};
+
+Game.prototype.resync = function() {
+    var data = this.codec.encode({
+        "type": "resync"
+    });
+    this.ws.send(data);
 };
 
 Game.prototype.place = function(shape_index, x, y) {
-    var str = JSON.stringify({
+    var data = this.codec.encode({
         "type": "place",
         "shape_index": shape_index,
         "origin": [x, y]
     });
-    this.ws.send(str);
+    this.ws.send(data);
 };
 
 Game.prototype.addMoveCandidates = function(loc) {
@@ -429,6 +801,74 @@ Game.prototype.addPlacementZone = function(type) {
     }
 };
 
+// Returns the full board described by a start/update message, or null if
+// it was a delta against a version we don't have.
+Game.prototype.applyBoard = function(data) {
+    var blockKeys = ["white_block", "black_block"];
+    var playerKeys = ["white_player", "black_player"];
+
+    if (data.board !== undefined) {
+        this.boardState = {
+            white_player: null,
+            black_player: null,
+            white_block: {},
+            black_block: {}
+        };
+        for (var i = 0; i < playerKeys.length; i++) {
+            var key = playerKeys[i];
+            if (data.board[key] != null) {
+                this.boardState[key] = data.board[key];
+            }
+        }
+        for (var i = 0; i < blockKeys.length; i++) {
+            var key = blockKeys[i];
+            var blocks = data.board[key];
+            for (var j = 0; j < blocks.length; j++) {
+                this.boardState[key][blocks[j].join(",")] = blocks[j];
+            }
+        }
+    } else {
+        var delta = data.board_delta;
+        if (this.boardState === null ||
+            delta.base_version !== this.boardVersion) {
+            return null;
+        }
+
+        for (var i = 0; i < playerKeys.length; i++) {
+            var key = playerKeys[i];
+            if (delta[key] !== undefined) {
+                this.boardState[key] = delta[key];
+            }
+        }
+        for (var i = 0; i < blockKeys.length; i++) {
+            var key = blockKeys[i];
+            var removed = delta.removed[key];
+            for (var j = 0; j < removed.length; j++) {
+                delete this.boardState[key][removed[j].join(",")];
+            }
+            var added = delta.added[key];
+            for (var j = 0; j < added.length; j++) {
+                this.boardState[key][added[j].join(",")] = added[j];
+            }
+        }
+    }
+    this.boardVersion = data.version;
+
+    var boardSpec = {
+        white_player: this.boardState.white_player,
+        black_player: this.boardState.black_player,
+        white_block: [],
+        black_block: []
+    };
+    for (var i = 0; i < blockKeys.length; i++) {
+        var key = blockKeys[i];
+        for (var pos in this.boardState[key]) {
+            boardSpec[key].push(this.boardState[key][pos]);
+        }
+    }
+    return boardSpec;
+};
+
 Game.prototype.update = function(boardSpec) {
     this.board.clearBoard();
 
@@ -0,0 +1,354 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+
+from game import Board, Game, Grid, PlayerType, OFF_BOARD
+
+# Board.TILE_* classes and per-player tiles as lookup arrays
+BLOCK_TILES = np.array(Board.BLOCK_TILES, dtype=bool)
+PLAYER_TILES = np.array(Board.PLAYER_TILES, dtype=bool)
+OPAQUE_TILES = np.array(Board.OPAQUE_TILES, dtype=bool)
+BLOCK_TILE = np.array([Board.TILE_BLOCK_WHITE, Board.TILE_BLOCK_BLACK],
+                      dtype=np.uint8)
+PLAYER_TILE = np.array([Board.TILE_PLAYER_WHITE, Board.TILE_PLAYER_BLACK],
+                       dtype=np.uint8)
+
+# Board indexes along axis 1 of GameBatch.tiles
+MASTER = 0
+
+class BatchTables(object):
+    """Per-width lookup tables for GameBatch, built from the Grid tables
+    and shared by every batch of that width."""
+    _tables = {}
+
+    @staticmethod
+    def for_width(width):
+        try:
+            return BatchTables._tables[width]
+        except KeyError:
+            tables = BatchTables(width)
+            BatchTables._tables[width] = tables
+            return tables
+
+    def __init__(self, width):
+        grid = Grid.for_width(width)
+        size = grid.size
+        self.grid = grid
+
+        # neighbours[direction, pos], OFF_BOARD at the edges
+        self.neighbours = np.array(
+            [grid.neighbours[direction] for direction in xrange(4)],
+            dtype=np.intp
+        )
+
+        # between[end, start] is a packed bitmap of the positions strictly
+        # between start and end on start's line to end
+        between = np.zeros((size, size, size), dtype=bool)
+        for end in xrange(size):
+            for start in xrange(size):
+                line, mask = grid.line(start, end)
+                between[end, start, list(line[:-1])] = True
+        self.between = np.packbits(between, axis=-1)
+
+        # the placement zone, which both players share
+        zone = Game(width)._players[PlayerType.WHITE].placement_zone
+        self.zone = np.zeros(size, dtype=bool)
+        for pos in xrange(size):
+            x = grid.xs[pos]
+            y = grid.ys[pos]
+            self.zone[pos] = (x >= zone.upperleft.x and
+                              y >= zone.upperleft.y and
+                              x < zone.upperleft.x + zone.width and
+                              y < zone.upperleft.y + zone.height)
+
+        # shape_points[shape, point] is an (x, y) offset; shapes with fewer
+        # points repeat their first one, which is harmless
+        num_points = max(len(shape.points) for shape in Game.SHAPES)
+        self.shape_points = np.zeros((len(Game.SHAPES), num_points, 2),
+                                     dtype=np.intp)
+        for i, shape in enumerate(Game.SHAPES):
+            for j in xrange(num_points):
+                point = shape.points[j % len(shape.points)]
+                self.shape_points[i, j] = (point.x, point.y)
+
+class GameBatch(object):
+    """N games of the same width stepped together.
+
+    The state of game i is:
+
+        tiles[i, 0]          the master board
+        tiles[i, 1 + p]      player p's view of the board
+        player_pos[i, b, p]  where board b thinks player p is
+        invis[i, p]          player p's invis mask, as a bool per position
+
+    Every action takes the player type and its arguments either as scalars
+    or as one value per game stepped, and optionally games, the indexes of
+    the games to step (all of them by default). It applies the same rules
+    as the matching game.Game method and returns that method's result for
+    each game as an array.
+    """
+
+    def __init__(self, n, width=None):
+        if width is None:
+            width = Game.BOARD_WIDTH
+        self._tables = BatchTables.for_width(width)
+        self._width = width
+        self.n = n
+
+        size = self._tables.grid.size
+        self.tiles = np.zeros((n, 3, size), dtype=np.uint8)
+        self.player_pos = np.zeros((n, 3, 2), dtype=np.intp)
+        self.invis = np.zeros((n, 2, size), dtype=bool)
+
+        self.reset()
+
+    def reset(self, games=None):
+        games = self._games(games)
+        grid = self._tables.grid
+        middle = self._width / 2
+        white_pos = grid.pack(middle, self._width - 1)
+        black_pos = grid.pack(middle, 0)
+
+        self.tiles[games] = Board.TILE_CLEAR
+        self.tiles[games, :, white_pos] = Board.TILE_PLAYER_WHITE
+        self.tiles[games, :, black_pos] = Board.TILE_PLAYER_BLACK
+        self.player_pos[games, :, PlayerType.WHITE] = white_pos
+        self.player_pos[games, :, PlayerType.BLACK] = black_pos
+        self.invis[games] = False
+
+    def _games(self, games):
+        if games is None:
+            return np.arange(self.n)
+        return np.asarray(games, dtype=np.intp)
+
+    def _args(self, games, *args):
+        return [np.broadcast_to(np.asarray(arg, dtype=np.intp),
+                                games.shape).copy() for arg in args]
+
+    def _set_player_pos(self, games, board, player_type, new_pos,
+                        old_pos_value):
+        """Board.set_player_pos on board for each of games."""
+        cur_pos = self.player_pos[games, board, player_type]
+        self.tiles[games, board, cur_pos] = old_pos_value
+
+        other_pos = self.player_pos[games, board, 1 - player_type]
+        self.tiles[games, board, new_pos] = np.where(
+            new_pos == other_pos,
+            Board.TILE_PLAYER_BOTH,
+            PLAYER_TILE[player_type]
+        )
+        self.player_pos[games, board, player_type] = new_pos
+
+    def _blocked(self, opaque, start, end):
+        """True wherever something in the packed opaque bitmap lies
+        strictly between start and end."""
+        return np.any(self._tables.between[end, start] & opaque, axis=-1)
+
+    def move_player(self, player_type, direction, games=None):
+        games = self._games(games)
+        player_type, direction = self._args(games, player_type, direction)
+        opponent_type = 1 - player_type
+        view = 1 + player_type
+
+        cur_pos = self.player_pos[games, MASTER, player_type]
+        new_pos = self._tables.neighbours[direction, cur_pos]
+        valid = new_pos != OFF_BOARD
+        new_pos = np.where(valid, new_pos, 0)
+
+        old_value = np.where(
+            self.tiles[games, MASTER, cur_pos] == Board.TILE_PLAYER_BOTH,
+            PLAYER_TILE[opponent_type], Board.TILE_CLEAR
+        ).astype(np.uint8)
+        player_old_value = np.where(
+            self.tiles[games, view, cur_pos] == Board.TILE_PLAYER_BOTH,
+            PLAYER_TILE[opponent_type], Board.TILE_CLEAR
+        ).astype(np.uint8)
+
+        value = self.tiles[games, MASTER, new_pos]
+        seen = self.tiles[games, view, new_pos]
+
+        # a block we thought was there but isn't
+        fake = valid & BLOCK_TILES[seen] & ~BLOCK_TILES[value]
+        # a block we didn't know about, or our own
+        hit_opponent = valid & ~fake & (value == BLOCK_TILE[opponent_type])
+        hit_own = valid & ~fake & (value == BLOCK_TILE[player_type])
+        moved = valid & ~fake & ~hit_opponent & ~hit_own
+
+        found = fake | hit_opponent
+        self.tiles[games[found], view[found], new_pos[found]] = value[found]
+
+        self._set_player_pos(games[moved], MASTER, player_type[moved],
+                             new_pos[moved], old_value[moved])
+        self._set_player_pos(games[moved], view[moved], player_type[moved],
+                             new_pos[moved], player_old_value[moved])
+        return moved
+
+    def place_shape(self, origin_x, origin_y, shape_index, player_type,
+                    games=None):
+        games = self._games(games)
+        origin_x, origin_y, shape_index, player_type = self._args(
+            games, origin_x, origin_y, shape_index, player_type)
+        opponent_type = 1 - player_type
+        view = 1 + player_type
+        width = self._width
+
+        tile_placed = np.zeros(games.shape, dtype=bool)
+        points = self._tables.shape_points[shape_index]
+        for i in xrange(points.shape[1]):
+            x = origin_x + points[:, i, 0]
+            y = origin_y + points[:, i, 1]
+            valid = (x >= 0) & (x < width) & (y >= 0) & (y < width)
+            pos = np.where(valid, y * width + x, 0)
+            valid &= self._tables.zone[pos]
+            tile_placed |= valid
+
+            tile = self.tiles[games, MASTER, pos]
+            see_tile = self.tiles[games, view, pos]
+            on_opponent = valid & (tile == PLAYER_TILE[opponent_type])
+            on_self = valid & (tile == PLAYER_TILE[player_type])
+
+            # Fake tile!
+            fake = on_opponent & (see_tile != tile)
+            self.tiles[games[fake], view[fake], pos[fake]] = \
+                BLOCK_TILE[player_type[fake]]
+            self.invis[games[fake], player_type[fake], pos[fake]] = True
+
+            real = valid & ~on_opponent & ~on_self
+            block_tile = BLOCK_TILE[player_type[real]]
+            self.tiles[games[real], MASTER, pos[real]] = block_tile
+            self.tiles[games[real], view[real], pos[real]] = block_tile
+            self.invis[games[real], opponent_type[real], pos[real]] = True
+
+        return tile_placed
+
+    def shoot(self, player_type, direction, games=None):
+        games = self._games(games)
+        player_type, direction = self._args(games, player_type, direction)
+        opponent_type = 1 - player_type
+        view = 1 + player_type
+        neighbours = self._tables.neighbours
+
+        pos = self.player_pos[games, MASTER, player_type]
+        endpoint = pos.copy()
+        walking = self.tiles[games, MASTER, pos] != Board.TILE_PLAYER_BOTH
+        path = [(np.ones(games.shape, dtype=bool), pos)]
+        for i in xrange(Game.SHOOT_RADIUS):
+            pos = np.where(walking, neighbours[direction, pos], OFF_BOARD)
+            on_board = walking & (pos != OFF_BOARD)
+            endpoint[walking] = pos[walking]
+            pos = np.where(on_board, pos, 0)
+            path.append((on_board, pos))
+            walking = on_board & ~OPAQUE_TILES[self.tiles[games, MASTER, pos]]
+
+        # clear out any fake tiles we passed through
+        for on_board, pos in path:
+            value = self.tiles[games, MASTER, pos]
+            fake = on_board & BLOCK_TILES[self.tiles[games, view, pos]] &\
+                   ~BLOCK_TILES[value]
+            self.tiles[games[fake], view[fake], pos[fake]] = value[fake]
+            self.invis[games[fake], player_type[fake], pos[fake]] = False
+
+        # see if we hit anything interesting
+        on_board = endpoint != OFF_BOARD
+        endpoint = np.where(on_board, endpoint, 0)
+        value = self.tiles[games, MASTER, endpoint]
+        hit_player = on_board & PLAYER_TILES[value]
+        hit_block = on_board & BLOCK_TILES[value]
+
+        hit = games[hit_block]
+        self.tiles[hit, MASTER, endpoint[hit_block]] = Board.TILE_CLEAR
+        self.tiles[hit, view[hit_block], endpoint[hit_block]] = \
+            Board.TILE_CLEAR
+        self.invis[hit, opponent_type[hit_block], endpoint[hit_block]] = True
+
+        return hit_player
+
+    def ping(self, player_type, games=None):
+        games = self._games(games)
+        (player_type,) = self._args(games, player_type)
+        opponent_type = 1 - player_type
+        view = 1 + player_type
+        opponent_view = 1 + opponent_type
+
+        player_pos = self.player_pos[games, MASTER, player_type]
+        opponent_pos = self.player_pos[games, MASTER, opponent_type]
+        opaque = np.packbits(OPAQUE_TILES[self.tiles[games, MASTER]],
+                             axis=-1)
+
+        at_both = self.tiles[games, MASTER, opponent_pos] ==\
+                  Board.TILE_PLAYER_BOTH
+        saw = (opponent_pos == player_pos) | (
+            ~at_both & ~self._blocked(opaque, opponent_pos, player_pos))
+
+        # if player sees opponent, opponent also sees player
+        self._set_player_pos(games[saw], view[saw], opponent_type[saw],
+                             opponent_pos[saw], Board.TILE_CLEAR)
+        self._set_player_pos(games[saw], opponent_view[saw], player_type[saw],
+                             player_pos[saw], Board.TILE_CLEAR)
+
+        missed = ~saw
+        last_seen = self.player_pos[games[missed], view[missed],
+                                    opponent_type[missed]]
+        self.tiles[games[missed], view[missed], last_seen] = Board.TILE_CLEAR
+
+        # reveal every invisible tile with a clear line to the player
+        rows, cols = np.nonzero(self.invis[games, player_type])
+        if len(rows):
+            g = games[rows]
+            blocked = self._blocked(opaque[rows], cols, player_pos[rows])
+
+            # a line starting where both players stand stops right there
+            blocked |= (self.tiles[g, MASTER, cols] ==
+                        Board.TILE_PLAYER_BOTH) & (cols != player_pos[rows])
+
+            revealed = ~blocked
+            g = g[revealed]
+            cols = cols[revealed]
+            rows = rows[revealed]
+            self.tiles[g, view[rows], cols] = self.tiles[g, MASTER, cols]
+            self.invis[g, player_type[rows], cols] = False
+
+        return saw
+
+    def to_game(self, i):
+        """Returns game i as a game.Game."""
+        game = Game(self._width)
+        boards = [game._board] +\
+                 [player.board for player in game._players]
+        for b, board in enumerate(boards):
+            for pos, value in enumerate(self.tiles[i, b]):
+                board.set_at(pos, int(value))
+            board._white_pos = int(self.player_pos[i, b, PlayerType.WHITE])
+            board._black_pos = int(self.player_pos[i, b, PlayerType.BLACK])
+
+        for player in game._players:
+            for pos in np.flatnonzero(self.invis[i, player.player_type]):
+                player.invis |= 1 << int(pos)
+        return game
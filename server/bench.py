@@ -0,0 +1,283 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Micro-benchmarks for the game engine hot paths.
+#
+# Each case runs one operation over a set of seeded, reproducible game
+# states, for every combination of board width and block density asked for,
+# and reports operations per second and the net number of GC-tracked
+# objects each operation leaves alive. That's the gen 0 count with
+# collection off: containers freed within the op, and untracked objects like
+# ints and strings, don't show up, so it isn't an allocation count.
+#
+# To record a baseline and check against it later:
+#
+#     python bench.py --save-baseline baseline.json
+#     python bench.py --baseline baseline.json --threshold 0.2
+#
+# The second run exits non-zero if any case is more than 20% slower than
+# it was in the baseline.
+#
+
+import gc
+import random
+import sys
+import time
+
+from game import Game, Location, PlayerType
+import journal
+import log
+import server
+import state
+
+try:
+    import ujson as json
+except:
+    import json
+
+DIRECTIONS = ['N', 'S', 'E', 'W']
+
+def make_game(width, density, rnd):
+    """Returns a Game with about density of its tiles covered in blocks,
+    each owned by a random player and hidden from the other half the
+    time."""
+    game = Game(width)
+    grid = game._grid
+    players = game._players
+    occupied = set(game._board.get_player_pos(player_type)
+                   for player_type in (PlayerType.WHITE, PlayerType.BLACK))
+
+    for pos in xrange(grid.size):
+        if pos in occupied or rnd.random() >= density:
+            continue
+
+        owner = players[rnd.randrange(2)]
+        opponent = players[not owner.player_type]
+        game._board.set_at(pos, owner.block_tile)
+        owner.board.set_at(pos, owner.block_tile)
+        if rnd.randrange(2):
+            opponent.board.set_at(pos, owner.block_tile)
+        else:
+            opponent.invis |= 1 << pos
+
+    return game
+
+def random_location(game, rnd):
+    width = game._grid.width
+    return Location(rnd.randrange(width), rnd.randrange(width))
+
+def setup_move_player(game, rnd):
+    return (game.move_player, rnd.randrange(2), rnd.randrange(4))
+
+def setup_place_shape(game, rnd):
+    return (game.place_shape, random_location(game, rnd),
+            rnd.choice(Game.SHAPES), rnd.randrange(2))
+
+def setup_shoot(game, rnd):
+    return (game.shoot, rnd.randrange(2), rnd.randrange(4))
+
+def setup_ping(game, rnd):
+    return (game.ping, rnd.randrange(2))
+
+def setup_cast_line(game, rnd):
+    return (game.cast_line, random_location(game, rnd),
+            random_location(game, rnd))
+
+def setup_state_apply(game, rnd):
+    """An action tried on the game's state, leaving the game as it was."""
+    action = rnd.randrange(4)
+    if action == 0:
+        action = (journal.MOVE, rnd.randrange(4))
+    elif action == 1:
+        loc = random_location(game, rnd)
+        action = (journal.PLACE, rnd.randrange(len(Game.SHAPES)), loc.x,
+                  loc.y)
+    elif action == 2:
+        action = (journal.SHOOT, rnd.randrange(4))
+    else:
+        action = (journal.PING,)
+    return (state.apply, state.from_game(game), rnd.randrange(2), action)
+
+def setup_for_json(game, rnd):
+    return (game.get_board(rnd.randrange(2)).for_json,)
+
+class StubConn(object):
+    """Stands in for a GameClient connection, dropping what's sent."""
+    get_type_and_parse = server.GameClient.__dict__['get_type_and_parse']
+    send_message = server.GameClient.__dict__['send_message']
+    send_encoded = server.GameClient.__dict__['send_encoded']
+
+    def __init__(self, name):
+        self.name = name
+        self.protocol = server.PROTOCOLS['json']
+
+    def send(self, msg, is_text):
+        pass
+
+    def send_close(self, code, reason=''):
+        pass
+
+def random_action(game, rnd):
+    action = rnd.randrange(4)
+    if action == 0:
+        return {'type': 'move', 'direction': rnd.choice(DIRECTIONS)}
+    elif action == 1:
+        loc = random_location(game, rnd)
+        return {'type': 'place', 'shape_index': rnd.randrange(3),
+                'origin': [loc.x, loc.y]}
+    elif action == 2:
+        return {'type': 'shoot', 'direction': rnd.choice(DIRECTIONS)}
+    else:
+        return {'type': 'ping'}
+
+def setup_session(game, rnd):
+    session = server.GameSession(StubConn('white'), StubConn('black'),
+                                 game=game)
+    session.start()
+
+    msg = random_action(game, rnd)
+    return (session.handle, session.current_player, json.dumps(msg), True)
+
+def setup_session_turn(game, rnd):
+    """A whole turn sent as one batch message."""
+    session = server.GameSession(StubConn('white'), StubConn('black'),
+                                 game=game)
+    session.start()
+
+    msg = {'type': 'batch',
+           'actions': [random_action(game, rnd)
+                       for i in xrange(Game.MOVES_PER_TURN)]}
+    return (session.handle, session.current_player, json.dumps(msg), True)
+
+CASES = [
+    ('move_player', setup_move_player),
+    ('place_shape', setup_place_shape),
+    ('shoot', setup_shoot),
+    ('ping', setup_ping),
+    ('cast_line', setup_cast_line),
+    ('state_apply', setup_state_apply),
+    ('for_json', setup_for_json),
+    ('session', setup_session),
+    ('session_turn', setup_session_turn),
+]
+
+def run_case(setup, width, density, iterations, seed):
+    """Times one call on each of iterations freshly built states.
+    Returns (ops per second, net GC-tracked objects per op)."""
+    rnd = random.Random(seed)
+    calls = [setup(make_game(width, density, rnd), rnd)
+             for i in xrange(iterations)]
+
+    gc.collect()
+    gc.disable()
+    try:
+        count = gc.get_count()[0]
+        start = time.time()
+        for call in calls:
+            call[0](*call[1:])
+        elapsed = time.time() - start
+        objects = gc.get_count()[0] - count
+    finally:
+        gc.enable()
+
+    return iterations / max(elapsed, 1e-9), objects / float(iterations)
+
+def case_key(name, width, density):
+    return '%s/w%d/d%.2f' % (name, width, density)
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = 'usage: bench.py [options]'
+    parser = OptionParser(usage)
+    parser.add_option("-w", "--widths", dest="widths", default="14,28",
+                      help="comma separated board widths")
+    parser.add_option("-d", "--densities", dest="densities",
+                      default="0,0.1,0.3",
+                      help="comma separated fractions of tiles with blocks")
+    parser.add_option("-n", "--iterations", dest="iterations", type="int",
+                      default=2000, help="operations per case")
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=1,
+                      help="random seed for the board states")
+    parser.add_option("-c", "--case", dest="cases", action="append",
+                      help="only run this case (may be repeated)")
+    parser.add_option("-b", "--baseline", dest="baseline",
+                      help="compare against this baseline file")
+    parser.add_option("-t", "--threshold", dest="threshold", type="float",
+                      default=0.2,
+                      help="fail if a case is this much slower than the "
+                           "baseline")
+    parser.add_option("--save-baseline", dest="save_baseline",
+                      help="write results to this baseline file")
+    (options, args) = parser.parse_args()
+
+    # keep the server's logging out of the timings
+    log.set_levels('error')
+
+    widths = [int(w) for w in options.widths.split(',')]
+    densities = [float(d) for d in options.densities.split(',')]
+
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.loads(f.read())
+
+    results = {}
+    regressions = []
+    print '%-28s %14s %10s %10s' % ('case', 'ops/sec', 'net gc/op', 'vs base')
+    for name, setup in CASES:
+        if options.cases and name not in options.cases:
+            continue
+        for width in widths:
+            for density in densities:
+                key = case_key(name, width, density)
+
+                ops, objects = run_case(setup, width, density,
+                                        options.iterations, options.seed)
+                results[key] = {'ops_per_sec': ops,
+                                'net_gc_objects_per_op': objects}
+
+                compare = ''
+                if key in baseline:
+                    ratio = ops / baseline[key]['ops_per_sec']
+                    compare = '%.2fx' % (ratio,)
+                    if ratio < 1.0 - options.threshold:
+                        compare += ' !!'
+                        regressions.append(key)
+                print '%-28s %14.1f %10.2f %10s' % (key, ops, objects,
+                                                    compare)
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            f.write(json.dumps(results))
+
+    if regressions:
+        print
+        print 'REGRESSED:', ', '.join(regressions)
+        sys.exit(1)
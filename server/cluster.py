@@ -0,0 +1,550 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import errno
+import os
+import select
+import signal
+import socket
+import struct
+import threading
+import time
+import traceback
+
+import log
+import metrics
+from matchmaking import MatchQueue
+
+try:
+    import ujson as json
+except:
+    import json
+
+# Each frame on a broker link is a JSON header followed by an opaque payload
+# (a client message being relayed), prefixed with both their lengths.
+FRAME_HEADER = struct.Struct('!II')
+
+cluster_log = log.get_logger('cluster')
+
+def encode_frame(header, payload=''):
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    header = json.dumps(header)
+    return FRAME_HEADER.pack(len(header), len(payload)) + header + payload
+
+class FrameBuffer(object):
+    """Collects bytes read from a link and splits off complete frames."""
+    def __init__(self):
+        self.data = ''
+
+    def feed(self, data):
+        self.data += data
+        frames = []
+        offset = 0
+        while len(self.data) - offset >= FRAME_HEADER.size:
+            header_len, payload_len = FRAME_HEADER.unpack_from(self.data,
+                                                               offset)
+            start = offset + FRAME_HEADER.size
+            end = start + header_len + payload_len
+            if len(self.data) < end:
+                break
+
+            header = json.loads(self.data[start:start + header_len])
+            frames.append((header, self.data[start + header_len:end]))
+            offset = end
+
+        self.data = self.data[offset:]
+        return frames
+
+class Broker(object):
+    """Pairs clients waiting on any worker and relays messages for matches
+    whose players ended up on different workers.
+
+    Messages from workers:
+
+        wait    {client, name, bucket, protocol}
+                                    client joined and wants an opponent
+        cancel  {client}            client left before being matched
+        msg     {session, is_text}  remote player sent payload, to the host
+        send    {session, is_text}  host sends payload to the remote player
+        close   {session, code, reason}
+                                    host closes the remote player
+        closed  {session}           this side's player is gone
+        park    {token}             a seat is held here for token
+        unpark  {token}             it no longer is
+        resume  {client, token, version, protocol}
+                                    client wants the seat held for token
+
+    Messages to workers:
+
+        match   {white, black}      both clients are on this worker
+        host    {session, client, color, opponent, opponent_protocol}
+                                    run the game here against a remote player
+        attach  {session, client}   client plays a game hosted elsewhere
+        resume  {session, token, version, protocol}
+                                    give the seat held for token to the
+                                    player at the other end of session
+        resume_failed {client}      no seat is held for client's token
+        msg, send, close, closed    relayed as above
+        drain                       finish current games and exit
+
+    Clients are paired by a MatchQueue. The client that was waiting longest
+    plays white, and the game runs on the worker of the other one, as it
+    does on a single process.
+    """
+    def __init__(self, max_wait=None):
+        self.links = set()
+        self.waiting = MatchQueue(max_wait)
+        self.routes = {}
+        self.next_session = 0
+
+        # resume token -> link of the worker holding the seat
+        self.parked = {}
+
+    def add_link(self, link):
+        self.links.add(link)
+
+    def remove_link(self, link):
+        self.links.discard(link)
+        for key in [key for key in self.waiting if key[0] is link]:
+            self.waiting.cancel(key)
+        for token in [token for token, host in self.parked.iteritems()
+                      if host is link]:
+            del self.parked[token]
+
+        for session, (host, remote) in self.routes.items():
+            if link is host:
+                remote.send({'op': 'closed', 'session': session})
+            elif link is remote:
+                host.send({'op': 'closed', 'session': session})
+            else:
+                continue
+            del self.routes[session]
+
+    def broadcast(self, header):
+        for link in self.links:
+            link.send(header)
+
+    def handle(self, link, header, payload):
+        op = header['op']
+        if op == 'wait':
+            key = (link, header['client'])
+            waiter = (link, header['client'], header['name'],
+                      header['protocol'])
+            opponent = self.waiting.join(key, waiter, header.get('bucket'))
+            if opponent is not None:
+                self.pair(opponent, waiter)
+        elif op == 'cancel':
+            self.waiting.cancel((link, header['client']))
+        elif op == 'park':
+            self.parked[header['token']] = link
+        elif op == 'unpark':
+            if self.parked.get(header['token']) is link:
+                del self.parked[header['token']]
+        elif op == 'resume':
+            host = self.parked.pop(header['token'], None)
+            if host is None:
+                link.send({'op': 'resume_failed', 'client': header['client']})
+                return
+
+            session = self.next_session
+            self.next_session += 1
+            self.routes[session] = (host, link)
+            link.send({'op': 'attach', 'session': session,
+                       'client': header['client']})
+            host.send({'op': 'resume', 'session': session,
+                       'token': header['token'],
+                       'version': header['version'],
+                       'protocol': header['protocol']})
+        elif op in ('msg', 'send', 'close', 'closed'):
+            route = self.routes.get(header['session'])
+            if route is None:
+                return
+
+            host, remote = route
+            if op == 'closed':
+                del self.routes[header['session']]
+            if link is host:
+                remote.send(header, payload)
+            else:
+                host.send(header, payload)
+
+    def pair_overdue(self):
+        for white, black in self.waiting.pop_overdue():
+            self.pair(white, black)
+
+    def pair(self, white, black):
+        white_link, white, white_name, white_protocol = white
+        link, client, name, protocol = black
+        if white_link is link:
+            link.send({'op': 'match', 'white': white, 'black': client})
+            return
+
+        session = self.next_session
+        self.next_session += 1
+        self.routes[session] = (link, white_link)
+        white_link.send({'op': 'attach', 'session': session,
+                         'client': white})
+        link.send({'op': 'host', 'session': session, 'client': client,
+                   'color': 'black', 'opponent': white_name,
+                   'opponent_protocol': white_protocol})
+
+class WorkerLink(object):
+    """Supervisor side of the socket shared with one worker process."""
+    def __init__(self, index, sock, pid):
+        self.index = index
+        self.sock = sock
+        self.pid = pid
+        self.started = time.time()
+        self.frames = FrameBuffer()
+        self.outgoing = []
+        sock.setblocking(0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, header, payload=''):
+        self.outgoing.append(encode_frame(header, payload))
+
+    def flush(self):
+        data = ''.join(self.outgoing)
+        try:
+            sent = self.sock.send(data)
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                # the worker is gone, reaping it will clean up
+                self.outgoing = []
+                return
+            sent = 0
+        self.outgoing = [data[sent:]] if sent < len(data) else []
+
+    def read(self):
+        """Returns the frames received, or None once the worker has hung
+        up."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return []
+            return None
+
+        if not data:
+            return None
+        return self.frames.feed(data)
+
+class BrokerLink(object):
+    """Worker side of the socket to the broker.
+
+    Frames are read on a background thread, since the connection event loop
+    doesn't know about this socket, and each is passed to
+    handler(header, payload) while holding lock. When the broker goes away
+    the handler gets a final {'op': 'disconnected'}.
+    """
+    def __init__(self, sock, handler, lock):
+        self.sock = sock
+        self.handler = handler
+        self.lock = lock
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def send(self, header, payload=''):
+        data = encode_frame(header, payload)
+        try:
+            with self._send_lock:
+                self.sock.sendall(data)
+        except socket.error:
+            # the reader thread sees the broker hang up and tells the handler
+            pass
+
+    def _dispatch(self, header, payload):
+        with self.lock:
+            try:
+                self.handler(header, payload)
+            except Exception:
+                cluster_log.error('handling %s from the broker:\n%s',
+                                  header.get('op'), traceback.format_exc())
+
+    def _run(self):
+        frames = FrameBuffer()
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                data = ''
+
+            if not data:
+                break
+
+            for header, payload in frames.feed(data):
+                self._dispatch(header, payload)
+
+        self._dispatch({'op': 'disconnected'}, '')
+
+class Supervisor(object):
+    """Runs num_workers copies of run_worker(index, broker_sock) in forked
+    processes and the matchmaking broker between them.
+
+    Every worker listens on the same port, which needs a transport that
+    can share it (see transport.py) so the kernel spreads connections
+    across them. A
+    worker that exits is restarted, after a delay that doubles each time it
+    dies soon after starting. On SIGTERM or SIGINT the workers are told to
+    drain: stop taking new players, finish the games in progress and exit.
+    Any still running after drain_timeout seconds, or after a second
+    signal, are killed. SIGUSR1 logs the matchmaking queue stats,
+    SIGHUP rereads log_levels_file and passes the levels on to the
+    workers, and SIGUSR2 turns profiling on or off in all the workers.
+
+    Given admin_port, the matchmaking stats are also served as metrics on
+    it (see metrics.serve).
+    """
+    MIN_UPTIME = 5.0
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 30.0
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, num_workers, run_worker, drain_timeout=300.0,
+                 max_wait=None, log_levels_file=None, admin_port=None):
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+        self.drain_timeout = drain_timeout
+        self.log_levels_file = log_levels_file
+        self.admin_port = admin_port
+        self.admin = None
+        self.broker = Broker(max_wait)
+        self.stats = self.broker.waiting.stats()
+        self.workers = {}
+        self.restarts = {}
+        self.backoff = {}
+        self.signals = []
+        self.deadline = None
+        self.profiling = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGUSR1, self._on_signal)
+        signal.signal(signal.SIGHUP, self._on_signal)
+        signal.signal(signal.SIGUSR2, self._on_signal)
+
+        if self.admin_port is not None:
+            self.admin = metrics.serve(self.admin_port, self._make_registry())
+
+        for index in xrange(self.num_workers):
+            self._spawn(index)
+
+        while self.workers or self.deadline is None:
+            self._handle_signals()
+            self._reap()
+
+            now = time.time()
+            if self.deadline is not None:
+                if now >= self.deadline:
+                    self._kill_all()
+            else:
+                for index, when in self.restarts.items():
+                    if now >= when:
+                        del self.restarts[index]
+                        self._spawn(index)
+
+            links = self.workers.values()
+            writable = [link for link in links if link.outgoing]
+            try:
+                readable, writable, _ = select.select(links, writable, [],
+                                                      Supervisor.POLL_INTERVAL)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            self.broker.pair_overdue()
+            # the admin thread reads this copy, not the live queue
+            self.stats = self.broker.waiting.stats()
+            for link in writable:
+                link.flush()
+
+            for link in readable:
+                frames = link.read()
+                if frames is None:
+                    self.broker.remove_link(link)
+                    continue
+
+                for header, payload in frames:
+                    self.broker.handle(link, header, payload)
+
+    def _spawn(self, index):
+        parent_sock, child_sock = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for link in self.workers.itervalues():
+                link.sock.close()
+            if self.admin is not None:
+                self.admin.socket.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # ctrl-c goes to the whole process group, let the supervisor
+            # decide what to do about it
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+            log.after_fork()
+
+            status = 0
+            try:
+                self.run_worker(index, child_sock)
+            except:
+                cluster_log.error('worker %d failed:\n%s', index,
+                                  traceback.format_exc())
+                status = 1
+            finally:
+                log.flush()
+                os._exit(status)
+
+        child_sock.close()
+        link = WorkerLink(index, parent_sock, pid)
+        self.workers[index] = link
+        self.broker.add_link(link)
+        cluster_log.info('worker %d started, pid %d', index, pid)
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                break
+
+            if pid == 0:
+                break
+
+            for link in self.workers.values():
+                if link.pid == pid:
+                    self._exited(link, status)
+                    break
+
+    def _exited(self, link, status):
+        if os.WIFSIGNALED(status):
+            how = 'killed by signal %d' % (os.WTERMSIG(status),)
+        else:
+            how = 'exited with status %d' % (os.WEXITSTATUS(status),)
+        cluster_log.info('worker %d (pid %d) %s', link.index, link.pid, how)
+        del self.workers[link.index]
+        self.broker.remove_link(link)
+        link.sock.close()
+
+        if self.deadline is not None:
+            return
+
+        if time.time() - link.started < Supervisor.MIN_UPTIME:
+            delay = min(max(self.backoff.get(link.index, 0) * 2,
+                            Supervisor.MIN_BACKOFF),
+                        Supervisor.MAX_BACKOFF)
+        else:
+            delay = 0
+        self.backoff[link.index] = delay
+        self.restarts[link.index] = time.time() + delay
+
+    def _make_registry(self):
+        registry = metrics.Registry()
+        registry.gauge('ping_workers', 'Worker processes running.',
+                       fn=lambda: len(self.workers))
+        registry.gauge('ping_remote_sessions',
+                       'Games relayed between two workers.',
+                       fn=lambda: len(self.broker.routes))
+        registry.gauge('ping_matchmaking_waiting',
+                       'Clients waiting for an opponent.',
+                       fn=lambda: self.stats['waiting'])
+        registry.gauge('ping_matchmaking_oldest_wait_seconds',
+                       'How long the longest waiting client has waited.',
+                       fn=lambda: self.stats['oldest_wait'])
+        registry.gauge('ping_matchmaking_mean_wait_seconds',
+                       'Mean time matched clients waited.',
+                       fn=lambda: self.stats['mean_wait'])
+        registry.gauge('ping_matchmaking_max_wait_seconds',
+                       'Longest time a matched client waited.',
+                       fn=lambda: self.stats['max_wait'])
+        registry.counter('ping_matchmaking_matches_total',
+                         'Matches made.',
+                         fn=lambda: self.stats['matches'])
+        registry.counter('ping_matchmaking_fallback_matches_total',
+                         'Matches made across buckets after max_wait.',
+                         fn=lambda: self.stats['fallback_matches'])
+        return registry
+
+    def _on_signal(self, signum, frame):
+        # handled from the main loop, not in the middle of it
+        self.signals.append(signum)
+
+    def _handle_signals(self):
+        while self.signals:
+            signum = self.signals.pop()
+            if signum == signal.SIGUSR1:
+                cluster_log.info('matchmaking: %s',
+                                 json.dumps(self.broker.waiting.stats()))
+            elif signum == signal.SIGHUP:
+                self._reload_log_levels()
+            elif signum == signal.SIGUSR2:
+                self.profiling = not self.profiling
+                cluster_log.info('profiling %s',
+                                 'on' if self.profiling else 'off')
+                self.broker.broadcast({'op': 'profile',
+                                       'on': self.profiling})
+            elif self.deadline is None:
+                cluster_log.info('draining workers')
+                self.deadline = time.time() + self.drain_timeout
+                self.restarts.clear()
+                self.broker.broadcast({'op': 'drain'})
+            else:
+                self._kill_all()
+
+    def _reload_log_levels(self):
+        if self.log_levels_file is None:
+            return
+
+        try:
+            spec = log.load_levels(self.log_levels_file)
+        except (IOError, ValueError) as e:
+            cluster_log.error('reading log levels: %s', str(e))
+            return
+        self.broker.broadcast({'op': 'log_levels', 'spec': spec})
+
+    def _kill_all(self):
+        for link in self.workers.itervalues():
+            try:
+                os.kill(link.pid, signal.SIGKILL)
+            except OSError:
+                pass
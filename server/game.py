@@ -27,9 +27,10 @@ ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE.
 """
 
-from collections import namedtuple
-import copy
+from collections import namedtuple, OrderedDict
+from itertools import chain, compress, imap
 import math
+import operator
 
 try:
     import ujson as json
@@ -65,7 +66,7 @@ class Location(object):
         return not (self == other)
 
     def __hash__(self):
-        return (self._x ^ self._y)
+        return hash((self._x, self._y))
 
 # Alias for Location
 Offset = Location
@@ -77,18 +78,30 @@ class Rectangle(object):
         self.height = height
 
     def contains(self, point):
-        res = (point.x >= self.upperleft.x and point.y >= self.upperleft.y\
+        return (point.x >= self.upperleft.x and point.y >= self.upperleft.y\
                 and point.x < (self.upperleft.x + self.width)\
                 and point.y < (self.upperleft.y + self.height))
-        print 'IS', point, 'IN', self.upperleft, ',',\
-                self.width, ',', self.height, ":", res
-
-        return res
 
 ShapeOffset = namedtuple('ShapeOffset', ['x', 'y', 'corner'])
 Shape = namedtuple('Shape', ['points'])
-Player = namedtuple('Player', ['board', 'invis_tiles', 'block_tile',
-                               'player_tile', 'player_type', 'placement_zone'])
+
+class Player(object):
+    """One side of a game, with its own view of the world. invis is a mask
+    of the positions the player has a block drawn at that the master board
+    disagrees with, or that the opponent can't see yet. zone_mask is the
+    placement zone as a mask."""
+    __slots__ = ('board', 'invis', 'block_tile', 'player_tile', 'player_type',
+                 'placement_zone', 'zone_mask')
+
+    def __init__(self, board, block_tile, player_tile, player_type,
+                 placement_zone, zone_mask):
+        self.board = board
+        self.invis = 0
+        self.block_tile = block_tile
+        self.player_tile = player_tile
+        self.player_type = player_type
+        self.placement_zone = placement_zone
+        self.zone_mask = zone_mask
 
 class PlayerType(object):
     WHITE = 0
@@ -143,6 +156,230 @@ SHAPES_STR =\
        X
 """[1:]
 
+# Packed coordinate for "off the edge of the board"
+OFF_BOARD = -1
+
+def bresenham(x0, y0, x1, y1):
+    """Returns the (x, y) points on the line from (x0, y0) to (x1, y1),
+    not including (x0, y0)."""
+    points = []
+    delta_x = x1 - x0
+    delta_y = y1 - y0
+    cur_x = x0
+    cur_y = y0
+
+    x_dir = 1
+    if delta_x < 0:
+        x_dir = -1
+        delta_x = -delta_x
+
+    y_dir = 1
+    if delta_y < 0:
+        y_dir = -1
+        delta_y = -delta_y
+
+    if delta_x > delta_y:
+        delta_y_x2 = delta_y * 2
+        delta_y_x2_minus_delta_x_x2 = delta_y_x2 - (delta_x * 2)
+        error_term = delta_y_x2 - delta_x
+
+        while delta_x > 0:
+            delta_x -= 1
+
+            if error_term >= 0:
+                cur_y += y_dir
+                error_term += delta_y_x2_minus_delta_x_x2
+            else:
+                error_term += delta_y_x2
+            cur_x += x_dir
+            points.append((cur_x, cur_y))
+    else:
+        delta_x_x2 = delta_x * 2
+        delta_x_x2_minus_delta_y_x2 = delta_x_x2 - (delta_y * 2)
+        error_term = delta_x_x2 - delta_y
+
+        while delta_y > 0:
+            delta_y -= 1
+
+            if error_term >= 0:
+                cur_x += x_dir
+                error_term += delta_x_x2_minus_delta_y_x2
+            else:
+                error_term += delta_x_x2
+            cur_y += y_dir
+            points.append((cur_x, cur_y))
+
+    return points
+
+def mask_positions(mask):
+    """Returns the positions of the bits set in mask, lowest first."""
+    positions = []
+    while mask:
+        low = mask & -mask
+        positions.append(low.bit_length() - 1)
+        mask ^= low
+    return positions
+
+class Grid(object):
+    """Packed coordinates for one board width.
+
+    Inside the engine a tile position is the int y * width + x rather than
+    a Location. A Grid holds the lookup tables for converting and stepping
+    between those, and is shared by every board of the same width.
+
+    The line and shadow tables are built as they're used and kept to about
+    MAX_LINE_POSITIONS positions and MAX_SHADOW_BITS bits, which holds them
+    all for small boards but not for wide ones.
+    """
+    _grids = {}
+
+    MAX_LINE_POSITIONS = 1 << 23
+    MAX_SHADOW_BITS = 1 << 28
+
+    @staticmethod
+    def for_width(width):
+        try:
+            return Grid._grids[width]
+        except KeyError:
+            grid = Grid(width)
+            Grid._grids[width] = grid
+            return grid
+
+    def __init__(self, width):
+        self.width = width
+        self.size = width * width
+
+        # (x, y) of each position
+        self.xs = tuple(pos % width for pos in xrange(self.size))
+        self.ys = tuple(pos / width for pos in xrange(self.size))
+        self.coords = tuple(zip(self.xs, self.ys))
+
+        # neighbours[direction][pos] is the position one step in direction,
+        # or OFF_BOARD
+        self.neighbours = {}
+        for direction, offset in Game.DIRECTION_OFFSETS.iteritems():
+            self.neighbours[direction] = tuple(
+                self.pack(self.xs[pos] + offset.x, self.ys[pos] + offset.y)
+                for pos in xrange(self.size)
+            )
+
+        # _lines[start][end] is (line, mask) once built: line is the
+        # positions from start to end, start excluded, and mask has the bit
+        # for each position strictly between the two set. Rows and entries
+        # are built on first use, and all dropped once there are too many
+        # rows.
+        self._lines = [None] * self.size
+        self._line_rows = 0
+        self._max_line_rows = max(
+            1, Grid.MAX_LINE_POSITIONS // (self.size * width))
+
+        # _shadows[end][pos] is a mask of the starts whose line to end
+        # passes through pos (not counting either end), built on first use;
+        # least recently used first
+        self._shadows = OrderedDict()
+        self._max_shadows = max(
+            1, Grid.MAX_SHADOW_BITS // (self.size * self.size))
+        self.full_mask = (1 << self.size) - 1
+
+        # id(shape) -> (shape, mask, min x, min y, max x, max y), with mask
+        # the shape's points with its upper left corner at position 0
+        self._shape_masks = {}
+        # (x, y, width, height) -> mask of the rectangle's positions
+        self._rect_masks = {}
+
+    def line(self, start, end):
+        row = self._lines[start]
+        if row == None:
+            if self._line_rows >= self._max_line_rows:
+                self._lines = [None] * self.size
+                self._line_rows = 0
+            row = [None] * self.size
+            self._lines[start] = row
+            self._line_rows += 1
+
+        entry = row[end]
+        if entry == None:
+            line = tuple(
+                y * self.width + x for x, y in bresenham(
+                    self.xs[start], self.ys[start],
+                    self.xs[end], self.ys[end]
+                )
+            )
+            mask = 0
+            for pos in line[:-1]:
+                mask |= 1 << pos
+            entry = (line, mask)
+            row[end] = entry
+        return entry
+
+    def shadows(self, end):
+        shadows = self._shadows.pop(end, None)
+        if shadows == None:
+            if len(self._shadows) >= self._max_shadows:
+                self._shadows.popitem(last=False)
+
+            # walked here rather than through line(), which would keep
+            # every line to end
+            width = self.width
+            end_x = self.xs[end]
+            end_y = self.ys[end]
+            shadows = [0] * self.size
+            for start in xrange(self.size):
+                bit = 1 << start
+                for x, y in bresenham(self.xs[start], self.ys[start],
+                                      end_x, end_y)[:-1]:
+                    shadows[y * width + x] |= bit
+        self._shadows[end] = shadows
+        return shadows
+
+    def shape_mask(self, shape, x, y):
+        """Returns a mask of the on-board positions covered by shape with
+        its origin at (x, y)."""
+        entry = self._shape_masks.get(id(shape))
+        if entry is None:
+            xs = [offset.x for offset in shape.points]
+            ys = [offset.y for offset in shape.points]
+            min_x, min_y = min(xs), min(ys)
+            mask = 0
+            for offset in shape.points:
+                mask |= 1 << ((offset.y - min_y) * self.width +
+                              offset.x - min_x)
+            entry = (shape, mask, min_x, min_y, max(xs), max(ys))
+            self._shape_masks[id(shape)] = entry
+
+        shape, mask, min_x, min_y, max_x, max_y = entry
+        if (x + min_x >= 0 and x + max_x < self.width and
+                y + min_y >= 0 and y + max_y < self.width):
+            return mask << ((y + min_y) * self.width + x + min_x)
+
+        # partly off the board, where shifting would wrap rows
+        mask = 0
+        for offset in shape.points:
+            pos = self.pack(x + offset.x, y + offset.y)
+            if pos != OFF_BOARD:
+                mask |= 1 << pos
+        return mask
+
+    def rect_mask(self, rect):
+        """Returns a mask of the on-board positions inside rect."""
+        key = (rect.upperleft.x, rect.upperleft.y, rect.width, rect.height)
+        mask = self._rect_masks.get(key)
+        if mask is None:
+            mask = 0
+            for pos in xrange(self.size):
+                if rect.contains(Location(self.xs[pos], self.ys[pos])):
+                    mask |= 1 << pos
+            self._rect_masks[key] = mask
+        return mask
+
+    def pack(self, x, y):
+        if x < 0 or x >= self.width or y < 0 or y >= self.width:
+            return OFF_BOARD
+        return y * self.width + x
+
+    def location(self, pos):
+        return Location(self.xs[pos], self.ys[pos])
+
 class Board(object):
     TILE_CLEAR              = 0
     TILE_BLOCK_BLACK        = 1
@@ -151,101 +388,229 @@ class Board(object):
     TILE_PLAYER_WHITE       = 4
     TILE_PLAYER_BOTH        = 5
 
-    def __init__(self):
-        self._tiles =\
-                [[Board.TILE_CLEAR] * Game.BOARD_WIDTH for i in range(Game.BOARD_WIDTH)]
-        middle = Game.BOARD_WIDTH / 2
-        self._black_loc = Location(middle, 0)
-        self._white_loc = Location(middle, Game.BOARD_WIDTH - 1)
-        self.set_tile(self._white_loc, Board.TILE_PLAYER_WHITE)
-        self.set_tile(self._black_loc, Board.TILE_PLAYER_BLACK)
+    NUM_TILES               = 6
+
+    # Tile classes, indexed by tile value
+    BLOCK_TILES  = (False, True, True, False, False, False)
+    PLAYER_TILES = (False, False, False, True, True, True)
+    OPAQUE_TILES = (False, True, True, True, True, True)
+
+    def __init__(self, width=None):
+        if width is None:
+            width = Game.BOARD_WIDTH
+        self.grid = Grid.for_width(width)
+        self._width = width
+
+        # one byte per tile, indexed by packed position
+        self._tiles = bytearray(self.grid.size)
+
+        # positions of every tile holding each value, TILE_CLEAR excepted,
+        # as sets to walk and as masks to combine
+        self._index = [set() for i in xrange(Board.NUM_TILES)]
+        self._masks = [0] * Board.NUM_TILES
+
+        # bit pos is set for every opaque tile, and for every block
+        self._opaque = 0
+        self._blocks = 0
+
+        # positions of every tile changed since _log_base, in order
+        self._log = []
+        self._log_base = 0
+
+        self.reset()
+
+    def reset(self):
+        """Clears every tile and puts both players back at the start."""
+        self._tiles[:] = bytearray(len(self._tiles))
+        for tiles in self._index:
+            tiles.clear()
+        self._masks[:] = [0] * Board.NUM_TILES
+        self._opaque = 0
+        self._blocks = 0
+        self._forget_changes()
+
+        middle = self._width / 2
+        self._black_pos = self.grid.pack(middle, 0)
+        self._white_pos = self.grid.pack(middle, self._width - 1)
+        self.set_at(self._white_pos, Board.TILE_PLAYER_WHITE)
+        self.set_at(self._black_pos, Board.TILE_PLAYER_BLACK)
+
+    def copy_from(self, other):
+        """Makes this board an exact copy of other."""
+        assert self._width == other._width
+        self._tiles[:] = other._tiles
+        for tiles, other_tiles in zip(self._index, other._index):
+            tiles.clear()
+            tiles.update(other_tiles)
+        self._masks[:] = other._masks
+        self._opaque = other._opaque
+        self._blocks = other._blocks
+        self._white_pos = other._white_pos
+        self._black_pos = other._black_pos
+        self._forget_changes()
+
+    def diff(self, other):
+        """Returns the set of positions whose value differs between this
+        board and other."""
+        assert self._width == other._width
+        if self._tiles == other._tiles:
+            return set()
+
+        return set(compress(
+            xrange(len(self._tiles)),
+            imap(operator.ne, self._tiles, other._tiles)
+        ))
+
+    def _forget_changes(self):
+        # every checkpoint handed out so far becomes too old to answer
+        self._log_base += len(self._log) + 1
+        self._log = []
 
     def valid(self, loc):
-        return (loc.x >= 0 and loc.x < Game.BOARD_WIDTH and
-                loc.y >= 0 and loc.y < Game.BOARD_WIDTH)
+        return (loc.x >= 0 and loc.x < self._width and
+                loc.y >= 0 and loc.y < self._width)
 
     def get_player_loc(self, player_type):
+        return self.grid.location(self.get_player_pos(player_type))
+
+    def get_player_pos(self, player_type):
         if player_type == PlayerType.WHITE:
-            return self._white_loc
+            return self._white_pos
         else:
-            return self._black_loc
+            return self._black_pos
 
     def set_player_loc(self, player_type, new_loc, old_loc_value):
-        if player_type == PlayerType.WHITE:
-            tile = self.get_tile(self._white_loc)
+        self.set_player_pos(player_type, self.grid.pack(new_loc.x, new_loc.y),
+                            old_loc_value)
 
-            self.set_tile(self._white_loc, old_loc_value)
-            if new_loc == self._black_loc:
-                self.set_tile(new_loc, Board.TILE_PLAYER_BOTH)
+    def set_player_pos(self, player_type, new_pos, old_pos_value):
+        if player_type == PlayerType.WHITE:
+            self.set_at(self._white_pos, old_pos_value)
+            if new_pos == self._black_pos:
+                self.set_at(new_pos, Board.TILE_PLAYER_BOTH)
             else:
-                self.set_tile(new_loc, Board.TILE_PLAYER_WHITE)
-            self._white_loc = new_loc
+                self.set_at(new_pos, Board.TILE_PLAYER_WHITE)
+            self._white_pos = new_pos
         elif player_type == PlayerType.BLACK:
-            tile = self.get_tile(self._black_loc)
-
-            self.set_tile(self._black_loc, old_loc_value)
-            if new_loc == self._white_loc:
-                self.set_tile(new_loc, Board.TILE_PLAYER_BOTH)
+            self.set_at(self._black_pos, old_pos_value)
+            if new_pos == self._white_pos:
+                self.set_at(new_pos, Board.TILE_PLAYER_BOTH)
             else:
-                self.set_tile(new_loc, Board.TILE_PLAYER_BLACK)
-            self._black_loc = new_loc
+                self.set_at(new_pos, Board.TILE_PLAYER_BLACK)
+            self._black_pos = new_pos
 
     def set_tile(self, loc, value):
-        self._tiles[loc.x][loc.y] = value
+        self.set_at(loc.y * self._width + loc.x, value)
+
+    def set_at(self, pos, value):
+        old_value = self._tiles[pos]
+        if old_value == value:
+            return
+
+        self._tiles[pos] = value
+
+        bit = 1 << pos
+        if old_value != Board.TILE_CLEAR:
+            self._index[old_value].discard(pos)
+            self._masks[old_value] ^= bit
+        if value != Board.TILE_CLEAR:
+            self._index[value].add(pos)
+            self._masks[value] ^= bit
+        if Board.OPAQUE_TILES[old_value] != Board.OPAQUE_TILES[value]:
+            self._opaque ^= bit
+        if Board.BLOCK_TILES[old_value] != Board.BLOCK_TILES[value]:
+            self._blocks ^= bit
+
+        self._log.append(pos)
+        if len(self._log) > 2 * len(self._tiles):
+            # forget the oldest half; checkpoints from before then will
+            # need a full snapshot
+            trim = len(self._log) / 2
+            del self._log[:trim]
+            self._log_base += trim
+
+    def checkpoint(self):
+        """Returns a token to pass to changes_since() later."""
+        return self._log_base + len(self._log)
+
+    def changes_since(self, checkpoint):
+        """Returns the set of positions whose value changed since
+        checkpoint was taken, or None if that is too far back to know."""
+        if checkpoint < self._log_base:
+            return None
+        return set(self._log[checkpoint - self._log_base:])
+
+    def blocks(self, block_tile):
+        """Returns the set of positions holding block_tile."""
+        return self._index[block_tile]
+
+    def player_for_json(self, player_type):
+        """Returns (x, y) of the tile showing player_type, or None."""
+        if player_type == PlayerType.WHITE:
+            tiles = self._index[Board.TILE_PLAYER_WHITE]
+        else:
+            tiles = self._index[Board.TILE_PLAYER_BLACK]
+        both = self._index[Board.TILE_PLAYER_BOTH]
+        if not tiles and not both:
+            return None
+
+        # match a scan in (x, y) order: the last tile seen wins
+        grid = self.grid
+        return max(grid.coords[pos] for pos in chain(tiles, both))
 
     def get_tile(self, loc):
-        return self._tiles[loc.x][loc.y]
+        return self._tiles[loc.y * self._width + loc.x]
+
+    def get_at(self, pos):
+        return self._tiles[pos]
 
     def is_block(self, loc):
-        return (self._tiles[loc.x][loc.y] == Board.TILE_BLOCK_BLACK or
-                self._tiles[loc.x][loc.y] == Board.TILE_BLOCK_WHITE)
+        return Board.BLOCK_TILES[self._tiles[loc.y * self._width + loc.x]]
+
+    def is_block_at(self, pos):
+        return Board.BLOCK_TILES[self._tiles[pos]]
 
     def is_player(self, loc):
-        return (self._tiles[loc.x][loc.y] == Board.TILE_PLAYER_BLACK or
-                self._tiles[loc.x][loc.y] == Board.TILE_PLAYER_WHITE or
-                self._tiles[loc.x][loc.y] == Board.TILE_PLAYER_BOTH)
+        return Board.PLAYER_TILES[self._tiles[loc.y * self._width + loc.x]]
+
+    def is_player_at(self, pos):
+        return Board.PLAYER_TILES[self._tiles[pos]]
 
     def for_json(self):
+        coords = self.grid.coords
         json_dict = {
-            'black_block': [],
-            'white_block': []
+            'black_block':
+                [coords[pos] for pos in self._index[Board.TILE_BLOCK_BLACK]],
+            'white_block':
+                [coords[pos] for pos in self._index[Board.TILE_BLOCK_WHITE]]
         }
-        for x in xrange(Game.BOARD_WIDTH):
-            for y in xrange(Game.BOARD_WIDTH):
-                tile = self._tiles[x][y]
-                if tile == Board.TILE_CLEAR:
-                    continue
-                elif tile == Board.TILE_BLOCK_BLACK:
-                    json_dict.setdefault('black_block', []).append([x, y])
-                elif tile == Board.TILE_BLOCK_WHITE:
-                    json_dict.setdefault('white_block', []).append([x, y])
-                elif tile == Board.TILE_PLAYER_BLACK:
-                    json_dict['black_player'] = [x, y]
-                elif tile == Board.TILE_PLAYER_WHITE:
-                    json_dict['white_player'] = [x, y]
-                else:
-                    assert tile == Board.TILE_PLAYER_BOTH
-                    json_dict['black_player'] = [x, y]
-                    json_dict['white_player'] = [x, y]
+
+        white_player = self.player_for_json(PlayerType.WHITE)
+        if white_player is not None:
+            json_dict['white_player'] = white_player
+
+        black_player = self.player_for_json(PlayerType.BLACK)
+        if black_player is not None:
+            json_dict['black_player'] = black_player
 
         return json_dict
 
     def __repr__(self):
-        extra_spaces = int(math.log(Game.BOARD_WIDTH, 10)) + 1
+        extra_spaces = int(math.log(self._width, 10)) + 1
         r = ' ' * (extra_spaces + 1)
         col = 'A'
         row = 1
-        for i in xrange(Game.BOARD_WIDTH):
+        for i in xrange(self._width):
             r += col + ' '
             col = chr(ord(col) + 1)
 
         r += '\n'
-        for y in xrange(Game.BOARD_WIDTH):
+        for y in xrange(self._width):
             r += '%*.d ' % (extra_spaces, row)
             row += 1
-            for x in xrange(Game.BOARD_WIDTH):
+            for x in xrange(self._width):
                 c = ''
-                tile = self._tiles[x][y]
+                tile = self._tiles[y * self._width + x]
                 if tile == Board.TILE_CLEAR:
                     c = '.'
                 elif tile == Board.TILE_BLOCK_BLACK:
@@ -285,40 +650,75 @@ class Game(object):
 
     SHAPES = [LONG_SHAPE_0, LONG_SHAPE_1, BOX_SHAPE]
 
-    def __init__(self):
+    def __init__(self, width=None):
+        if width is None:
+            width = Game.BOARD_WIDTH
+        self._grid = Grid.for_width(width)
+
         # master board
-        self._board = Board()
+        self._board = Board(width)
 
-        half_width = Game.BOARD_WIDTH / 2
-        border_width = Game.BOARD_WIDTH / 5
+        half_width = width / 2
+        border_width = width / 5
 
         placement_zone = Rectangle(
             Location(border_width, border_width),
-            Game.BOARD_WIDTH - border_width * 2,
-            Game.BOARD_WIDTH - border_width * 2
+            width - border_width * 2,
+            width - border_width * 2
         )
 
-        # players, with their own view of the world
+        zone_mask = self._grid.rect_mask(placement_zone)
+
         self._players = [
             Player(
-                board=Board(),
-                invis_tiles=set(),
+                board=Board(width),
                 block_tile=Board.TILE_BLOCK_WHITE,
                 player_tile=Board.TILE_PLAYER_WHITE,
                 player_type=PlayerType.WHITE,
-                placement_zone=placement_zone
+                placement_zone=placement_zone,
+                zone_mask=zone_mask
             ),
             Player(
-                board=Board(),
-                invis_tiles=set(),
+                board=Board(width),
                 block_tile=Board.TILE_BLOCK_BLACK,
                 player_tile=Board.TILE_PLAYER_BLACK,
                 player_type=PlayerType.BLACK,
-                placement_zone=placement_zone
+                placement_zone=placement_zone,
+                zone_mask=zone_mask
             )
         ]
 
         self._turn = 0
+        self._left_board_at = None
+
+        # last visible_from() sweep: (end, opaque mask) -> blocked mask
+        self._sweep_key = None
+        self._sweep_blocked = 0
+
+    def reset(self):
+        """Puts this game back as it was when new."""
+        self._board.reset()
+        for player in self._players:
+            player.board.reset()
+            player.invis = 0
+
+        self._turn = 0
+        self._left_board_at = None
+        self._sweep_key = None
+        self._sweep_blocked = 0
+
+    def copy_from(self, other):
+        """Makes this game an exact copy of other, which must be the same
+        width."""
+        self._board.copy_from(other._board)
+        for player, other_player in zip(self._players, other._players):
+            player.board.copy_from(other_player.board)
+            player.invis = other_player.invis
+
+        self._turn = other._turn
+        self._left_board_at = other._left_board_at
+        self._sweep_key = other._sweep_key
+        self._sweep_blocked = other._sweep_blocked
 
     def _get_player(self, player_type):
         return self._players[player_type]
@@ -327,144 +727,141 @@ class Game(object):
         return self._players[not player_type]
 
     def is_opaque(self, x, y):
-        loc = Location(x, y)
-        #res = True
-        #if not self._board.is_block(loc) and not self._board.is_player(loc):
-        #    res = False
-        #    self._board.set_tile(loc, Board.TILE_PLAYER_BOTH)
-        return not self._board.valid(loc) or\
-               self._board.is_block(loc) or\
-               self._board.is_player(loc)
-        #return res
+        pos = self._grid.pack(x, y)
+        return pos == OFF_BOARD or\
+               Board.OPAQUE_TILES[self._board.get_at(pos)]
 
     def cast_line(self, point0, point1, path=None):
-        def octant0(origin, offset, x_dir, y_dir):
-            #print "OCTANT 0 (%d, %d) offset (%d, %d)" % (origin.x, origin.y, offset.x, offset.y)
-            delta_y = offset.y
-            delta_x = offset.x
-            cur_x = origin.x
-            cur_y = origin.y
-
-            delta_y_x2 = delta_y * 2
-            delta_y_x2_minus_delta_x_x2 = delta_y_x2 - (delta_x * 2)
-            error_term = delta_y_x2 - delta_x
-
+        grid = self._grid
+        pos_path = None
+        if path != None:
+            pos_path = []
+
+        endpoint = self._cast_line(grid.pack(point0.x, point0.y),
+                                   point1.x, point1.y, pos_path)
+
+        if path != None:
+            path.extend(grid.location(pos) for pos in pos_path)
+        if endpoint == OFF_BOARD:
+            endpoint = Location(*self._left_board_at)
             if path != None:
-                path.append(Location(cur_x, cur_y))
-
-            tile = self._board.get_tile(origin)
-            if tile == Board.TILE_PLAYER_BOTH:
-                return origin
-
-            while delta_x > 0:
-                delta_x -= 1
-
-                if error_term >= 0:
-                    cur_y += y_dir
-                    error_term += delta_y_x2_minus_delta_x_x2
-                else:
-                    error_term += delta_y_x2
-                cur_x += x_dir
-
-                if path != None:
-                    path.append(Location(cur_x, cur_y))
-
-                if self.is_opaque(cur_x, cur_y):
-                    return Location(cur_x, cur_y)
-
-            return Location(cur_x, cur_y)
-
-        def octant1(origin, offset, x_dir, y_dir):
-            #print "OCTANT 1 (%d, %d) offset (%d, %d)" % (origin.x, origin.y, offset.x, offset.y)
-            delta_y = offset.y
-            delta_x = offset.x
-            cur_x = origin.x
-            cur_y = origin.y
-
-            delta_x_x2 = delta_x * 2
-            delta_x_x2_minus_delta_y_x2 = delta_x_x2 - (delta_y * 2)
-            error_term = delta_x_x2 - delta_y
-
+                path.append(endpoint)
+            return endpoint
+        return grid.location(endpoint)
+
+    def _cast_line(self, start, x1, y1, path=None):
+        """Walks a line from position start toward (x1, y1), which may be
+        off the board.
+
+        Returns the first opaque position after start, the position at
+        (x1, y1) if nothing was in the way, or OFF_BOARD if the line left
+        the board, in which case _left_board_at is the (x, y) it left at.
+        If path is given, every on-board position visited is appended to
+        it.
+        """
+        tiles = self._board._tiles
+
+        if path != None:
+            path.append(start)
+
+        if tiles[start] == Board.TILE_PLAYER_BOTH:
+            return start
+
+        end = self._grid.pack(x1, y1)
+        if end == OFF_BOARD:
+            return self._cast_off_board(start, x1, y1, path)
+
+        line, mask = self._grid.line(start, end)
+        if not (mask & self._board._opaque):
+            # nothing in the way; the end itself may be opaque, but then
+            # it's what we'd stop at anyway
             if path != None:
-                path.append(Location(cur_x, cur_y))
-
-            tile = self._board.get_tile(origin)
-            if tile == Board.TILE_PLAYER_BOTH:
-                return origin
-
-            while delta_y > 0:
-                delta_y -= 1
-                if error_term >= 0:
-                    cur_x += x_dir
-                    error_term += delta_x_x2_minus_delta_y_x2
-                else:
-                    error_term += delta_x_x2
-                cur_y += y_dir
-
-                if path != None:
-                    path.append(Location(cur_x, cur_y))
+                path.extend(line)
+            return end
 
-                if self.is_opaque(cur_x, cur_y):
-                    return Location(cur_x, cur_y)
-
-            return Location(cur_x, cur_y)
-
-        #print "CAST:", point0, point1
-        x0 = point0.x
-        y0 = point0.y
-        x1 = point1.x
-        y1 = point1.y
-
-        delta_x = x1 - x0
-        delta_y = y1 - y0
-
-        x_dir = 1
-        if delta_x < 0:
-            x_dir = -1
-            delta_x = abs(delta_x)
-
-        y_dir = 1
-        if delta_y < 0:
-            y_dir = -1
-            delta_y = abs(delta_y)
-
-        if delta_x > delta_y:
-            return octant0(Location(x0, y0), Offset(delta_x, delta_y),
-                           x_dir, y_dir)
-        else:
-            return octant1(Location(x0, y0), Offset(delta_x, delta_y),
-                           x_dir, y_dir)
+        opaque = Board.OPAQUE_TILES
+        for pos in line:
+            if path != None:
+                path.append(pos)
+            if opaque[tiles[pos]]:
+                return pos
+        return end
+
+    def _cast_off_board(self, start, x1, y1, path):
+        # Lines to off-board points aren't in the tables; walk them.
+        width = self._grid.width
+        tiles = self._board._tiles
+        opaque = Board.OPAQUE_TILES
+
+        pos = start
+        for x, y in bresenham(self._grid.xs[start], self._grid.ys[start],
+                              x1, y1):
+            if x < 0 or x >= width or y < 0 or y >= width:
+                self._left_board_at = (x, y)
+                return OFF_BOARD
+
+            pos = y * width + x
+            if path != None:
+                path.append(pos)
+            if opaque[tiles[pos]]:
+                return pos
+        return pos
+
+    def visible_from(self, end):
+        """Returns a mask of every position whose cast_line to end would
+        reach it.
+
+        Rather than casting from each position, this ORs together the
+        shadow every opaque tile on the master board casts away from end.
+        The result is remembered until a tile changes opacity.
+        """
+        board = self._board
+        if self._sweep_key != (end, board._opaque):
+            shadows = self._grid.shadows(end)
+            blocked = 0
+            for tiles in board._index:
+                for pos in tiles:
+                    blocked |= shadows[pos]
+            self._sweep_key = (end, board._opaque)
+            self._sweep_blocked = blocked
+
+        # a line starting where both players stand stops right there
+        blocked = self._sweep_blocked
+        for pos in board._index[Board.TILE_PLAYER_BOTH]:
+            if pos != end:
+                blocked |= 1 << pos
+
+        return self._grid.full_mask & ~blocked
 
     def ping(self, player_type):
-        player_loc = self._board.get_player_loc(player_type)
+        player_pos = self._board.get_player_pos(player_type)
         player = self._get_player(player_type)
         opponent = self._get_opponent(player_type)
         opponent_type = opponent.player_type
-        opponent_loc = self._board.get_player_loc(opponent_type)
+        opponent_pos = self._board.get_player_pos(opponent_type)
+        player_x = self._grid.xs[player_pos]
+        player_y = self._grid.ys[player_pos]
 
         saw_opponent = False
-        endpoint = self.cast_line(opponent_loc, player_loc)
-        if endpoint == player_loc:
+        endpoint = self._cast_line(opponent_pos, player_x, player_y)
+        if endpoint == player_pos:
             saw_opponent = True
-            #print "REVEALING", opponent_loc, "TO", player_type
-            last_seen_loc = player.board.get_player_loc(opponent_type)
-            player.board.set_player_loc(opponent_type, opponent_loc, Board.TILE_CLEAR)
+            player.board.set_player_pos(opponent_type, opponent_pos,
+                                        Board.TILE_CLEAR)
 
             # if player sees opponent, opponent also sees player
-            #print "REVEALING", player_loc, "TO", opponent_type
-            opponent_last_seen_loc = opponent.board.get_player_loc(player_type)
-            opponent.board.set_player_loc(player_type, player_loc, Board.TILE_CLEAR)
+            opponent.board.set_player_pos(player_type, player_pos,
+                                          Board.TILE_CLEAR)
         else:
-            #player.board.set_player_ghost(opponent_type)
-            opponent_loc = player.board.get_player_loc(opponent_type)
-            player.board.set_tile(opponent_loc, Board.TILE_CLEAR)
+            opponent_pos = player.board.get_player_pos(opponent_type)
+            player.board.set_at(opponent_pos, Board.TILE_CLEAR)
 
-        #print "INVIS:", player.invis_tiles
-        for loc in copy.copy(player.invis_tiles):
-            endpoint = self.cast_line(loc, player_loc)
-            if endpoint == player_loc:
-                player.board.set_tile(loc, self._board.get_tile(loc))
-                player.invis_tiles.remove(loc)
+        if player.invis:
+            revealed = player.invis & self.visible_from(player_pos)
+            if revealed:
+                player.invis ^= revealed
+                for pos in mask_positions(revealed):
+                    player.board.set_at(pos, self._board.get_at(pos))
 
         return saw_opponent
 
@@ -472,41 +869,41 @@ class Game(object):
         player = self._get_player(player_type)
         opponent = self._get_opponent(player_type)
 
-        tile_placed = False
-        for offset in shape.points:
-            loc = origin + offset
-            if self._board.valid(loc) and player.placement_zone.contains(loc):
-                tile_placed = True
-                tile = self._board.get_tile(loc)
-                see_tile = player.board.get_tile(loc)
-                if tile == player.player_tile:
-                    continue
-                elif tile == opponent.player_tile:
-                    if see_tile == tile:
-                        continue
-                    else:
-                        # Fake tile!
-                        player.board.set_tile(loc, player.block_tile)
-                        player.invis_tiles.add(loc)
-                else:
-                    self._board.set_tile(loc, player.block_tile)
-                    player.board.set_tile(loc, player.block_tile)
-                    opponent.invis_tiles.add(loc)
-
-        return tile_placed
+        placed = (self._grid.shape_mask(shape, origin.x, origin.y) &
+                  player.zone_mask)
+        if not placed:
+            return False
 
+        # blocks go everywhere but on the players; where the opponent is,
+        # only if the player can't see them there
+        masks = self._board._masks
+        placed &= ~masks[player.player_tile]
+        on_opponent = placed & masks[opponent.player_tile]
+        if on_opponent:
+            placed ^= on_opponent
+            for pos in mask_positions(on_opponent):
+                if player.board.get_at(pos) != opponent.player_tile:
+                    # Fake tile!
+                    player.board.set_at(pos, player.block_tile)
+                    player.invis |= 1 << pos
+
+        if placed:
+            opponent.invis |= placed
+            for pos in mask_positions(placed):
+                self._board.set_at(pos, player.block_tile)
+                player.board.set_at(pos, player.block_tile)
+
+        return True
 
     def move_player(self, player_type, direction):
-        dir = Game.DIRECTION_OFFSETS[direction]
         player = self._get_player(player_type)
         opponent = self._get_opponent(player_type)
-        cur_loc = self._board.get_player_loc(player_type)
-        new_loc = cur_loc + dir
+        cur_pos = self._board.get_player_pos(player_type)
+        new_pos = self._grid.neighbours[direction][cur_pos]
 
-        #print player_type, "FROM:", cur_loc, "TO:", new_loc
-        if self._board.valid(new_loc):
-            old_value = self._board.get_tile(cur_loc)
-            player_old_value = player.board.get_tile(cur_loc)
+        if new_pos != OFF_BOARD:
+            old_value = self._board.get_at(cur_pos)
+            player_old_value = player.board.get_at(cur_pos)
 
             if old_value == Board.TILE_PLAYER_BOTH:
                 old_value = opponent.player_tile
@@ -518,24 +915,20 @@ class Game(object):
             else:
                 player_old_value = Board.TILE_CLEAR
 
-            value = self._board.get_tile(new_loc)
-            player_value = player.board.get_tile(new_loc)
+            value = self._board.get_at(new_pos)
 
-            #if player_value == player.fake_tile:
-            #    player.board.set_tile(new_loc, self._board.get_tile(new_loc))
-            #    return False
-            if player.board.is_block(new_loc) and\
-               not self._board.is_block(new_loc):
-                player.board.set_tile(new_loc, self._board.get_tile(new_loc))
+            if player.board.is_block_at(new_pos) and\
+               not Board.BLOCK_TILES[value]:
+                player.board.set_at(new_pos, value)
                 return False
             elif value == opponent.block_tile:
-                player.board.set_tile(new_loc, opponent.block_tile)
+                player.board.set_at(new_pos, opponent.block_tile)
                 return False
             elif value == player.block_tile:
                 return False
             else:
-                self._board.set_player_loc(player_type, new_loc, old_value)
-                player.board.set_player_loc(player_type, new_loc,
+                self._board.set_player_pos(player_type, new_pos, old_value)
+                player.board.set_player_pos(player_type, new_pos,
                                             player_old_value)
                 return True
         else:
@@ -543,33 +936,34 @@ class Game(object):
 
     def shoot(self, player_type, direction):
         dir = Game.DIRECTION_OFFSETS[direction]
-        dir = Offset(dir.x * Game.SHOOT_RADIUS, dir.y * Game.SHOOT_RADIUS)
         player = self._get_player(player_type)
         opponent = self._get_opponent(player_type)
-        player_loc = self._board.get_player_loc(player_type)
+        player_pos = self._board.get_player_pos(player_type)
 
         path = []
-        #print 'SHOOTING FROM', player_loc, 'TO', player_loc + dir
-        endpoint = self.cast_line(player_loc, player_loc + dir, path=path)
+        endpoint = self._cast_line(
+            player_pos,
+            self._grid.xs[player_pos] + dir.x * Game.SHOOT_RADIUS,
+            self._grid.ys[player_pos] + dir.y * Game.SHOOT_RADIUS,
+            path=path
+        )
 
         # clear out any fake tiles we passed through
-        for loc in path:
-            if not self._board.valid(loc):
-                continue
-
-            if player.board.is_block(loc) and not self._board.is_block(loc):
-                player.board.set_tile(loc, self._board.get_tile(loc))
-                player.invis_tiles.remove(loc)
+        for pos in path:
+            if player.board.is_block_at(pos) and\
+               not self._board.is_block_at(pos):
+                player.board.set_at(pos, self._board.get_at(pos))
+                player.invis &= ~(1 << pos)
 
         # see if we hit anything interesting
-        if not self._board.valid(endpoint):
+        if endpoint == OFF_BOARD:
             return False
-        if self._board.is_player(endpoint):
+        if self._board.is_player_at(endpoint):
             return True
-        elif self._board.is_block(endpoint):
-            self._board.set_tile(loc, Board.TILE_CLEAR)
-            player.board.set_tile(loc, Board.TILE_CLEAR)
-            opponent.invis_tiles.add(loc)
+        elif self._board.is_block_at(endpoint):
+            self._board.set_at(endpoint, Board.TILE_CLEAR)
+            player.board.set_at(endpoint, Board.TILE_CLEAR)
+            opponent.invis |= 1 << endpoint
             return False
         else:
             return False
@@ -578,6 +972,10 @@ class Game(object):
         player = self._get_player(player_type)
         return player.board
 
+    def get_master_board(self):
+        """Returns the board as it really is, without fog of war."""
+        return self._board
+
     def get_zone_for_json(self, player_type):
         zone = self._get_player(player_type).placement_zone
         zone_dict = {
@@ -0,0 +1,318 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Append-only binary journals of games, and replaying them.
+#
+# Each game gets its own file. It starts with a header:
+#
+#     magic "PINGJNL", version (B), board width (H), start time (d),
+#     white name length (H), black name length (H), then both names
+#
+# followed by fixed size records, all big-endian:
+#
+#     turn (I), kind (B), flags (B), arg (B), x (h), y (h)
+#
+# kind is MOVE, PLACE, SHOOT or PING, with the direction or shape index in
+# arg and the placement origin in x, y. Bit 0 of flags is the player type
+# and bit 1 is set if the action used up a move. Every action the game ran
+# is recorded, used up or not, since the ones that aren't can still reveal
+# tiles. The last record, if the game finished, is END, with the winner in
+# flags and an index into END_REASONS, the loser's reason, in arg.
+#
+# Recording packs a record into a queue; a background thread appends what
+# has built up a few times a second. A game whose journal can't be written,
+# say to a full disk, is logged and the rest of it dropped, rather than
+# left to build up or appended to a file it may have been cut short in.
+#
+
+from collections import deque, namedtuple
+from itertools import count
+import os
+import struct
+import threading
+import time
+
+from game import Game, Location
+import log
+
+journal_log = log.get_logger('journal')
+
+MAGIC = 'PINGJNL'
+VERSION = 1
+
+HEADER = struct.Struct('!7sBHdHH')
+RECORD = struct.Struct('!IBBBhh')
+
+END = 0
+MOVE = 1
+PLACE = 2
+SHOOT = 3
+PING = 4
+
+END_REASONS = ('destroyed', 'not your turn', 'invalid data', 'disconnected',
+               'timed out')
+
+FLAG_BLACK = 1
+FLAG_USED = 2
+
+# place origins well off the board place nothing, so clamping them to what
+# fits in a record doesn't change the outcome
+COORD_MIN = -32768
+COORD_MAX = 32767
+
+MAX_NAME = 255
+
+Action = namedtuple('Action', ['turn', 'kind', 'player_type', 'used', 'arg',
+                               'x', 'y'])
+
+class JournalError(Exception):
+    pass
+
+class SessionJournal(object):
+    """Records one game into the journal it came from."""
+    def __init__(self, journal, path):
+        self.journal = journal
+        self.path = path
+
+    def action(self, turn, player_type, used, kind, arg=0, x=0, y=0):
+        x = max(COORD_MIN, min(COORD_MAX, x))
+        y = max(COORD_MIN, min(COORD_MAX, y))
+        flags = player_type | (FLAG_USED if used else 0)
+        self.journal.queue.append(
+            (self.path, RECORD.pack(turn, kind, flags, arg, x, y)))
+
+    def end(self, turn, winner_type, reason):
+        self.journal.queue.append(
+            (self.path, RECORD.pack(turn, END, winner_type,
+                                    END_REASONS.index(reason), 0, 0)))
+        self.journal.queue.append((self.path, None))
+
+class Journal(object):
+    """Writes a journal per game into directory, from a background thread
+    that runs once start() is called."""
+    def __init__(self, directory, interval=0.2):
+        self.directory = directory
+        self.interval = interval
+        self.queue = deque()
+        self.ids = count()
+        self._files = {}
+        # games not journaled any more since writing them failed
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def session(self, white_name, black_name, width=None):
+        if width is None:
+            width = Game.BOARD_WIDTH
+
+        white_name = white_name[:MAX_NAME]
+        black_name = black_name[:MAX_NAME]
+        now = time.time()
+        name = '%s-%d-%d.journal' % (time.strftime('%Y%m%d-%H%M%S',
+                                                   time.localtime(now)),
+                                     os.getpid(), next(self.ids))
+        path = os.path.join(self.directory, name)
+        self.queue.append((path, HEADER.pack(MAGIC, VERSION, width, now,
+                                             len(white_name),
+                                             len(black_name)) +
+                                 white_name + black_name))
+        return SessionJournal(self, path)
+
+    def flush(self):
+        with self._lock:
+            batches = {}
+            order = []
+            while True:
+                try:
+                    path, data = self.queue.popleft()
+                except IndexError:
+                    break
+                if path not in batches:
+                    batches[path] = []
+                    order.append(path)
+                batches[path].append(data)
+
+            for path in order:
+                chunks = batches[path]
+                if path not in self._failed:
+                    try:
+                        self._write(path, chunks)
+                    except (IOError, OSError) as e:
+                        journal_log.error('writing %s: %s', path, e)
+                        self._failed.add(path)
+                        self._close(path)
+                if chunks[-1] is None:
+                    self._failed.discard(path)
+
+    def _write(self, path, chunks):
+        f = self._files.get(path)
+        if f is None:
+            f = self._files[path] = open(path, 'ab')
+        f.write(''.join(chunk for chunk in chunks if chunk))
+        f.flush()
+        if chunks[-1] is None:
+            # the game is over
+            self._close(path)
+
+    def _close(self, path):
+        f = self._files.pop(path, None)
+        if f is not None:
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+def read(path):
+    """Returns (header dict, [Action], end Action or None) for the journal
+    at path. A record cut short by a crash is ignored."""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if len(data) < HEADER.size:
+        raise JournalError('%s: not a journal' % (path,))
+    magic, version, width, started, white_len, black_len = \
+        HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise JournalError('%s: not a version %d journal' % (path, VERSION))
+
+    offset = HEADER.size
+    header = {
+        'width': width,
+        'started': started,
+        'white': data[offset:offset + white_len],
+        'black': data[offset + white_len:offset + white_len + black_len]
+    }
+    offset += white_len + black_len
+
+    actions = []
+    end = None
+    while offset + RECORD.size <= len(data):
+        turn, kind, flags, arg, x, y = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        action = Action(turn, kind, flags & FLAG_BLACK,
+                        bool(flags & FLAG_USED), arg, x, y)
+        if kind == END:
+            end = action
+            break
+        actions.append(action)
+    return header, actions, end
+
+def apply_action(game, action):
+    """Runs action on game and returns whether it used up a move, or for
+    SHOOT whether it hit."""
+    if action.kind == MOVE:
+        return game.move_player(action.player_type, action.arg)
+    elif action.kind == PLACE:
+        return game.place_shape(Location(action.x, action.y),
+                                Game.SHAPES[action.arg], action.player_type)
+    elif action.kind == SHOOT:
+        return game.shoot(action.player_type, action.arg)
+    elif action.kind == PING:
+        game.ping(action.player_type)
+        return True
+    raise JournalError('unknown action kind %d' % (action.kind,))
+
+class Replay(object):
+    """Rebuilds the game in a journal as it was after any number of its
+    actions.
+
+    A copy of the game is kept every snapshot_every actions replayed, so
+    seeking starts from the nearest one at or before where it is going
+    rather than from the beginning.
+    """
+    def __init__(self, path, snapshot_every=32):
+        self.header, self.actions, self.end = read(path)
+        self.width = self.header['width']
+        self.snapshot_every = snapshot_every
+        self.snapshots = [Game(self.width)]
+
+    def __len__(self):
+        return len(self.actions)
+
+    def game_at(self, index):
+        """Returns a new Game as it was after the first index actions."""
+        if not 0 <= index <= len(self.actions):
+            raise IndexError('action index out of range')
+
+        every = self.snapshot_every
+        nearest = min(index // every, len(self.snapshots) - 1)
+        game = Game(self.width)
+        game.copy_from(self.snapshots[nearest])
+
+        for i in xrange(nearest * every, index):
+            self._apply(game, i)
+            if (i + 1) % every == 0 and (i + 1) // every == len(self.snapshots):
+                snapshot = Game(self.width)
+                snapshot.copy_from(game)
+                self.snapshots.append(snapshot)
+        return game
+
+    def _apply(self, game, i):
+        action = self.actions[i]
+        result = apply_action(game, action)
+        if action.kind in (MOVE, PLACE) and result != action.used:
+            raise JournalError('replay diverged at action %d' % (i,))
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = 'usage: journal.py [options] journal'
+    parser = OptionParser(usage)
+    parser.add_option("-a", "--at", dest="at", type="int",
+                      help="show the game after this many actions "
+                           "(default: all of them)")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected a journal')
+
+    try:
+        replay = Replay(args[0])
+        at = len(replay) if options.at is None else options.at
+        game = replay.game_at(at)
+    except (IOError, IndexError, JournalError) as e:
+        parser.error(str(e))
+
+    print '%s (white) vs %s (black), %d actions' % (
+        replay.header['white'], replay.header['black'], len(replay))
+    if replay.end is not None:
+        print '%s won, loser: %s' % (
+            ('white', 'black')[replay.end.player_type],
+            END_REASONS[replay.end.arg])
+    print
+    print 'after %d actions:' % (at,)
+    print game
@@ -0,0 +1,267 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Leveled logging that stays off the hot path.
+#
+# Loggers are per category ("conn", "session", ...) and each has its own
+# level. A call below the level returns after one comparison. Anything else
+# is appended, unformatted, to a bounded ring buffer, and a background
+# thread formats and writes out what has built up a few times a second.
+# When the buffer is full the oldest records are dropped and counted. Since
+# formatting happens later, pass values that won't change, not live
+# objects.
+#
+# Levels are given as a spec like "info,session=debug,conn=warning": a bare
+# level applies to every category, category=level to just that one.
+#
+
+from collections import deque
+import atexit
+import os
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR
+}
+LEVEL_NAMES = dict((level, name.upper()) for name, level in LEVELS.items())
+
+class RingSink(object):
+    """Bounded buffer of log records, written out by a background thread."""
+    def __init__(self, capacity=8192, interval=0.2, stream=None):
+        self.buffer = deque(maxlen=capacity)
+        self.capacity = capacity
+        self.interval = interval
+        self.stream = stream
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def record(self, level, category, fmt, args):
+        if len(self.buffer) == self.capacity:
+            self.dropped += 1
+        self.buffer.append((time.time(), level, category, fmt, args))
+
+    def flush(self):
+        with self._lock:
+            lines = []
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(self._format(time.time(), WARNING, 'log',
+                                          'dropped %d records', (dropped,)))
+            while True:
+                try:
+                    record = self.buffer.popleft()
+                except IndexError:
+                    break
+                lines.append(self._format(*record))
+
+            if lines:
+                stream = self.stream or sys.stdout
+                stream.write(''.join(lines))
+                stream.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def after_fork(self):
+        """Forgets what the parent had buffered and starts a flush thread,
+        which the child doesn't inherit."""
+        self.buffer.clear()
+        self.dropped = 0
+        self._lock = threading.Lock()
+        if self._thread is not None:
+            self.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def _format(self, when, level, category, fmt, args):
+        try:
+            message = fmt % args if args else fmt
+        except Exception:
+            message = 'bad log format: %r %r' % (fmt, args)
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+        return '%s.%03d [%d] %s %s: %s\n' % (stamp, int(when * 1000) % 1000,
+                                            os.getpid(), LEVEL_NAMES[level],
+                                            category, message)
+
+class Logger(object):
+    def __init__(self, sink, category, level):
+        self.sink = sink
+        self.category = category
+        self.level = level
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def debug(self, fmt, *args):
+        if DEBUG >= self.level:
+            self.sink.record(DEBUG, self.category, fmt, args)
+
+    def info(self, fmt, *args):
+        if INFO >= self.level:
+            self.sink.record(INFO, self.category, fmt, args)
+
+    def warning(self, fmt, *args):
+        if WARNING >= self.level:
+            self.sink.record(WARNING, self.category, fmt, args)
+
+    def error(self, fmt, *args):
+        if ERROR >= self.level:
+            self.sink.record(ERROR, self.category, fmt, args)
+
+    def sampled(self, per_second):
+        return SampledLogger(self, per_second)
+
+class SampledLogger(object):
+    """Lets through at most about per_second records a second, for events
+    that happen on every message. The next record let through says how
+    many were skipped."""
+    def __init__(self, logger, per_second):
+        self.logger = logger
+        self.per_second = float(per_second)
+        self.tokens = self.per_second
+        self.last = time.time()
+        self.skipped = 0
+
+    def _allow(self, level):
+        if level < self.logger.level:
+            return False
+
+        now = time.time()
+        self.tokens = min(self.per_second,
+                          self.tokens + (now - self.last) * self.per_second)
+        self.last = now
+        if self.tokens < 1:
+            self.skipped += 1
+            return False
+
+        self.tokens -= 1
+        return True
+
+    def _record(self, level, fmt, args):
+        if self.skipped:
+            fmt += ' (%d similar skipped)'
+            args += (self.skipped,)
+            self.skipped = 0
+        self.logger.sink.record(level, self.logger.category, fmt, args)
+
+    def debug(self, fmt, *args):
+        if self._allow(DEBUG):
+            self._record(DEBUG, fmt, args)
+
+    def info(self, fmt, *args):
+        if self._allow(INFO):
+            self._record(INFO, fmt, args)
+
+_sink = RingSink()
+_loggers = {}
+_default_level = INFO
+_levels = {}
+
+def get_logger(category):
+    try:
+        return _loggers[category]
+    except KeyError:
+        logger = Logger(_sink, category, _levels.get(category,
+                                                     _default_level))
+        _loggers[category] = logger
+        return logger
+
+def parse_levels(spec):
+    """Returns (default level or None, {category: level}) for a spec, or
+    raises ValueError."""
+    default = None
+    levels = {}
+    for part in spec.replace('\n', ',').split(','):
+        part = part.strip()
+        if not part or part.startswith('#'):
+            continue
+
+        category, _, name = part.rpartition('=')
+        try:
+            level = LEVELS[name.strip().lower()]
+        except KeyError:
+            raise ValueError('unknown log level: %s' % (name,))
+
+        if category:
+            levels[category.strip()] = level
+        else:
+            default = level
+    return default, levels
+
+def set_levels(spec):
+    """Applies a level spec to every logger, now and from then on.
+    Categories the spec doesn't name go back to the default level."""
+    global _default_level, _levels
+    default, levels = parse_levels(spec)
+    if default is not None:
+        _default_level = default
+    _levels = levels
+    for category, logger in _loggers.iteritems():
+        logger.level = _levels.get(category, _default_level)
+
+def load_levels(path):
+    """Applies the level spec in the file at path and returns it."""
+    with open(path) as f:
+        spec = f.read()
+    set_levels(spec)
+    return spec
+
+def start(stream=None, capacity=None):
+    """Starts writing logs out, to stdout unless given a stream."""
+    if stream is not None:
+        _sink.stream = stream
+    if capacity is not None:
+        _sink.capacity = capacity
+        _sink.buffer = deque(_sink.buffer, maxlen=capacity)
+    _sink.start()
+
+def after_fork():
+    _sink.after_fork()
+
+def flush():
+    _sink.flush()
+
+atexit.register(flush)
@@ -0,0 +1,159 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from collections import OrderedDict
+import time
+
+class MatchQueue(object):
+    """Clients waiting for an opponent, in the order they joined.
+
+    Each client waits in a bucket (a region, a skill band, or None for
+    anyone) and is paired with the client that has waited longest in the
+    same bucket. Once a client has waited max_wait seconds it will take
+    the next client from any bucket instead. Joining, cancelling and
+    pairing are all O(1); waiting clients are kept in ordered dicts, which
+    are linked lists underneath.
+
+    Keys identify clients and must be hashable, values are what gets
+    handed back when a client is paired.
+    """
+    def __init__(self, max_wait=None, clock=time.time):
+        self.max_wait = max_wait
+        self.clock = clock
+        # key -> (value, bucket, time joined), over all buckets
+        self._order = OrderedDict()
+        # bucket -> OrderedDict of the keys waiting in it
+        self._buckets = {}
+
+        self.matches = 0
+        self.fallback_matches = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, key):
+        return key in self._order
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def values(self):
+        return [entry[0] for entry in self._order.itervalues()]
+
+    def join(self, key, value, bucket=None):
+        """Pairs key with a waiting client if there is one for it, and
+        returns that client's value. Otherwise key starts waiting and None
+        is returned."""
+        now = self.clock()
+        waiting = self._buckets.get(bucket)
+        if waiting:
+            other = next(iter(waiting))
+        elif self._order and self._overdue(next(iter(self._order)), now):
+            other = next(iter(self._order))
+            self.fallback_matches += 1
+        else:
+            self._order[key] = (value, bucket, now)
+            self._buckets.setdefault(bucket, OrderedDict())[key] = None
+            return None
+
+        self.matches += 1
+        self._record_wait(0.0)
+        return self._take(other, now)
+
+    def cancel(self, key):
+        """Stops key waiting. Returns its value, or None if it wasn't."""
+        if key not in self._order:
+            return None
+
+        value, bucket, since = self._order.pop(key)
+        self._remove_from_bucket(key, bucket)
+        return value
+
+    def pop_overdue(self):
+        """Pairs clients that have waited longer than max_wait with the
+        longest waiting client in any other bucket. Returns a list of
+        (value, value) pairs, the one that waited longer first."""
+        pairs = []
+        if self.max_wait is None:
+            return pairs
+
+        now = self.clock()
+        while len(self._order) >= 2:
+            oldest = next(iter(self._order))
+            if not self._overdue(oldest, now):
+                break
+
+            first = self._take(oldest, now)
+            second = self._take(next(iter(self._order)), now)
+            self.matches += 1
+            self.fallback_matches += 1
+            pairs.append((first, second))
+        return pairs
+
+    def stats(self):
+        now = self.clock()
+        if self._order:
+            oldest = now - self._order[next(iter(self._order))][2]
+        else:
+            oldest = 0.0
+
+        return {
+            'waiting': len(self._order),
+            'buckets': dict((bucket, len(keys))
+                            for bucket, keys in self._buckets.iteritems()),
+            'oldest_wait': oldest,
+            'matches': self.matches,
+            'fallback_matches': self.fallback_matches,
+            'mean_wait': self._total_wait / max(self._waits, 1),
+            'max_wait': self._max_wait_seen
+        }
+
+    def _overdue(self, key, now):
+        return (self.max_wait is not None and
+                now - self._order[key][2] >= self.max_wait)
+
+    def _take(self, key, now):
+        value, bucket, since = self._order.pop(key)
+        self._remove_from_bucket(key, bucket)
+        self._record_wait(now - since)
+        return value
+
+    def _remove_from_bucket(self, key, bucket):
+        waiting = self._buckets[bucket]
+        del waiting[key]
+        if not waiting:
+            del self._buckets[bucket]
+
+    def _record_wait(self, waited):
+        self._waits += 1
+        self._total_wait += waited
+        self._max_wait_seen = max(self._max_wait_seen, waited)
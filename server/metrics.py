@@ -0,0 +1,290 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Counters, gauges and latency histograms, exposed in the Prometheus text
+# format over HTTP on a local admin port.
+#
+# Updating a metric is an attribute increment or two, so they are cheap
+# enough to leave on. Labelled metrics hand out a child per set of label
+# values, which is what gets updated.
+#
+
+import BaseHTTPServer
+import threading
+import time
+
+import log
+
+metrics_log = log.get_logger('metrics')
+
+class Metric(object):
+    """Given fn, the value is fn() at the time it is read, so nothing needs
+    updating as it changes."""
+    type = None
+
+    def __init__(self, name, help, label_names=(), fn=None):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.fn = fn
+        self.children = {}
+        if not label_names:
+            self.children[()] = self._new_child()
+
+    def labels(self, *values):
+        try:
+            return self.children[values]
+        except KeyError:
+            child = self._new_child()
+            self.children[values] = child
+            return child
+
+    def render(self, lines):
+        lines.append('# HELP %s %s\n' % (self.name, self.help))
+        lines.append('# TYPE %s %s\n' % (self.name, self.type))
+        for values, child in sorted(self.children.iteritems()):
+            labels = ','.join('%s="%s"' % (name, value) for name, value
+                              in zip(self.label_names, values))
+            self._render_child(lines, labels, child)
+
+    def _render_child(self, lines, labels, child):
+        if self.fn is not None:
+            child.value = self.fn()
+        lines.append('%s%s %r\n' % (self.name, labels and '{%s}' % labels,
+                                    child.value))
+
+class CounterChild(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.children[()].value += amount
+
+class GaugeChild(object):
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self.children[()].value = value
+
+    def inc(self, amount=1):
+        self.children[()].value += amount
+
+    def dec(self, amount=1):
+        self.children[()].value -= amount
+
+class HistogramChild(object):
+    """Counts of observations in log-linear buckets, like HdrHistogram:
+    each power of two of microseconds is split into SUB_BUCKETS buckets, so
+    a value is off by at most 1/SUB_BUCKETS of itself. Values are truncated
+    to whole microseconds and anything past about two minutes lands in the
+    last bucket."""
+    SUB_BUCKET_BITS = 2
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    NUM_BUCKETS = 28 * SUB_BUCKETS
+
+    def __init__(self):
+        self.counts = [0] * HistogramChild.NUM_BUCKETS
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        micros = int(seconds * 1000000)
+        if micros < HistogramChild.SUB_BUCKETS:
+            index = max(micros, 0)
+        else:
+            shift = micros.bit_length() - HistogramChild.SUB_BUCKET_BITS - 1
+            index = (((shift + 1) << HistogramChild.SUB_BUCKET_BITS) +
+                     (micros >> shift) - HistogramChild.SUB_BUCKETS)
+            if index >= HistogramChild.NUM_BUCKETS:
+                index = HistogramChild.NUM_BUCKETS - 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    @staticmethod
+    def upper_bound(index):
+        """Returns the smallest number of microseconds above bucket index."""
+        if index < HistogramChild.SUB_BUCKETS:
+            return index + 1
+        shift = (index >> HistogramChild.SUB_BUCKET_BITS) - 1
+        top = HistogramChild.SUB_BUCKETS + (index % HistogramChild.SUB_BUCKETS)
+        return (top + 1) << shift
+
+class Histogram(Metric):
+    """Latencies in seconds. Buckets are only written out up to the highest
+    one that has been used, the rest being the same as +Inf."""
+    type = 'histogram'
+
+    def _new_child(self):
+        return HistogramChild()
+
+    def observe(self, seconds):
+        self.children[()].observe(seconds)
+
+    def time(self):
+        return Timer(self.children[()])
+
+    def _render_child(self, lines, labels, child):
+        prefix = labels and labels + ','
+        counts = child.counts
+        last = len(counts) - 1
+        while last >= 0 and not counts[last]:
+            last -= 1
+
+        total = 0
+        for index in xrange(last + 1):
+            total += counts[index]
+            lines.append('%s_bucket{%sle="%r"} %d\n' % (
+                self.name, prefix,
+                HistogramChild.upper_bound(index) / 1000000.0, total))
+        lines.append('%s_bucket{%sle="+Inf"} %d\n' % (self.name, prefix,
+                                                      child.count))
+
+        labels = labels and '{%s}' % labels
+        lines.append('%s_sum%s %r\n' % (self.name, labels, child.sum))
+        lines.append('%s_count%s %d\n' % (self.name, labels, child.count))
+
+class Timer(object):
+    """with histogram.time(): ... observes how long the block took."""
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.time() - self.start)
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self._by_name = {}
+
+    def add(self, metric):
+        """Registers metric, replacing one with the same name."""
+        old = self._by_name.get(metric.name)
+        if old is not None:
+            self.metrics.remove(old)
+        self.metrics.append(metric)
+        self._by_name[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names=(), fn=None):
+        return self.add(Counter(name, help, label_names, fn))
+
+    def gauge(self, name, help, label_names=(), fn=None):
+        return self.add(Gauge(name, help, label_names, fn))
+
+    def histogram(self, name, help, label_names=()):
+        return self.add(Histogram(name, help, label_names))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            metric.render(lines)
+        return ''.join(lines)
+
+REGISTRY = Registry()
+
+class LagMonitor(object):
+    """Observes how late a thread that sleeps for interval seconds wakes
+    up. Callbacks that hold the interpreter for a long time show up as
+    lag, since this thread can't run until they let go."""
+    def __init__(self, histogram, interval=0.1):
+        self.histogram = histogram
+        self.interval = interval
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            start = time.time()
+            time.sleep(self.interval)
+            self.histogram.observe(max(time.time() - start - self.interval,
+                                       0.0))
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    def __init__(self, address, registry):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.registry = registry
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        metrics_log.debug(fmt, *args)
+
+def serve(port, registry=REGISTRY, host='127.0.0.1'):
+    """Serves registry at http://host:port/metrics from a background
+    thread. Returns the HTTP server."""
+    httpd = MetricsServer((host, port), registry)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    metrics_log.info('serving metrics on %s:%d', host, port)
+    return httpd
@@ -0,0 +1,109 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Games kept for reuse between matches.
+#
+# A new Game allocates three boards, each with its tile array, index sets
+# and change log, plus the players around them, and all of it becomes
+# garbage when the match ends. A GamePool keeps up to max_size finished
+# games, reset to how they were when new, and hands them to the next
+# matches to start, so a busy server allocates games only when more are
+# being played at once than ever before. Like the timing wheel it isn't
+# thread safe; the server only uses its pool with its lock held.
+#
+
+import sys
+
+from game import Game, Grid
+
+class GamePool(object):
+    def __init__(self, max_size, width=None):
+        self.max_size = max_size
+        self.width = width
+        self._free = []
+        # acquire() calls that found a game waiting, and that had to
+        # make one
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._free)
+
+    def warm(self, count=None):
+        """Fills the pool with up to count new games, max_size if count is
+        None, so the first matches don't have to make them."""
+        if count is None:
+            count = self.max_size
+        while len(self._free) < min(count, self.max_size):
+            self._free.append(Game(self.width))
+
+    def acquire(self):
+        """Returns a game as it is when new."""
+        if self._free:
+            self.hits += 1
+            return self._free.pop()
+        self.misses += 1
+        return Game(self.width)
+
+    def release(self, game):
+        """Takes back a game nothing will touch again."""
+        if len(self._free) < self.max_size:
+            game.reset()
+            self._free.append(game)
+
+    def resident_bytes(self):
+        """Returns about how much memory the games waiting take up."""
+        if not self._free:
+            return 0
+        # reset games of the same width are all the same size
+        return len(self._free) * object_size(self._free[0], set())
+
+def object_size(obj, seen):
+    """Returns the bytes taken by obj and everything it refers to that
+    hasn't been counted yet, leaving out the Grid lookup tables, which are
+    shared by every game of a width."""
+    if id(obj) in seen or isinstance(obj, (Grid, type)):
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += object_size(key, seen) + object_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += object_size(item, seen)
+    else:
+        if hasattr(obj, '__dict__'):
+            size += object_size(obj.__dict__, seen)
+        for name in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, name):
+                size += object_size(getattr(obj, name), seen)
+    return size
@@ -0,0 +1,213 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Sampling profiler for a running server.
+#
+# While on, a background thread looks at the main thread's stack every
+# interval seconds and counts how often each stack turns up. Nothing is
+# hooked into the code being profiled, so when it is off it costs nothing
+# at all, and when on it costs about one stack walk per sample.
+#
+# Samples are written in the folded format flame graph tools read (one
+# "outer;...;inner count" line per distinct stack), with frames named
+# module:function. GameSession._handle frames carry the message type being
+# handled, as server:_handle(move), so time splits by message type; a
+# summary of that and of the functions that took the most time is logged
+# when the profiler stops.
+#
+
+import os
+import sys
+import threading
+import time
+import traceback
+
+import log
+
+profile_log = log.get_logger('profiler')
+
+# (module, function) -> name of a local whose value is added to the frame
+LABELS = {
+    ('server', '_handle'): 'type',
+}
+
+class Sampler(object):
+    """Samples the stack of the thread with id thread_id every interval
+    seconds from a thread of its own, until stop() is called."""
+    def __init__(self, thread_id, interval=0.005, labels=LABELS):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.labels = labels
+        # (frame key, ...) from outermost in -> samples
+        self.counts = {}
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self._stopping = False
+        self._on_stop = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        # code object -> (name, label local or None)
+        self._names = {}
+
+    def start(self):
+        self.started = time.time()
+        self._thread.start()
+
+    def stop(self, on_stop=None):
+        """Stops sampling. on_stop(sampler) is then called from the
+        sampling thread."""
+        self._on_stop = on_stop
+        self._stopping = True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if self._stopping:
+                break
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self._sample(frame)
+            # let go of the stack before sleeping
+            frame = None
+
+        self.stopped = time.time()
+        if self._on_stop is not None:
+            try:
+                self._on_stop(self)
+            except:
+                profile_log.error('saving profile:\n%s',
+                                  traceback.format_exc())
+
+    def _sample(self, frame):
+        names = self._names
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            entry = names.get(code)
+            if entry is None:
+                module = os.path.splitext(
+                    os.path.basename(code.co_filename))[0]
+                entry = ('%s:%s' % (module, code.co_name),
+                         self.labels.get((module, code.co_name)))
+                names[code] = entry
+
+            name, local = entry
+            if local is not None:
+                # not there yet while the message is still being parsed
+                locals_ = frame.f_locals
+                if local in locals_:
+                    value = locals_[local]
+                    if not isinstance(value, basestring):
+                        value = 'invalid'
+                    name = '%s(%s)' % (name, value)
+            stack.append(name)
+            frame = frame.f_back
+
+        stack.reverse()
+        key = tuple(stack)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def write_folded(self, f):
+        for stack, count in sorted(self.counts.iteritems()):
+            f.write('%s %d\n' % (';'.join(stack), count))
+
+    def summary(self, top=10):
+        """Returns lines saying how the samples split by message type, and
+        which functions they were most often in, themselves or below."""
+        by_type = {}
+        inclusive = {}
+        exclusive = {}
+        for stack, count in self.counts.iteritems():
+            for name in set(stack):
+                inclusive[name] = inclusive.get(name, 0) + count
+                if name.startswith('server:_handle('):
+                    message_type = name[len('server:_handle('):-1]
+                    by_type[message_type] = (by_type.get(message_type, 0) +
+                                             count)
+            exclusive[stack[-1]] = exclusive.get(stack[-1], 0) + count
+
+        total = max(self.samples, 1)
+        lines = ['%d samples over %.1fs' % (
+            self.samples, (self.stopped or time.time()) - self.started)]
+        lines.append('by message type:')
+        for message_type, count in sorted(by_type.iteritems(),
+                                          key=lambda item: -item[1]):
+            lines.append('  %5.1f%%  %s' % (100.0 * count / total,
+                                            message_type))
+        for title, counts in (('including callees:', inclusive),
+                              ('by itself:', exclusive)):
+            lines.append(title)
+            for name, count in sorted(counts.iteritems(),
+                                      key=lambda item: -item[1])[:top]:
+                lines.append('  %5.1f%%  %s' % (100.0 * count / total, name))
+        return lines
+
+class Profiler(object):
+    """Turns sampling of the thread it was made on on and off. Each run is
+    saved to directory as ping-<pid>-<time>.folded when it stops."""
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.thread_id = threading.current_thread().ident
+        self.sampler = None
+
+    def running(self):
+        return self.sampler is not None
+
+    def start(self):
+        if self.sampler is not None:
+            return
+        self.sampler = Sampler(self.thread_id, self.interval)
+        self.sampler.start()
+        profile_log.info('profiling every %gs', self.interval)
+
+    def stop(self):
+        if self.sampler is None:
+            return
+        sampler = self.sampler
+        self.sampler = None
+        sampler.stop(self._save)
+
+    def toggle(self):
+        if self.running():
+            self.stop()
+        else:
+            self.start()
+
+    def _save(self, sampler):
+        path = os.path.join(self.directory, 'ping-%d-%s.folded' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S',
+                                       time.localtime(sampler.started))))
+        with open(path, 'w') as f:
+            sampler.write_folded(f)
+        profile_log.info('wrote %s\n%s', path, '\n'.join(sampler.summary()))
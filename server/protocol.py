@@ -0,0 +1,495 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import struct
+
+try:
+    import ujson as json
+except:
+    import json
+
+#
+# Wire formats for client messages.
+#
+# MESSAGES lists every message type with the fields it carries, and both
+# codecs work from it. A client picks one in its "join" message (which is
+# always JSON text):
+#
+#   json    every message is a JSON text frame, as described in
+#           server.GameClient
+#   binary  every message is a binary frame: a one byte message id followed
+#           by its fields in order, packed in network byte order as below
+#
+# Clients on the binary protocol may still send JSON text frames.
+#
+# Messages whose fields are mostly the same every time can be sent from a
+# template, which encodes those fields once and only encodes the rest per
+# message.
+#
+# Field kinds in the binary format:
+#
+#   u8/u16/u32      unsigned integers
+#   bool            one byte, 0 or 1
+#   enum            one byte, index into the kind's list of strings
+#   str             u16 byte length, then UTF-8
+#   point           x and y as one byte each
+#   maybe point     one byte: 0 if the key is absent, 1 if it is null,
+#                   2 if a point follows
+#   points          one byte: 0 if a u16 count of points follows, 1 if a
+#                   bitmap of width * width bits follows, bit y * width + x
+#                   set for each point, low bit of each byte first; whichever
+#                   is shorter is sent
+#   shapes          u8 count of shapes, then a u8 count of points and the
+#                   points of each
+#   struct          its fields in order
+#   one of          one byte picking which of the named fields follows
+#   actions         u8 count of messages, then each one as its message id
+#                   and fields, as if it were sent on its own
+#
+
+class Kind(object):
+    """How one field is packed. Most kinds map a value to bytes; write and
+    read are on the whole message dict so kinds can handle absent keys."""
+    def write(self, out, msg, name):
+        out.append(self.pack(msg[name]))
+
+    def read(self, data, offset, msg, name):
+        msg[name], offset = self.unpack(data, offset)
+        return offset
+
+class Fixed(Kind):
+    def __init__(self, fmt):
+        self.struct = struct.Struct('!' + fmt)
+
+    def pack(self, value):
+        return self.struct.pack(value)
+
+    def unpack(self, data, offset):
+        return (self.struct.unpack_from(data, offset)[0],
+                offset + self.struct.size)
+
+class Bool(Fixed):
+    def __init__(self):
+        Fixed.__init__(self, 'B')
+
+    def unpack(self, data, offset):
+        value, offset = Fixed.unpack(self, data, offset)
+        return bool(value), offset
+
+class Enum(Fixed):
+    def __init__(self, *values):
+        Fixed.__init__(self, 'B')
+        self.values = values
+        self.indexes = dict((value, i) for i, value in enumerate(values))
+
+    def pack(self, value):
+        return Fixed.pack(self, self.indexes[value])
+
+    def unpack(self, data, offset):
+        index, offset = Fixed.unpack(self, data, offset)
+        return self.values[index], offset
+
+class Str(Kind):
+    LENGTH = struct.Struct('!H')
+
+    def pack(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return Str.LENGTH.pack(len(value)) + value
+
+    def unpack(self, data, offset):
+        length, = Str.LENGTH.unpack_from(data, offset)
+        start = offset + Str.LENGTH.size
+        if start + length > len(data):
+            raise ValueError('string past end of message')
+        return data[start:start + length].decode('utf-8'), start + length
+
+class Point(Kind):
+    STRUCT = struct.Struct('!BB')
+
+    def pack(self, value):
+        return Point.STRUCT.pack(value[0], value[1])
+
+    def unpack(self, data, offset):
+        x, y = Point.STRUCT.unpack_from(data, offset)
+        return [x, y], offset + Point.STRUCT.size
+
+class MaybePoint(Point):
+    ABSENT = '\x00'
+    NULL = '\x01'
+    PRESENT = '\x02'
+
+    def write(self, out, msg, name):
+        if name not in msg:
+            out.append(MaybePoint.ABSENT)
+        elif msg[name] is None:
+            out.append(MaybePoint.NULL)
+        else:
+            out.append(MaybePoint.PRESENT)
+            out.append(self.pack(msg[name]))
+
+    def read(self, data, offset, msg, name):
+        tag = data[offset]
+        offset += 1
+        if tag == MaybePoint.NULL:
+            msg[name] = None
+        elif tag == MaybePoint.PRESENT:
+            msg[name], offset = self.unpack(data, offset)
+        elif tag != MaybePoint.ABSENT:
+            raise ValueError('bad point tag')
+        return offset
+
+class Points(Kind):
+    LIST = '\x00'
+    BITMAP = '\x01'
+    COUNT = struct.Struct('!H')
+
+    def __init__(self, width):
+        self.width = width
+        self.bitmap_size = (width * width + 7) // 8
+
+    def pack(self, value):
+        if 2 * len(value) <= self.bitmap_size:
+            packed = [Points.LIST, Points.COUNT.pack(len(value))]
+            packed.extend(Point.STRUCT.pack(x, y) for x, y in value)
+            return ''.join(packed)
+
+        bits = 0
+        width = self.width
+        for x, y in value:
+            bits |= 1 << (y * width + x)
+        packed = bytearray(self.bitmap_size)
+        for i in xrange(self.bitmap_size):
+            packed[i] = (bits >> (i * 8)) & 0xff
+        return Points.BITMAP + str(packed)
+
+    def unpack(self, data, offset):
+        tag = data[offset]
+        offset += 1
+        if tag == Points.LIST:
+            count, = Points.COUNT.unpack_from(data, offset)
+            offset += Points.COUNT.size
+            end = offset + count * Point.STRUCT.size
+            if end > len(data):
+                raise ValueError('points past end of message')
+            packed = bytearray(data[offset:end])
+            return ([[packed[i], packed[i + 1]]
+                     for i in xrange(0, len(packed), 2)], end)
+        elif tag == Points.BITMAP:
+            end = offset + self.bitmap_size
+            if end > len(data):
+                raise ValueError('bitmap past end of message')
+            width = self.width
+            points = []
+            for i, byte in enumerate(bytearray(data[offset:end])):
+                while byte:
+                    low = byte & -byte
+                    pos = i * 8 + low.bit_length() - 1
+                    points.append([pos % width, pos // width])
+                    byte ^= low
+            return points, end
+        raise ValueError('bad points tag')
+
+class Shapes(Kind):
+    COUNT = struct.Struct('!B')
+
+    def pack(self, value):
+        packed = [Shapes.COUNT.pack(len(value))]
+        for points in value:
+            packed.append(Shapes.COUNT.pack(len(points)))
+            packed.extend(Point.STRUCT.pack(x, y) for x, y in points)
+        return ''.join(packed)
+
+    def unpack(self, data, offset):
+        count, = Shapes.COUNT.unpack_from(data, offset)
+        offset += Shapes.COUNT.size
+        shapes = []
+        for i in xrange(count):
+            num_points, = Shapes.COUNT.unpack_from(data, offset)
+            offset += Shapes.COUNT.size
+            points = []
+            for j in xrange(num_points):
+                x, y = Point.STRUCT.unpack_from(data, offset)
+                offset += Point.STRUCT.size
+                points.append([x, y])
+            shapes.append(points)
+        return shapes, offset
+
+class Struct(Kind):
+    def __init__(self, *fields):
+        self.fields = fields
+
+    def pack(self, value):
+        out = []
+        for name, kind in self.fields:
+            kind.write(out, value, name)
+        return ''.join(out)
+
+    def unpack(self, data, offset):
+        value = {}
+        for name, kind in self.fields:
+            offset = kind.read(data, offset, value, name)
+        return value, offset
+
+class OneOf(Kind):
+    """Exactly one of several keys is in the message. Used with a name of
+    None, since it reads and writes the keys itself."""
+    def __init__(self, *fields):
+        self.fields = fields
+
+    def write(self, out, msg, name):
+        for i, (key, kind) in enumerate(self.fields):
+            if key in msg:
+                out.append(chr(i))
+                kind.write(out, msg, key)
+                return
+        raise KeyError(self.fields[0][0])
+
+    def read(self, data, offset, msg, name):
+        key, kind = self.fields[ord(data[offset])]
+        return kind.read(data, offset + 1, msg, key)
+
+class Actions(Kind):
+    """A list of messages, each packed as it would be on its own."""
+    COUNT = struct.Struct('!B')
+
+    def __init__(self, messages):
+        self.by_type = {}
+        self.by_id = {}
+        for type, id, fields in messages:
+            self.by_type[type] = (chr(id), fields)
+            self.by_id[chr(id)] = (type, fields)
+
+    def pack(self, value):
+        packed = [Actions.COUNT.pack(len(value))]
+        for action in value:
+            id, fields = self.by_type[action['type']]
+            packed.append(id)
+            for name, kind in fields:
+                kind.write(packed, action, name)
+        return ''.join(packed)
+
+    def unpack(self, data, offset):
+        count, = Actions.COUNT.unpack_from(data, offset)
+        offset += Actions.COUNT.size
+        actions = []
+        for i in xrange(count):
+            type, fields = self.by_id[data[offset]]
+            action = {'type': type}
+            offset += 1
+            for name, kind in fields:
+                offset = kind.read(data, offset, action, name)
+            actions.append(action)
+        return actions, offset
+
+def message_schema(width):
+    """Returns [(type, id, fields)] for boards of the given width."""
+    u8 = Fixed('B')
+    u32 = Fixed('I')
+    color = Enum('white', 'black')
+    direction = Enum('N', 'S', 'E', 'W')
+    points = Points(width)
+    blocks = Struct(('white_block', points), ('black_block', points))
+    board = OneOf(
+        ('board', Struct(
+            ('white_player', MaybePoint()),
+            ('black_player', MaybePoint()),
+            ('white_block', points),
+            ('black_block', points)
+        )),
+        ('board_delta', Struct(
+            ('base_version', u32),
+            ('added', blocks),
+            ('removed', blocks),
+            ('white_player', MaybePoint()),
+            ('black_player', MaybePoint())
+        ))
+    )
+
+    # from clients: what a player can do on their turn, alone or in a batch
+    actions = [
+        ('move', 1, [('direction', direction)]),
+        ('shoot', 2, [('direction', direction)]),
+        ('place', 3, [('shape_index', u8), ('origin', Point())]),
+        ('ping', 4, []),
+    ]
+
+    return actions + [
+        ('resync', 5, []),
+        ('ack', 6, [('version', u32)]),
+        ('batch', 7, [('actions', Actions(actions))]),
+
+        # to clients
+        ('joined', 64, [('board_width', u8), ('moves_per_turn', u8)]),
+        ('start', 65, [
+            ('turn', color),
+            ('turn_number', u32),
+            ('moves_remaining', u8),
+            ('your_color', color),
+            ('opponent', Str()),
+            ('resume_token', Str()),
+            ('version', u32),
+            ('shapes', Shapes()),
+            ('placement_zone', Struct(
+                ('upperleft', Point()),
+                ('width', u8),
+                ('height', u8)
+            )),
+            (None, board)
+        ]),
+        ('update', 66, [
+            ('turn', color),
+            ('turn_number', u32),
+            ('moves_remaining', u8),
+            ('ping_saw_opponent', Bool()),
+            ('version', u32),
+            (None, board)
+        ]),
+        ('end', 67, [('result', Enum('win', 'loss')), ('reason', Str())]),
+        ('watching', 68, [
+            ('white', Str()),
+            ('black', Str()),
+            ('view', Enum('master', 'white', 'black'))
+        ]),
+    ]
+
+class JsonTemplate(object):
+    def __init__(self, static):
+        assert 'type' in static
+        # the encoded object without its closing brace
+        self.prefix = json.dumps(static)[:-1]
+        self.constant = self.prefix + '}'
+
+    def render(self, fields):
+        if not fields:
+            return self.constant, True
+        return self.prefix + ',' + json.dumps(fields)[1:], True
+
+class BinaryTemplate(object):
+    def __init__(self, id, fields, static):
+        # runs of static fields encoded ahead of time, and (name, kind) for
+        # the fields in between
+        self.parts = []
+        out = [id]
+        for name, kind in fields:
+            if name is not None and name in static:
+                kind.write(out, static, name)
+            else:
+                if out:
+                    self.parts.append(''.join(out))
+                    out = []
+                self.parts.append((name, kind))
+        if out:
+            self.parts.append(''.join(out))
+
+    def render(self, fields):
+        out = []
+        for part in self.parts:
+            if part.__class__ is str:
+                out.append(part)
+            else:
+                part[1].write(out, fields, part[0])
+        return ''.join(out), False
+
+class JsonCodec(object):
+    name = 'json'
+
+    def encode(self, msg):
+        """Returns (data, is_text) to send."""
+        return json.dumps(msg), True
+
+    def template(self, static):
+        """Returns a template for messages that all have the fields in
+        static (including "type"). Its render(fields) returns (data,
+        is_text) for the message with the rest of the fields."""
+        return JsonTemplate(static)
+
+    def decode(self, data, is_text):
+        """Returns (type, message dict), or (None, None) if data isn't a
+        valid message."""
+        if not is_text:
+            return (None, None)
+
+        try:
+            msg = json.loads(data)
+        except ValueError:
+            return (None, None)
+
+        try:
+            type = msg['type']
+        except (KeyError, TypeError):
+            return (None, None)
+
+        return type, msg
+
+class BinaryCodec(object):
+    name = 'binary'
+
+    def __init__(self, schema):
+        self.json = JsonCodec()
+        self.by_type = {}
+        self.by_id = {}
+        for type, id, fields in schema:
+            self.by_type[type] = (chr(id), fields)
+            self.by_id[chr(id)] = (type, fields)
+
+    def encode(self, msg):
+        id, fields = self.by_type[msg['type']]
+        out = [id]
+        for name, kind in fields:
+            kind.write(out, msg, name)
+        return ''.join(out), False
+
+    def template(self, static):
+        id, fields = self.by_type[static['type']]
+        return BinaryTemplate(id, fields, static)
+
+    def decode(self, data, is_text):
+        if is_text:
+            return self.json.decode(data, is_text)
+
+        try:
+            type, fields = self.by_id[data[0]]
+            msg = {'type': type}
+            offset = 1
+            for name, kind in fields:
+                offset = kind.read(data, offset, msg, name)
+        except (KeyError, IndexError, ValueError, struct.error):
+            return (None, None)
+
+        if offset != len(data):
+            return (None, None)
+        return type, msg
+
+def make_codecs(width):
+    """Returns {protocol name: codec} for boards of the given width."""
+    return {
+        JsonCodec.name: JsonCodec(),
+        BinaryCodec.name: BinaryCodec(message_schema(width))
+    }
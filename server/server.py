@@ -27,25 +27,164 @@ ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 POSSIBILITY OF SUCH DAMAGE.
 """
 
-import heelhook
-from heelhook import Server, ServerConn, CloseCode, LogLevel
-from game import PlayerType, Game, Location
-import sys
+from game import PlayerType, Game, Board, Location
+from cluster import BrokerLink, Supervisor
+from matchmaking import MatchQueue
+from protocol import make_codecs
+from pool import GamePool
+from timers import TimingWheel
+from transport import CloseCode
+from collections import deque
+from itertools import count
+import journal
+import log
+import metrics
+import os
+import profiler
+import signal
+import static
+import threading
+import time
 import traceback
+import transport
 
 try:
     import ujson as json
 except:
     import json
 
-heelhook.set_opts(loglevel=LogLevel.DEBUG_3, log_to_stdout=True)
-
-class GameClient(ServerConn):
+conn_log = log.get_logger('conn')
+received_log = conn_log.sampled(per_second=20)
+match_log = log.get_logger('match')
+session_log = log.get_logger('session')
+
+ACTION_TYPES = ('move', 'place', 'shoot', 'ping', 'resync', 'batch')
+action_seconds = metrics.REGISTRY.histogram(
+    'ping_action_seconds', 'Time taken to handle a game message.', ('type',))
+actions = metrics.REGISTRY.counter(
+    'ping_actions_total',
+    'Game messages handled, by whether the game accepted them.',
+    ('type', 'result'))
+update_seconds = metrics.REGISTRY.histogram(
+    'ping_send_update_seconds',
+    'Time taken to build, encode and send an update to both players.')
+loop_lag_seconds = metrics.REGISTRY.histogram(
+    'ping_loop_lag_seconds',
+    'How late a timer thread wakes up while callbacks hold the interpreter.')
+sent_bytes = metrics.REGISTRY.counter(
+    'ping_sent_bytes_total', 'Bytes of messages sent to clients.')
+connections = metrics.REGISTRY.gauge(
+    'ping_connections', 'Open client connections.')
+spectators_coalesced = metrics.REGISTRY.counter(
+    'ping_spectators_coalesced_total',
+    'Times a spectator that fell behind skipped ahead to a full board.')
+
+class Protocol(object):
+    """A codec, plus the messages that are the same, or mostly the same,
+    for every client encoded with it ahead of time."""
+    SHAPES = [[[point.x, point.y] for point in shape.points]
+              for shape in Game.SHAPES]
+
+    def __init__(self, codec):
+        self.name = codec.name
+        self.codec = codec
+        self.joined = codec.encode({
+            'type': 'joined',
+            'board_width': Game.BOARD_WIDTH,
+            'moves_per_turn': Game.MOVES_PER_TURN
+        })
+        self.start = codec.template({'type': 'start',
+                                     'shapes': Protocol.SHAPES})
+        self._ends = {}
+
+    def encode(self, json_dict):
+        return self.codec.encode(json_dict)
+
+    def decode(self, msg, is_text):
+        return self.codec.decode(msg, is_text)
+
+    def end(self, result, reason):
+        try:
+            return self._ends[(result, reason)]
+        except KeyError:
+            encoded = self.codec.encode({'type': 'end', 'result': result,
+                                         'reason': reason})
+            self._ends[(result, reason)] = encoded
+            return encoded
+
+PROTOCOLS = dict((name, Protocol(codec))
+                 for name, codec in make_codecs(Game.BOARD_WIDTH).iteritems())
+
+def new_token():
+    return os.urandom(16).encode('hex')
+
+def send_opponent_left(player):
+    player.send_encoded(player.protocol.end('win', 'opponent disconnect'))
+    player.send_close(CloseCode.NORMAL, reason='game over')
+
+def locked(method):
+    """Runs a connection callback holding the server lock, which broker
+    messages are also handled under, after any timers that are due."""
+    def wrapper(self, *args, **kwargs):
+        with self.server.lock:
+            self.server.poll_timers()
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class GameClient(object):
     """Messages received from clients:
 
     {
         "type": "join",
-        "name": "<player name>"
+        "name": "<player name>",
+        "bucket": <str>,
+        "protocol": "<json|binary>"
+    }
+
+    "bucket" is optional. Players are matched with others in the same bucket
+    (e.g. a region or skill band) unless one has waited too long, in which
+    case they take anyone.
+
+    "protocol" is optional and picks the format of every later message:
+    "json" (the default) for the JSON text frames described here, or
+    "binary" for the packed binary frames described in protocol.py, which
+    carry the same messages and fields. "join" itself is always JSON.
+
+    {
+        "type": "resume",
+        "token": "<resume_token>",
+        "version": <int>,
+        "protocol": "<json|binary>"
+    }
+
+    Sent instead of "join" by a client whose connection dropped during a
+    game, with the resume_token from its "start" and the board version it
+    last got. If its seat is still held it is back in the game: it gets an
+    "update" with a delta from that version, or a "start" with the whole
+    board if it has some other version. "protocol" should be the one it
+    joined with. Like "join", "resume" is always JSON.
+
+    {
+        "type": "watch",
+        "player": "<player name>",
+        "view": "<master|white|black>",
+        "delay": <seconds>,
+        "protocol": "<json|binary>"
+    }
+
+    Also sent instead of "join", always as JSON, to spectate the game
+    player is in, or the game that started last if player is left out.
+    "view" is the true board ("master", the default) or what one player
+    can see. The game is shown "delay" seconds (default 0) behind. A
+    spectator gets "joined", then "watching", then "update"s and finally
+    "end", with the result for white, or for the player whose view it has.
+    It must send "ack" with the version of each update it gets; one that
+    falls too far behind skips the updates it missed and gets a full board.
+    Spectators only see games running on the process they connect to.
+
+    {
+        "type": "ack",
+        "version": <int>
     }
 
     {
@@ -68,6 +207,24 @@ class GameClient(ServerConn):
         "type": "ping"
     }
 
+    {
+        "type": "resync"
+    }
+
+    A client that receives a "board_delta" whose base_version is not the
+    version it holds sends "resync" and gets a full board back. This may be
+    sent at any time and does not use up a move.
+
+    {
+        "type": "batch",
+        "actions": [<move, place, shoot or ping message>, ...]
+    }
+
+    Runs several actions of one turn as one message, in order, and answers
+    with a single "update" once they are done. It stops at the first action
+    the game rejects, or that ends the game; the ones before it still count.
+    A batch may not hold more actions than the moves remaining this turn.
+
     Messages sent to clients:
 
     {
@@ -83,6 +240,8 @@ class GameClient(ServerConn):
         "moves_remaining": <int>,
         "your_color": "<white|black>",
         "opponent": <str>,
+        "resume_token": <str>,
+        "version": <int>,
         "shapes": [
             [[x, y], [x, y], ...],
             [[x, y], [x, y], ...],
@@ -105,7 +264,8 @@ class GameClient(ServerConn):
         "turn": <white|black>,
         "turn_number": <int>,
         "moves_remaining": <int>,
-        "ping_saw_opponent": <bool>
+        "ping_saw_opponent": <bool>,
+        "version": <int>,
         "board": {
             "white_player": [x, y],
             "black_player": [x, y],
@@ -114,10 +274,28 @@ class GameClient(ServerConn):
         }
     }
 
+    An update carries either a full "board" or, when it is smaller, a
+    "board_delta" against the version the client already has. Player keys
+    are only present in a delta if that player moved; null means the
+    player is no longer visible:
+
     {
-        "type": "end",
-        "result": "<win|loss>",
-        "reason": <str>
+        "type": "update",
+        ...
+        "version": <int>,
+        "board_delta": {
+            "base_version": <int>,
+            "added": {
+                "white_block" : [[x, y], [x, y], ...],
+                "black_block" : [[x, y], [x, y], ...]
+            },
+            "removed": {
+                "white_block" : [[x, y], [x, y], ...],
+                "black_block" : [[x, y], [x, y], ...]
+            },
+            "white_player": [x, y] | null,
+            "black_player": [x, y] | null
+        }
     }
 
     {
@@ -126,39 +304,52 @@ class GameClient(ServerConn):
         "reason": <str>
     }
 
+    {
+        "type": "watching",
+        "white": <str>,
+        "black": <str>,
+        "view": "<master|white|black>"
+    }
+
     """
     STATE_JOINING = 0
     STATE_WAITING = 1
     STATE_PLAYING = 2
+    STATE_WATCHING = 3
 
+    @locked
     def on_connect(self):
         self.state = GameClient.STATE_JOINING
         self.name = ''
+        self.bucket = None
+        self.protocol = PROTOCOLS['json']
         self.session = None
-        print 'ON CONNECT'
+        self.spectator = None
+        self.idle_timer = None
+        if self.server.idle_timeout:
+            self.idle_timer = self.server.call_later(self.server.idle_timeout,
+                                                     self.on_idle)
+        connections.inc()
+        conn_log.debug('connected')
 
     def on_open(self):
-        print 'ON OPEN'
+        conn_log.debug('opened')
         #self.send(json.dumps({'hello': 'dummy data'}), is_text=True);
 
     def get_type_and_parse(self, msg, is_text):
-        if not is_text:
-            return (None, None)
+        return self.protocol.decode(msg, is_text)
 
-        try:
-            json_dict = json.loads(msg)
-        except ValueError:
-            return (None, None)
-
-        try:
-            type = json_dict['type']
-        except KeyError:
-            return (None, None)
+    def send_message(self, json_dict):
+        self.send_encoded(self.protocol.encode(json_dict))
 
-        return type, json_dict
+    def send_encoded(self, encoded):
+        msg, is_text = encoded
+        sent_bytes.inc(len(msg))
+        self.send(msg, is_text=is_text)
 
+    @locked
     def on_message(self, msg, is_text):
-        print 'RECEIVED:',msg
+        received_log.debug('received %r', msg)
 
         if self.state == GameClient.STATE_JOINING:
             type, json_dict = self.get_type_and_parse(msg, is_text)
@@ -166,6 +357,14 @@ class GameClient(ServerConn):
                 self.send_close(CloseCode.PROTOCOL, "invalid data")
                 return
 
+            if type == 'resume':
+                self.on_resume(json_dict)
+                return
+
+            if type == 'watch':
+                self.on_watch(json_dict)
+                return
+
             if type != 'join':
                 self.send_close(CloseCode.PROTOCOL, "invalid type")
                 return
@@ -175,117 +374,562 @@ class GameClient(ServerConn):
                 self.send_close(CloseCode.PROTOCOL, "expected name")
                 return
 
-            print self.name, 'JOINED, WAITING:', len(self.server.waiting_clients)
+            self.bucket = json_dict.get('bucket')
+            if self.bucket is not None:
+                self.bucket = str(self.bucket)
 
-            json_dict = {
-                'type': 'joined',
-                'board_width': Game.BOARD_WIDTH,
-                'moves_per_turn': Game.MOVES_PER_TURN
-            }
-            self.send(json.dumps(json_dict), is_text=True)
+            if not self.set_protocol(json_dict):
+                return
 
-            if len(self.server.waiting_clients) >= 1:
-                print 'PLAYING!!'
-                opponent = self.server.waiting_clients.pop(0)
+            match_log.info('%s joined, %d waiting', self.name,
+                           len(self.server.waiting_clients))
 
-                session = GameSession(white=opponent, black=self)
-                self.session = session
-                opponent.session = session
-                session.start()
+            self.send_encoded(self.protocol.joined)
 
-                self.state = GameClient.STATE_PLAYING
-                opponent.state = GameClient.STATE_PLAYING
-            else:
-                print 'WUT, WIATING'
-                self.server.waiting_clients.append(self)
-                self.state = GameClient.STATE_WAITING
+            self.state = GameClient.STATE_WAITING
+            self.server.join(self)
         elif self.state == GameClient.STATE_WAITING:
-            print 'WHAT:', msg
+            conn_log.info('%s sent a message while waiting', self.name)
             self.send_close(CloseCode.PROTOCOL, "already waiting")
         elif self.state == GameClient.STATE_PLAYING:
             self.session.handle(self, msg, is_text)
+        elif self.state == GameClient.STATE_WATCHING:
+            type, json_dict = self.get_type_and_parse(msg, is_text)
+            try:
+                if type != 'ack':
+                    raise ValueError()
+                self.spectator.ack(int(json_dict['version']))
+            except (KeyError, TypeError, ValueError):
+                self.send_close(CloseCode.PROTOCOL, "expected ack")
         else:
             assert False
 
-    def on_close(self, code, reason):
+    def set_protocol(self, json_dict):
         try:
-            self.server.waiting_clients.remove(self)
-        except ValueError:
-            pass
+            self.protocol = PROTOCOLS[json_dict.get('protocol', 'json')]
+        except (KeyError, TypeError):
+            self.send_close(CloseCode.PROTOCOL, "unknown protocol")
+            return False
+        return True
 
-        if self.session:
-            print "CLOSING SESSION:", self.session, self.session.game_over
-        else:
-            print "CLOSING (NO SESSION)"
+    def on_resume(self, json_dict):
+        try:
+            token = str(json_dict['token'])
+            version = int(json_dict.get('version', 0))
+        except (KeyError, TypeError, ValueError):
+            self.send_close(CloseCode.PROTOCOL, "expected token")
+            return
 
-        if self.session != None and not self.session.game_over:
-            self.session.game_over = True
-            if self.session.current_player == self:
-                print 'CURRENT PLAYER SELF'
-                other = self.session.next_player
-            else:
-                print 'CURRENT PLAYER OPPONENT'
-                other = self.session.current_player
+        if not self.set_protocol(json_dict):
+            return
+
+        self.state = GameClient.STATE_WAITING
+        self.server.resume(self, token, version)
+
+    def on_watch(self, json_dict):
+        view = json_dict.get('view', 'master')
+        if view not in Feed.VIEWS:
+            self.send_close(CloseCode.PROTOCOL, "unknown view")
+            return
+
+        try:
+            delay = float(json_dict.get('delay', 0))
+        except (TypeError, ValueError):
+            self.send_close(CloseCode.PROTOCOL, "invalid delay")
+            return
+
+        player = json_dict.get('player')
+        if player is not None:
+            player = str(player)
+
+        if not self.set_protocol(json_dict):
+            return
 
-            json_dict = {'type': 'end', 'result': 'win',
-                         'reason': 'opponent disconnect'}
-            other.send(json.dumps(json_dict), is_text=True)
-            other.send_close(CloseCode.NORMAL, reason='game over')
+        self.server.watch(self, player, view, delay)
+
+    def on_idle(self):
+        if self.state == GameClient.STATE_JOINING:
+            conn_log.info('closing a connection that never joined')
+            self.send_close(CloseCode.NORMAL, reason='idle')
+
+    @locked
+    def on_close(self, code, reason):
+        connections.dec()
+        self.server.leave(self)
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+
+        conn_log.debug('%s closed: %s %s', self.name, code, reason)
+        if self.spectator is not None:
+            self.server.unwatch(self.spectator)
+            self.spectator = None
+        if self.session != None:
+            if not self.server.park(self.session, self):
+                self.session.player_left(self)
 
         del self.session
+        self.server.check_drained()
+
+class RemotePlayer(object):
+    """Stands in, on the worker hosting a game, for a player connected to
+    another worker. Everything sent to it is relayed by the broker."""
+    def __init__(self, broker, session_id, name, protocol):
+        self.broker = broker
+        self.session_id = session_id
+        self.name = name
+        self.protocol = protocol
+
+    def get_type_and_parse(self, msg, is_text):
+        return self.protocol.decode(msg, is_text)
+
+    def send_message(self, json_dict):
+        self.send_encoded(self.protocol.encode(json_dict))
+
+    def send_encoded(self, encoded):
+        msg, is_text = encoded
+        self.send(msg, is_text)
+
+    def send(self, msg, is_text):
+        self.broker.send({'op': 'send', 'session': self.session_id,
+                          'is_text': is_text}, msg)
+
+    def send_close(self, code, reason=''):
+        self.broker.send({'op': 'close', 'session': self.session_id,
+                          'code': code, 'reason': reason})
+
+class ParkedPlayer(object):
+    """Holds the seat of a player whose connection dropped, until they
+    resume or timer fires. Updates aren't sent to it, so the player's
+    view stays at the version they last got. The only thing that is, the
+    end of the game, is kept to pass on if they come back."""
+    __slots__ = ('name', 'protocol', 'token', 'session', 'timer',
+                 'last_sent')
+
+    def __init__(self, name, protocol, token, session):
+        self.name = name
+        self.protocol = protocol
+        self.token = token
+        self.session = session
+        self.timer = None
+        self.last_sent = None
+
+    def send_message(self, json_dict):
+        self.send_encoded(self.protocol.encode(json_dict))
+
+    def send_encoded(self, encoded):
+        self.last_sent = encoded
+
+    def send_close(self, code, reason=''):
+        pass
+
+class RemoteSession(object):
+    """Stands in for a GameSession hosted on another worker, relaying what
+    the local client sends to it."""
+    def __init__(self, server, session_id):
+        self.server = server
+        self.session_id = session_id
+        self.game_over = False
+
+    def handle(self, player, msg, is_text):
+        if self.game_over:
+            return
+
+        self.server.broker.send({'op': 'msg', 'session': self.session_id,
+                                 'is_text': is_text}, msg)
+
+    def player_left(self, player):
+        self.game_over = True
+        self.server.attached.pop(self.session_id, None)
+        self.server.broker.send({'op': 'closed', 'session': self.session_id})
+
+    def opponent_left(self, player):
+        if not self.game_over:
+            self.game_over = True
+            send_opponent_left(player)
+
+class PlayerView(object):
+    """Versioned view of one player's board, as last sent to that client.
+
+    Every board sent bumps the version. Updates are encoded as a delta
+    against the last version sent (the connection delivers in order, so
+    that is the version the client holds) unless the delta would be larger
+    than a full snapshot. Only tiles the board reports as changed since the
+    last send are looked at.
+    """
+    BLOCK_KEYS = (
+        ('white_block', Board.TILE_BLOCK_WHITE),
+        ('black_block', Board.TILE_BLOCK_BLACK)
+    )
+    PLAYER_KEYS = (
+        ('white_player', PlayerType.WHITE),
+        ('black_player', PlayerType.BLACK)
+    )
+
+    def __init__(self, board):
+        self.board = board
+        self.version = 0
+        self._checkpoint = None
+        self._sent_blocks = None
+        self._sent_players = None
+
+    def snapshot(self):
+        board_json = self.board.for_json()
+        self._checkpoint = self.board.checkpoint()
+        self._sent_blocks = dict(
+            (key, set(self.board.blocks(tile)))
+            for key, tile in PlayerView.BLOCK_KEYS
+        )
+        self._sent_players = dict(
+            (key, board_json.get(key)) for key, _ in PlayerView.PLAYER_KEYS
+        )
+        self.version += 1
+        return {'version': self.version, 'board': board_json}
+
+    def update(self):
+        if self._checkpoint is None:
+            return self.snapshot()
+
+        changed = self.board.changes_since(self._checkpoint)
+        if changed is None:
+            return self.snapshot()
+
+        coords = self.board.grid.coords
+        added = {}
+        removed = {}
+        delta_size = 0
+        snapshot_size = 0
+        for key, tile in PlayerView.BLOCK_KEYS:
+            blocks = self.board.blocks(tile)
+            sent = self._sent_blocks[key]
+            added[key] = []
+            removed[key] = []
+            for pos in changed:
+                if pos in blocks:
+                    if pos not in sent:
+                        added[key].append(coords[pos])
+                        sent.add(pos)
+                elif pos in sent:
+                    removed[key].append(coords[pos])
+                    sent.remove(pos)
+            delta_size += len(added[key]) + len(removed[key])
+            snapshot_size += len(blocks)
+
+        moved = {}
+        for key, player_type in PlayerView.PLAYER_KEYS:
+            cur = self.board.player_for_json(player_type)
+            if cur is not None:
+                snapshot_size += 1
+            if cur != self._sent_players[key]:
+                moved[key] = cur
+                self._sent_players[key] = cur
+                delta_size += 1
+
+        if delta_size > snapshot_size:
+            return self.snapshot()
+
+        board_delta = {
+            'base_version': self.version,
+            'added': added,
+            'removed': removed
+        }
+        board_delta.update(moved)
+
+        self._checkpoint = self.board.checkpoint()
+        self.version += 1
+        return {'version': self.version, 'board_delta': board_delta}
+
+class FeedEntry(object):
+    __slots__ = ('seq', 'time', 'version', 'json_dict', 'keyframe', 'final',
+                 '_encoded')
+
+    def __init__(self, seq, time, json_dict, keyframe, final):
+        self.seq = seq
+        self.time = time
+        self.version = json_dict.get('version')
+        self.json_dict = json_dict
+        self.keyframe = keyframe
+        self.final = final
+        self._encoded = {}
+
+    def encoded(self, protocol):
+        try:
+            return self._encoded[protocol.name]
+        except KeyError:
+            encoded = protocol.encode(self.json_dict)
+            self._encoded[protocol.name] = encoded
+            return encoded
+
+class Spectator(object):
+    """A client watching a Feed of session, delay seconds behind."""
+    def __init__(self, client, session, feed, delay):
+        self.client = client
+        self.session = session
+        self.feed = feed
+        self.delay = delay
+        # next entry to look at, None until placed at a keyframe
+        self.next_seq = None
+        # the last entry sent was a keyframe, or a delta following one
+        self.synced = False
+        # versions sent and not yet acked
+        self.in_flight = deque()
+        self.done = False
+
+    def ack(self, version):
+        in_flight = self.in_flight
+        while in_flight and in_flight[0] <= version:
+            in_flight.popleft()
+        self.feed.pump_one(self, time.time())
+
+class Feed(object):
+    """One view of a game as sent to everyone watching it.
+
+    Each update is encoded once per protocol in use and the same bytes go
+    to every spectator. Updates are kept for MAX_DELAY seconds, with a
+    full board every KEYFRAME_EVERY of them that spectators start from.
+
+    A spectator gets at most WINDOW updates it hasn't acked. One that has
+    more than QUEUE_LIMIT due and not yet sent, or that the kept updates
+    have moved past, skips to the newest full board that is due instead.
+    The end of the game is always sent.
+    """
+    VIEWS = ('master', 'white', 'black')
+    MAX_DELAY = 120.0
+    KEYFRAME_EVERY = 16
+    WINDOW = 8
+    QUEUE_LIMIT = 32
+
+    def __init__(self, name, board, update_dict):
+        self.name = name
+        self.view = PlayerView(board)
+        self.history = deque()
+        self.keyframes = deque()
+        self.next_seq = 0
+        self.since_keyframe = 0
+        self.spectators = []
+        self.ended = False
+
+        update_dict.update(self.view.snapshot())
+        self._add(update_dict, keyframe=True)
+
+    def publish(self, update_dict):
+        keyframe = dict(update_dict)
+        update_dict.update(self.view.update())
+        self._add(update_dict)
+
+        self.since_keyframe += 1
+        if self.since_keyframe >= Feed.KEYFRAME_EVERY:
+            self.since_keyframe = 0
+            keyframe['version'] = self.view.version
+            keyframe['board'] = self.view.board.for_json()
+            self._add(keyframe, keyframe=True)
+
+        self.pump(time.time())
+
+    def end(self, result, reason):
+        self.ended = True
+        self._add({'type': 'end', 'result': result, 'reason': reason},
+                  final=True)
+        self.pump(time.time())
+
+    def _add(self, json_dict, keyframe=False, final=False):
+        now = time.time()
+        entry = FeedEntry(self.next_seq, now, json_dict, keyframe, final)
+        self.next_seq += 1
+        self.history.append(entry)
+        if keyframe:
+            self.keyframes.append(entry)
+
+        # keep the newest keyframe a spectator MAX_DELAY behind could
+        # start from, and everything after it
+        keyframes = self.keyframes
+        while (len(keyframes) > 1 and
+               keyframes[1].time <= now - Feed.MAX_DELAY):
+            keyframes.popleft()
+        while self.history[0].seq < keyframes[0].seq:
+            self.history.popleft()
+
+    def add(self, spectator):
+        self.spectators.append(spectator)
+        self.pump_one(spectator, time.time())
+
+    def remove(self, spectator):
+        self.spectators.remove(spectator)
+
+    def pump(self, now):
+        for spectator in list(self.spectators):
+            self.pump_one(spectator, now)
+
+    def pump_one(self, spectator, now):
+        """Sends spectator whatever is due that it has room for."""
+        if spectator.done:
+            return
+
+        history = self.history
+        base = history[0].seq
+        due = now - spectator.delay
+
+        if spectator.next_seq is not None:
+            lag = 0
+            if spectator.next_seq < base:
+                lag = Feed.QUEUE_LIMIT + 1
+            elif len(spectator.in_flight) < Feed.WINDOW:
+                for index in xrange(len(history) - 1,
+                                    spectator.next_seq - base - 1, -1):
+                    if history[index].time <= due:
+                        lag = index - (spectator.next_seq - base) + 1
+                        break
+            if lag > Feed.QUEUE_LIMIT:
+                spectators_coalesced.inc()
+                spectator.next_seq = None
+
+        if spectator.next_seq is None:
+            for keyframe in reversed(self.keyframes):
+                if keyframe.time <= due:
+                    spectator.next_seq = keyframe.seq
+                    spectator.synced = False
+                    break
+            else:
+                # nothing far enough back yet
+                return
+
+        client = spectator.client
+        while True:
+            index = spectator.next_seq - base
+            if index >= len(history):
+                break
+            entry = history[index]
+            if entry.time > due:
+                break
+
+            if entry.final:
+                spectator.done = True
+                client.send_encoded(entry.encoded(client.protocol))
+                client.send_close(CloseCode.NORMAL, reason='game over')
+                break
+
+            if len(spectator.in_flight) >= Feed.WINDOW:
+                last = history[-1]
+                if last.final and last.time <= due:
+                    # skip to the end, it's sent regardless
+                    spectator.next_seq = last.seq
+                    continue
+                break
+
+            spectator.next_seq += 1
+            if entry.keyframe == spectator.synced:
+                # in sync, deltas only, or waiting for a keyframe
+                continue
+
+            spectator.synced = True
+            spectator.in_flight.append(entry.version)
+            client.send_encoded(entry.encoded(client.protocol))
 
 class GameSession(object):
-    def __init__(self, white, black):
+    """One game between white and black. Given a journal.SessionJournal,
+    every action run on the game is recorded to it. Given a TimingWheel and
+    turn_timeout, a player who takes longer than turn_timeout seconds over
+    their turn loses."""
+    DIRECTIONS = {
+        'N': Game.DIRECTION_NORTH,
+        'S': Game.DIRECTION_SOUTH,
+        'E': Game.DIRECTION_EAST,
+        'W': Game.DIRECTION_WEST,
+    }
+
+    def __init__(self, white, black, game=None, journal=None, timers=None,
+                 turn_timeout=None):
         assert PlayerType.WHITE == 0 and PlayerType.BLACK == 1
 
+        if game is None:
+            game = Game()
+
         self.white = white
         self.black = black
-        self.game = Game()
+        self.game = game
+        self.journal = journal
+        self.views = [
+            PlayerView(self.game.get_board(PlayerType.WHITE)),
+            PlayerView(self.game.get_board(PlayerType.BLACK))
+        ]
         self.current_player = white
         self.next_player = black
         self.turn = 0
         self.game_over = False
         self.moves_remaining = Game.MOVES_PER_TURN
 
-    def start(self):
-        print 'STARTING!!!!'
+        # what each player resumes with, by player type
+        self.tokens = [new_token(), new_token()]
 
-        shapes = []
-        for shape in Game.SHAPES:
-            points = []
-            for point in shape.points:
-                points.append([point.x, point.y])
-            shapes.append(points)
+        self.started = time.time()
+        # spectator feeds, by view name
+        self.feeds = {}
 
-        json_dict = {
-            'type': 'start',
-            'turn': 'white',
-            'turn_number': self.turn,
-            'moves_remaining': self.moves_remaining,
-            'your_color': 'white',
-            'opponent': self.black.name,
-            'shapes': shapes,
-            'board': self.game.get_board(PlayerType.WHITE).for_json(),
-            'placement_zone': self.game.get_zone_for_json(PlayerType.WHITE)
-        }
-        self.white.send(json.dumps(json_dict), is_text=True)
+        self.timers = timers
+        self.turn_timeout = turn_timeout
+        self.turn_timer = None
 
+    def start(self):
+        session_log.info('starting %s vs %s', self.white.name, self.black.name)
+        self.send_start(PlayerType.WHITE)
+        self.send_start(PlayerType.BLACK)
+        if self.timers is not None and self.turn_timeout:
+            self.turn_timer = self.timers.schedule(self.turn_timeout,
+                                                   self.on_turn_timeout)
+
+    def send_start(self, player_type):
+        if player_type == PlayerType.WHITE:
+            player, opponent, color = self.white, self.black, 'white'
+        else:
+            player, opponent, color = self.black, self.white, 'black'
+
+        # shapes come from the template
         json_dict = {
-            'type': 'start',
-            'turn': 'white',
+            'turn': self._turn_name(),
             'turn_number': self.turn,
             'moves_remaining': self.moves_remaining,
-            'your_color': 'black',
-            'opponent': self.white.name,
-            'shapes': shapes,
-            'board': self.game.get_board(PlayerType.BLACK).for_json(),
-            'placement_zone': self.game.get_zone_for_json(PlayerType.BLACK)
+            'your_color': color,
+            'opponent': opponent.name,
+            'resume_token': self.tokens[player_type],
+            'placement_zone': self.game.get_zone_for_json(player_type)
         }
-        self.black.send(json.dumps(json_dict), is_text=True)
+        json_dict.update(self.views[player_type].snapshot())
+        player.send_encoded(player.protocol.start.render(json_dict))
+
+    def player_type(self, player):
+        if player == self.white:
+            return PlayerType.WHITE
+        else:
+            return PlayerType.BLACK
+
+    def replace_player(self, old, new):
+        """Puts new in the seat old had."""
+        if self.white == old:
+            self.white = new
+        else:
+            self.black = new
+
+        if self.current_player == old:
+            self.current_player = new
+        else:
+            self.next_player = new
+
+    def send_resume(self, player, version):
+        """Brings a player back into the game who last got version of
+        their board."""
+        player_type = self.player_type(player)
+        view = self.views[player_type]
+        if version != view.version:
+            self.send_start(player_type)
+            return
+
+        json_dict = self._update_dict(False)
+        json_dict.update(view.update())
+        player.send_message(json_dict)
 
     def send_end(self, winning_player, win_reason, lose_reason):
-        print 'SENDING END'
+        session_log.info('%s won: %s', winning_player.name, win_reason)
         self.game_over = True
+        self._on_end(winning_player, win_reason, lose_reason)
 
         if self.current_player == winning_player:
             result_current = 'win'
@@ -298,98 +942,191 @@ class GameSession(object):
             result_current = 'loss'
             reason_current = lose_reason
 
-        json_dict = {'type': 'end', 'result': result_current,
-                     'reason': reason_current}
-        self.current_player.send(json.dumps(json_dict), is_text=True)
+        self.current_player.send_encoded(
+            self.current_player.protocol.end(result_current, reason_current))
         self.current_player.send_close(CloseCode.NORMAL, reason='game over')
 
-        json_dict = {'type': 'end', 'result': result_next,
-                     'reason': reason_next}
-        self.next_player.send(json.dumps(json_dict), is_text=True)
+        self.next_player.send_encoded(
+            self.next_player.protocol.end(result_next, reason_next))
         self.next_player.send_close(CloseCode.NORMAL, reason='game over')
 
-    def send_update(self, ping_saw_opponent, exclusive=None):
-        player_type = self.turn % 2
-        if player_type == PlayerType.WHITE:
-            opponent_type = PlayerType.BLACK
-            name = 'white'
+    def _turn_name(self):
+        if self.turn % 2 == PlayerType.WHITE:
+            return 'white'
         else:
-            opponent_type = PlayerType.WHITE
-            name = 'black'
+            return 'black'
 
-        json_dict = {
+    def _update_dict(self, ping_saw_opponent):
+        return {
             'type': 'update',
-            'turn': name,
+            'turn': self._turn_name(),
             'turn_number': self.turn,
             'moves_remaining': self.moves_remaining,
             'ping_saw_opponent': ping_saw_opponent
         }
 
-        if not exclusive or exclusive == self.current_player:
-            json_dict['board'] = self.game.get_board(player_type).for_json()
-            self.current_player.send(json.dumps(json_dict), is_text=True)
+    def send_update(self, ping_saw_opponent, exclusive=None):
+        start = time.time()
+        player_type = self.turn % 2
+        if player_type == PlayerType.WHITE:
+            opponent_type = PlayerType.BLACK
+        else:
+            opponent_type = PlayerType.WHITE
+
+        # a parked player's view waits for them at the version they have
+        if ((not exclusive or exclusive == self.current_player) and
+                not isinstance(self.current_player, ParkedPlayer)):
+            json_dict = self._update_dict(ping_saw_opponent)
+            json_dict.update(self.views[player_type].update())
+            self.current_player.send_message(json_dict)
+
+        if ((not exclusive or exclusive == self.next_player) and
+                not isinstance(self.next_player, ParkedPlayer)):
+            json_dict = self._update_dict(ping_saw_opponent)
+            json_dict.update(self.views[opponent_type].update())
+            self.next_player.send_message(json_dict)
+
+        for feed in self.feeds.values():
+            feed.publish(self._update_dict(ping_saw_opponent))
 
-        if not exclusive or exclusive == self.next_player:
-            json_dict['board'] = self.game.get_board(opponent_type).for_json()
-            self.next_player.send(json.dumps(json_dict), is_text=True)
+        update_seconds.observe(time.time() - start)
+
+    def send_resync(self, player):
+        json_dict = self._update_dict(False)
+        json_dict.update(self.views[self.player_type(player)].snapshot())
+        player.send_message(json_dict)
+
+    def _on_end(self, winning_player, win_reason, lose_reason):
+        if self.turn_timer is not None:
+            self.turn_timer.cancel()
+
+        winner_type = self.player_type(winning_player)
+        if self.journal is not None:
+            self.journal.end(self.turn, winner_type, lose_reason)
+
+        for name, feed in self.feeds.items():
+            if name == 'black':
+                won = winner_type == PlayerType.BLACK
+            else:
+                won = winner_type == PlayerType.WHITE
+            if won:
+                feed.end('win', win_reason)
+            else:
+                feed.end('loss', lose_reason)
+
+    def watch(self, client, view, delay):
+        """Starts client spectating view of this game."""
+        feed = self.feeds.get(view)
+        if feed is None:
+            if view == 'master':
+                board = self.game.get_master_board()
+            elif view == 'white':
+                board = self.game.get_board(PlayerType.WHITE)
+            else:
+                board = self.game.get_board(PlayerType.BLACK)
+            feed = Feed(view, board, self._update_dict(False))
+            self.feeds[view] = feed
+
+        client.send_encoded(client.protocol.joined)
+        client.send_message({'type': 'watching', 'white': self.white.name,
+                             'black': self.black.name, 'view': view})
+
+        spectator = Spectator(client, self, feed,
+                              max(0.0, min(delay, Feed.MAX_DELAY)))
+        feed.add(spectator)
+        return spectator
+
+    def unwatch(self, spectator):
+        feed = spectator.feed
+        feed.remove(spectator)
+        if not feed.spectators and self.feeds.get(feed.name) is feed:
+            del self.feeds[feed.name]
+
+    def on_turn_timeout(self):
+        if self.game_over:
+            return
+
+        session_log.info('%s ran out of time', self.current_player.name)
+        self.send_end(self.next_player, 'opponent timed out', 'timed out')
+
+    def player_left(self, player):
+        if self.game_over:
+            return
+
+        self.game_over = True
+        if self.current_player == player:
+            other = self.next_player
+        else:
+            other = self.current_player
+        session_log.info('%s left, %s wins', player.name, other.name)
+        self._on_end(other, 'opponent disconnect', 'disconnected')
+
+        send_opponent_left(other)
 
     def handle(self, player, msg, is_text):
         if self.game_over:
             return
 
+        start = time.time()
+        type, result = self._handle(player, msg, is_text)
+        if type not in ACTION_TYPES:
+            type = 'invalid'
+        action_seconds.labels(type).observe(time.time() - start)
+        actions.labels(type, result).inc()
+
+    def _handle(self, player, msg, is_text):
+        """Returns the message type and what became of it: accepted,
+        rejected by the game, invalid or out_of_turn. A batch is accepted
+        only if every action in it was."""
+        type, json_dict = player.get_type_and_parse(msg, is_text)
+        if type == 'resync':
+            self.send_resync(player)
+            return type, 'accepted'
+
         if self.current_player != player:
             self.send_end(self.current_player, 'opponent disconnect',
                           'not your turn')
-            return
+            return type, 'out_of_turn'
 
-        type, json_dict = self.current_player.get_type_and_parse(msg, is_text)
         if not type:
             self.send_end(self.next_player, 'opponent disconnect',
                           'invalid data')
-            return
-
-        directions = {
-            'N': Game.DIRECTION_NORTH,
-            'S': Game.DIRECTION_SOUTH,
-            'E': Game.DIRECTION_EAST,
-            'W': Game.DIRECTION_WEST,
-        }
+            return type, 'invalid'
+
+        if type == 'batch':
+            actions = json_dict.get('actions')
+            if (not isinstance(actions, list) or not actions or
+                    len(actions) > self.moves_remaining):
+                self.send_end(self.next_player, 'opponent disconnect',
+                              'invalid data')
+                return type, 'invalid'
+        else:
+            actions = (json_dict,)
 
         player_type = self.turn % 2
 
-        res = True
-        silent_update = False
-        game_over = False
+        # actions run until one is rejected or ends the game; the turn can
+        # only pass on the last, since a batch fits in the moves remaining
+        applied = 0
         ping_saw_opponent = False
-        try:
-            if type == 'move':
-                dir = json_dict['direction']
-                res = self.game.move_player(player_type, directions[dir])
-            elif type == 'place':
-                shape_index = json_dict['shape_index']
-                shape = Game.SHAPES[shape_index]
-                x, y = json_dict['origin']
-                res = self.game.place_shape(Location(x, y), shape, player_type)
-            elif type == 'shoot':
-                dir = json_dict['direction']
-                game_over = self.game.shoot(player_type, directions[dir])
-                res = True
-            elif type == 'ping':
-                ping_saw_opponent = self.game.ping(player_type)
-                res = True
-            else:
-                raise ValueError("Invalid type: %s" % (type,))
-        except (KeyError, ValueError) as e:
-            #print "DEBUG TRACEBACK: ", traceback.format_exc()
-            self.send_end(self.next_player, 'opponent disconnect',
-                          'invalid data')
-            return
-
-        if game_over:
-            self.send_end(self.current_player, 'direct hit', 'destroyed')
-            return
-
-        if res:
+        for action in actions:
+            try:
+                res, game_over, saw = self._apply(player_type, action)
+            except (KeyError, TypeError, ValueError) as e:
+                #print "DEBUG TRACEBACK: ", traceback.format_exc()
+                self.send_end(self.next_player, 'opponent disconnect',
+                              'invalid data')
+                return type, 'invalid'
+
+            if game_over:
+                self.send_end(self.current_player, 'direct hit', 'destroyed')
+                return type, 'accepted'
+
+            if not res:
+                break
+
+            applied += 1
+            ping_saw_opponent = ping_saw_opponent or saw
             self.moves_remaining -= 1
             if self.moves_remaining == 0:
                 self.turn += 1
@@ -397,20 +1134,673 @@ class GameSession(object):
                 temp = self.current_player
                 self.current_player = self.next_player
                 self.next_player = temp
+                if self.turn_timer is not None:
+                    self.timers.restart(self.turn_timer, self.turn_timeout)
 
+        # one update for the whole message
+        if applied:
             self.send_update(ping_saw_opponent)
         else:
-            self.send_update(ping_saw_opponent, exclusive=self.current_player)
+            self.send_update(False, exclusive=self.current_player)
+
+        if res:
+            return type, 'accepted'
+        else:
+            return type, 'rejected'
+
+    def _apply(self, player_type, json_dict):
+        """Runs one move, place, shoot or ping on the game and journals it.
+        Returns (whether the game accepted it, whether it ended the game,
+        whether a ping saw the opponent). Raises KeyError, TypeError or
+        ValueError if it isn't a valid action."""
+        type = json_dict['type']
+        res = True
+        game_over = False
+        ping_saw_opponent = False
+        if type == 'move':
+            dir = GameSession.DIRECTIONS[json_dict['direction']]
+            res = self.game.move_player(player_type, dir)
+            action = (journal.MOVE, dir)
+        elif type == 'place':
+            shape_index = json_dict['shape_index']
+            # SHAPES[-1] would work, but can't be journaled
+            if not 0 <= shape_index < len(Game.SHAPES):
+                raise ValueError("Invalid shape index: %r" % (shape_index,))
+            shape = Game.SHAPES[shape_index]
+            x, y = json_dict['origin']
+            res = self.game.place_shape(Location(x, y), shape, player_type)
+            action = (journal.PLACE, shape_index, x, y)
+        elif type == 'shoot':
+            dir = GameSession.DIRECTIONS[json_dict['direction']]
+            game_over = self.game.shoot(player_type, dir)
+            action = (journal.SHOOT, dir)
+        elif type == 'ping':
+            ping_saw_opponent = self.game.ping(player_type)
+            action = (journal.PING,)
+        else:
+            raise ValueError("Invalid type: %s" % (type,))
+
+        if self.journal is not None:
+            self.journal.action(self.turn, player_type, res, *action)
+        return res, game_over, ping_saw_opponent
+
+class GameServer(object):
+    """Matches clients as they join and tracks the games they play.
+
+    On its own a server pairs the clients that join it. As one of several
+    workers under a Supervisor it hands joining clients to the broker
+    instead (see cluster.Broker), which may pair them with a client on
+    another worker; in that case one worker runs the GameSession with a
+    RemotePlayer and the other relays its client through a RemoteSession.
+
+    A player whose connection drops mid-game has their seat held by a
+    ParkedPlayer for resume_grace seconds, on the worker running the game.
+    A client resuming on another worker is relayed to it by the broker.
+    Broker messages are handled on a thread of their own, so running as a
+    worker needs a THREADSAFE transport.
+
+    Players get turn_timeout seconds for each turn, and connections that
+    haven't joined, resumed or started watching after idle_timeout seconds
+    are closed. Those deadlines and the others above run on one
+    TimingWheel, advanced on the transport's thread: every TIMER_INTERVAL
+    by a timer thread if the transport is THREADSAFE, otherwise before
+    each connection callback, so on a quiet server they go off late.
+
+    Games come from a pool.GamePool holding up to game_pool finished games,
+    made ahead of time, and go back to it once their session is over.
+
+    Given a profiler.Profiler, the broker's "profile" messages turn it on
+    and off.
+
+    GameServer and GameClient are mixins; make_classes() puts them on a
+    transport backend's Server and ServerConn.
+    """
+    TIMER_INTERVAL = 0.25
+
+    # whether the transport lets connections be sent to from any thread and
+    # has call_soon_threadsafe(); make_classes() sets it from the backend
+    THREADSAFE = False
 
-class GameServer(Server):
     def __init__(self, *args, **kwargs):
+        max_wait = kwargs.pop('max_wait', None)
+        self.journal = kwargs.pop('journal', None)
+        self.resume_grace = kwargs.pop('resume_grace', 0)
+        self.turn_timeout = kwargs.pop('turn_timeout', None)
+        self.idle_timeout = kwargs.pop('idle_timeout', None)
+        game_pool = kwargs.pop('game_pool', 0)
+        self.profiler = kwargs.pop('profiler', None)
         super(GameServer, self).__init__(*args, **kwargs)
-        self.waiting_clients = []
-        self.game_sessions = []
+        self.waiting_clients = MatchQueue(max_wait)
+        self.game_sessions = set()
+        self.lock = threading.RLock()
+        self.draining = False
+
+        # only used with a broker
+        self.broker = None
+        self.client_ids = count()
+        self.brokered_clients = {}
+        self.hosted = {}
+        self.attached = {}
+
+        # resume token -> ParkedPlayer
+        self.parked = {}
+        self.spectators = set()
+        self.timers = TimingWheel(GameServer.TIMER_INTERVAL)
+        self._timer_thread = None
+        self._timers_run = time.time()
+
+        # finished games, reset for the next ones to start
+        self.games = GamePool(game_pool)
+        self.games.warm()
+
+        metrics.REGISTRY.gauge(
+            'ping_spectators', 'Clients spectating games.',
+            fn=lambda: len(self.spectators))
+        metrics.REGISTRY.gauge(
+            'ping_parked_players', 'Seats held for players to resume.',
+            fn=lambda: len(self.parked))
+        metrics.REGISTRY.gauge(
+            'ping_waiting_clients', 'Clients waiting for an opponent.',
+            fn=lambda: len(self.waiting_clients) + len(self.brokered_clients))
+        metrics.REGISTRY.gauge(
+            'ping_active_sessions', 'Games in progress on this process.',
+            fn=lambda: len(self.game_sessions))
+        metrics.REGISTRY.gauge(
+            'ping_timers', 'Timers waiting to fire.',
+            fn=lambda: len(self.timers))
+        metrics.REGISTRY.counter(
+            'ping_game_pool_hits_total',
+            'Games started with a game from the pool.',
+            fn=lambda: self.games.hits)
+        metrics.REGISTRY.counter(
+            'ping_game_pool_misses_total',
+            'Games started with a new game, the pool being empty.',
+            fn=lambda: self.games.misses)
+        metrics.REGISTRY.gauge(
+            'ping_game_pool_games', 'Games in the pool.',
+            fn=lambda: len(self.games))
+        metrics.REGISTRY.gauge(
+            'ping_game_pool_bytes',
+            'Estimated memory held by the games in the pool.',
+            fn=lambda: self.games.resident_bytes())
+
+    def use_broker(self, sock):
+        self.broker = BrokerLink(sock, self.on_broker_message, self.lock)
+        self.broker.start()
+
+    def join(self, client):
+        if self.draining:
+            client.send_close(CloseCode.NORMAL, reason='server shutting down')
+            return
+
+        if self.broker is not None:
+            client.client_id = next(self.client_ids)
+            self.brokered_clients[client.client_id] = client
+            self.broker.send({'op': 'wait', 'client': client.client_id,
+                              'name': client.name, 'bucket': client.bucket,
+                              'protocol': client.protocol.name})
+            return
+
+        self.pair_overdue()
+
+        opponent = self.waiting_clients.join(client, client, client.bucket)
+        if opponent is not None:
+            self.start_session(white=opponent, black=client)
+        elif self.waiting_clients.max_wait is not None:
+            # from then on it can be paired with anyone
+            self.call_later(self.waiting_clients.max_wait, self.pair_overdue)
+
+    def pair_overdue(self):
+        if self.draining:
+            return
+
+        for white, black in self.waiting_clients.pop_overdue():
+            self.start_session(white=white, black=black)
+
+    def leave(self, client):
+        if self.broker is not None:
+            client_id = getattr(client, 'client_id', None)
+            if self.brokered_clients.pop(client_id, None) is not None:
+                self.broker.send({'op': 'cancel', 'client': client_id})
+            return
+
+        self.waiting_clients.cancel(client)
+
+    def park(self, session, player):
+        """Holds player's seat in session for them to resume. Returns
+        False if it can't be held."""
+        if (not self.resume_grace or session.game_over or
+                not isinstance(session, GameSession)):
+            return False
+
+        token = session.tokens[session.player_type(player)]
+        parked = ParkedPlayer(player.name, player.protocol, token, session)
+        parked.timer = self.call_later(self.resume_grace, self.expire_parked,
+                                       token)
+        session.replace_player(player, parked)
+        self.parked[token] = parked
+        if self.broker is not None:
+            self.broker.send({'op': 'park', 'token': token})
+
+        session_log.info('%s dropped out, holding their seat for %ds',
+                         player.name, self.resume_grace)
+        return True
+
+    def unpark(self, token):
+        parked = self.parked.pop(token, None)
+        if parked is not None:
+            parked.timer.cancel()
+            if self.broker is not None:
+                self.broker.send({'op': 'unpark', 'token': token})
+        return parked
+
+    def expire_parked(self, token):
+        parked = self.unpark(token)
+        if parked is not None and not parked.session.game_over:
+            session_log.info('%s did not come back', parked.name)
+            parked.session.player_left(parked)
+
+    def watch(self, client, player, view, delay):
+        sessions = [session for session in self.game_sessions
+                    if isinstance(session, GameSession) and
+                    not session.game_over and
+                    (player is None or
+                     player in (session.white.name, session.black.name))]
+        if not sessions:
+            client.send_close(CloseCode.NORMAL, reason='no such game')
+            return
+
+        session = max(sessions, key=lambda session: session.started)
+        client.spectator = session.watch(client, view, delay)
+        client.state = GameClient.STATE_WATCHING
+        self.spectators.add(client.spectator)
+        self._start_timers()
+
+    def unwatch(self, spectator):
+        self.spectators.discard(spectator)
+        spectator.session.unwatch(spectator)
+
+    def call_later(self, delay, callback, *args):
+        """Calls callback(*args), with the lock held, delay seconds from now.
+        Returns the timers.Timer."""
+        self._start_timers()
+        return self.timers.schedule(delay, callback, *args)
+
+    def _start_timers(self):
+        if self._timer_thread is None and self.THREADSAFE:
+            self._timer_thread = threading.Thread(target=self._run_timers)
+            self._timer_thread.daemon = True
+            self._timer_thread.start()
+
+    def _run_timers(self):
+        while True:
+            time.sleep(GameServer.TIMER_INTERVAL)
+            self.call_soon_threadsafe(self.run_timers)
+
+    def poll_timers(self):
+        """Runs the timers from a connection callback, if the transport
+        isn't THREADSAFE and they haven't run for TIMER_INTERVAL."""
+        if not self.THREADSAFE:
+            now = time.time()
+            if now >= self._timers_run + GameServer.TIMER_INTERVAL:
+                self.run_timers(now)
+
+    def run_timers(self, now=None):
+        """Fires the timers that are due and sends delayed spectators what
+        has come due. Called on the transport's thread."""
+        with self.lock:
+            if now is None:
+                now = time.time()
+            self._timers_run = now
+            self.timers.advance(now)
+            for spectator in list(self.spectators):
+                if spectator.delay:
+                    spectator.feed.pump_one(spectator, now)
+            self.check_drained()
+
+    def resume(self, client, token, version):
+        parked = self.unpark(token)
+        if parked is not None:
+            client.name = parked.name
+            session = self.take_seat(parked, client, version)
+            if session is not None:
+                client.session = session
+                client.state = GameClient.STATE_PLAYING
+            return
+
+        if self.broker is not None:
+            # the game may be running on another worker
+            client.client_id = next(self.client_ids)
+            self.brokered_clients[client.client_id] = client
+            self.broker.send({'op': 'resume', 'client': client.client_id,
+                              'token': token, 'version': version,
+                              'protocol': client.protocol.name})
+            return
+
+        client.send_close(CloseCode.NORMAL, reason='unknown token')
+
+    def take_seat(self, parked, player, version):
+        """Puts player in the seat parked held and catches them up.
+        Returns the session, or None if the game ended meanwhile."""
+        session = parked.session
+        if session.game_over:
+            if parked.last_sent is not None:
+                player.send_encoded(parked.last_sent)
+            player.send_close(CloseCode.NORMAL, reason='game over')
+            return None
+
+        session_log.info('%s resumed', parked.name)
+        session.replace_player(parked, player)
+        session.send_resume(player, version)
+        return session
+
+    def start_session(self, white, black):
+        session_journal = None
+        if self.journal is not None:
+            session_journal = self.journal.session(white.name, black.name)
+        session = GameSession(white=white, black=black,
+                              game=self.games.acquire(),
+                              journal=session_journal, timers=self.timers,
+                              turn_timeout=self.turn_timeout)
+        if self.turn_timeout:
+            self._start_timers()
+        for client in (white, black):
+            if isinstance(client, GameClient):
+                client.session = session
+        session.start()
+
+        for client in (white, black):
+            if isinstance(client, GameClient):
+                client.state = GameClient.STATE_PLAYING
+
+        self.game_sessions.add(session)
+        return session
+
+    def on_broker_message(self, header, payload):
+        op = header['op']
+        if op == 'match':
+            white = self.brokered_clients.pop(header['white'], None)
+            black = self.brokered_clients.pop(header['black'], None)
+            if white is not None and black is not None:
+                self.start_session(white=white, black=black)
+            elif white is not None or black is not None:
+                # the other one left before the broker heard about it
+                self.join(white or black)
+        elif op == 'host':
+            session_id = header['session']
+            client = self.brokered_clients.pop(header['client'], None)
+            if client is None:
+                self.broker.send({'op': 'closed', 'session': session_id})
+                return
+
+            remote = RemotePlayer(self.broker, session_id,
+                                  str(header['opponent']),
+                                  PROTOCOLS[header['opponent_protocol']])
+            if header['color'] == 'white':
+                session = self.start_session(white=client, black=remote)
+            else:
+                session = self.start_session(white=remote, black=client)
+            self.hosted[session_id] = (session, remote)
+        elif op == 'attach':
+            session_id = header['session']
+            client = self.brokered_clients.pop(header['client'], None)
+            if client is None:
+                self.broker.send({'op': 'closed', 'session': session_id})
+                return
+
+            session = RemoteSession(self, session_id)
+            client.session = session
+            client.state = GameClient.STATE_PLAYING
+            self.attached[session_id] = client
+            self.game_sessions.add(session)
+        elif op == 'msg':
+            entry = self.hosted.get(header['session'])
+            if entry is not None:
+                session, remote = entry
+                session.handle(remote, payload, header['is_text'])
+        elif op == 'send':
+            client = self.attached.get(header['session'])
+            if client is not None:
+                sent_bytes.inc(len(payload))
+                client.send(payload, is_text=header['is_text'])
+        elif op == 'close':
+            client = self.attached.get(header['session'])
+            if client is not None:
+                client.session.game_over = True
+                client.send_close(header['code'], reason=header['reason'])
+        elif op == 'closed':
+            self.remote_left(header['session'], park=True)
+        elif op == 'resume':
+            session_id = header['session']
+            remote = RemotePlayer(self.broker, session_id, '',
+                                  PROTOCOLS[header['protocol']])
+            parked = self.unpark(header['token'])
+            if parked is None:
+                remote.send_close(CloseCode.NORMAL, reason='unknown token')
+                return
+
+            remote.name = parked.name
+            session = self.take_seat(parked, remote, header['version'])
+            if session is not None:
+                self.hosted[session_id] = (session, remote)
+        elif op == 'resume_failed':
+            client = self.brokered_clients.pop(header['client'], None)
+            if client is not None:
+                client.send_close(CloseCode.NORMAL, reason='unknown token')
+        elif op == 'drain':
+            self.drain()
+        elif op == 'log_levels':
+            log.set_levels(header['spec'])
+        elif op == 'profile':
+            if self.profiler is not None:
+                if header['on']:
+                    self.profiler.start()
+                else:
+                    self.profiler.stop()
+        elif op == 'disconnected':
+            # without the broker nothing can be relayed
+            for session_id in self.hosted.keys() + self.attached.keys():
+                self.remote_left(session_id)
+            self.drain()
+
+        self.check_drained()
+
+    def remote_left(self, session_id, park=False):
+        if session_id in self.hosted:
+            session, remote = self.hosted.pop(session_id)
+            if not (park and self.park(session, remote)):
+                session.player_left(remote)
+        elif session_id in self.attached:
+            client = self.attached.pop(session_id)
+            client.session.opponent_left(client)
+
+    def drain(self):
+        """Stops taking new players and exits once the games in progress
+        are over."""
+        if self.draining:
+            return
+
+        match_log.info('draining')
+        self.draining = True
+        waiting = (self.waiting_clients.values() +
+                   self.brokered_clients.values())
+        for client in waiting:
+            client.send_close(CloseCode.NORMAL, reason='server shutting down')
+        self.check_drained()
+
+    def check_drained(self):
+        for session in [s for s in self.game_sessions if s.game_over]:
+            self.game_sessions.remove(session)
+            if isinstance(session, GameSession):
+                self.games.release(session.game)
+
+        if (self.draining and not self.game_sessions and
+                not self.waiting_clients and not self.brokered_clients and
+                not self.spectators):
+            if self.journal is not None:
+                self.journal.flush()
+            log.flush()
+            os._exit(0)
+
+_classes = {}
+
+def make_classes(backend):
+    """Returns (GameServer, GameClient) classes serving over backend, a
+    module from transport.load()."""
+    if backend not in _classes:
+        _classes[backend] = (
+            type('GameServer', (GameServer, backend.Server),
+                 {'THREADSAFE': backend.THREADSAFE}),
+            type('GameClient', (GameClient, backend.ServerConn), {}))
+    return _classes[backend]
 
 if __name__ == "__main__":
-    server = GameServer(port=int(sys.argv[1]), connection_class=GameClient,
-#                        heartbeat_interval_ms=30000, heartbeat_ttl_ms=5000,
-                       )
-    server.listen()
+    from optparse import OptionParser
+    usage = 'usage: server.py [options] port'
+    parser = OptionParser(usage)
+    parser.add_option("-w", "--workers", dest="workers", type="int",
+                      help="run this many worker processes on the port")
+    parser.add_option("--drain-timeout", dest="drain_timeout", type="float",
+                      default=300.0,
+                      help="seconds workers get to finish their games on "
+                           "shutdown")
+    parser.add_option("--max-wait", dest="max_wait", type="float",
+                      default=10.0,
+                      help="seconds a player waits for an opponent in their "
+                           "bucket before taking anyone")
+    parser.add_option("--resume-grace", dest="resume_grace", type="float",
+                      default=30.0,
+                      help="seconds a dropped player's seat is held for them "
+                           "to resume, 0 to end the game at once")
+    parser.add_option("--turn-timeout", dest="turn_timeout", type="float",
+                      default=60.0,
+                      help="seconds a player has for each turn before they "
+                           "lose, 0 for no limit")
+    parser.add_option("--idle-timeout", dest="idle_timeout", type="float",
+                      default=30.0,
+                      help="seconds a connection has to join, resume or "
+                           "watch before it is closed, 0 for no limit")
+    parser.add_option("--heartbeat-interval", dest="heartbeat_interval",
+                      type="float", default=30.0,
+                      help="seconds between WebSocket pings to quiet "
+                           "connections, 0 for none")
+    parser.add_option("--heartbeat-ttl", dest="heartbeat_ttl", type="float",
+                      default=5.0,
+                      help="seconds a connection has to answer a ping before "
+                           "it is dropped")
+    parser.add_option("--game-pool", dest="game_pool", type="int",
+                      default=64,
+                      help="finished games kept to reuse for new ones, "
+                           "made ahead of time at startup")
+    parser.add_option("--log-levels", dest="log_levels", default="info",
+                      help="log levels, e.g. info,session=debug")
+    parser.add_option("--log-levels-file", dest="log_levels_file",
+                      help="read log levels from this file at start and "
+                           "again on SIGHUP")
+    parser.add_option("--admin-port", dest="admin_port", type="int",
+                      help="serve Prometheus metrics on localhost at this "
+                           "port; workers use the ports after it")
+    parser.add_option("--journal-dir", dest="journal_dir",
+                      help="write a journal of every game to this directory")
+    parser.add_option("--static-dir", dest="static_dir",
+                      help="serve the files in this directory, e.g. the "
+                           "client, over HTTP")
+    parser.add_option("--static-port", dest="static_port", type="int",
+                      help="serve --static-dir on this port rather than the "
+                           "game's, which only the asyncio transport can do")
+    parser.add_option("--static-max-age", dest="static_max_age", type="int",
+                      default=86400,
+                      help="seconds browsers may cache static files other "
+                           "than HTML pages without asking again")
+    parser.add_option("--profile-dir", dest="profile_dir", default=".",
+                      help="directory for the folded stacks written each "
+                           "time SIGUSR2 turns profiling off (default .)")
+    parser.add_option("--profile-interval", dest="profile_interval",
+                      type="float", default=0.005,
+                      help="seconds between profiler samples")
+    parser.add_option("--transport", dest="transport", default="heelhook",
+                      choices=sorted(transport.BACKENDS),
+                      help="WebSocket server to use: %s (default heelhook)" %
+                           (', '.join(sorted(transport.BACKENDS)),))
+    parser.add_option("--heelhook-log-level", dest="heelhook_log_level",
+                      default="ERROR",
+                      help="heelhook LogLevel name for its own logging")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected a port')
+    port = int(args[0])
+
+    try:
+        log.set_levels(options.log_levels)
+        if options.log_levels_file:
+            log.load_levels(options.log_levels_file)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+
+    if options.journal_dir and not os.path.isdir(options.journal_dir):
+        parser.error('%s is not a directory' % (options.journal_dir,))
+    if not os.path.isdir(options.profile_dir):
+        parser.error('%s is not a directory' % (options.profile_dir,))
+
+    try:
+        backend = transport.load(options.transport)
+        if options.transport == 'heelhook':
+            backend.configure(options.heelhook_log_level)
+    except (ImportError, ValueError) as e:
+        parser.error(str(e))
+    ServerClass, ClientClass = make_classes(backend)
+    if options.workers is not None and not (backend.SHARES_PORT and
+                                            backend.THREADSAFE):
+        parser.error('the %s transport can only run in one process, use '
+                     '--transport asyncio with --workers' %
+                     (options.transport,))
+
+    assets = None
+    if options.static_dir:
+        if not os.path.isdir(options.static_dir):
+            parser.error('%s is not a directory' % (options.static_dir,))
+        if options.static_port is None and not backend.SERVES_ASSETS:
+            parser.error('the %s transport can only serve WebSockets, give '
+                         '--static-port' % (options.transport,))
+        try:
+            assets = static.Assets(options.static_dir,
+                                   max_age=options.static_max_age)
+        except (IOError, OSError) as e:
+            parser.error(str(e))
+    log.start()
+
+    if assets is not None and options.static_port is not None:
+        # one server for every worker, from this process
+        static.serve(options.static_port, assets)
+
+    def serve_metrics(admin_port):
+        metrics.LagMonitor(loop_lag_seconds).start()
+        if admin_port is not None:
+            metrics.serve(admin_port)
+
+    def make_server(reuse_port=False):
+        game_journal = None
+        if options.journal_dir:
+            game_journal = journal.Journal(options.journal_dir)
+            game_journal.start()
+
+        kwargs = {}
+        if options.heartbeat_interval:
+            kwargs['heartbeat_interval_ms'] = int(
+                options.heartbeat_interval * 1000)
+            kwargs['heartbeat_ttl_ms'] = int(options.heartbeat_ttl * 1000)
+        if assets is not None and options.static_port is None:
+            kwargs['assets'] = assets
+        if reuse_port:
+            kwargs['reuse_port'] = True
+        # made here so it samples the thread the server runs on
+        game_profiler = profiler.Profiler(options.profile_dir,
+                                          options.profile_interval)
+
+        def on_sigusr2(signum, frame):
+            game_profiler.toggle()
+        signal.signal(signal.SIGUSR2, on_sigusr2)
+
+        return ServerClass(port=port, connection_class=ClientClass,
+                           max_wait=options.max_wait, journal=game_journal,
+                           resume_grace=options.resume_grace,
+                           turn_timeout=options.turn_timeout,
+                           idle_timeout=options.idle_timeout,
+                           game_pool=options.game_pool,
+                           profiler=game_profiler, **kwargs)
+
+    def run_worker(index, broker_sock):
+        # every worker listens on the port
+        server = make_server(reuse_port=True)
+        server.use_broker(broker_sock)
+        admin_port = options.admin_port
+        if admin_port is not None:
+            admin_port += 1 + index
+        serve_metrics(admin_port)
+
+        def on_sigterm(signum, frame):
+            with server.lock:
+                server.drain()
+        signal.signal(signal.SIGTERM, on_sigterm)
+
+        server.listen()
+
+    if options.workers is None:
+        if options.log_levels_file:
+            def on_sighup(signum, frame):
+                try:
+                    log.load_levels(options.log_levels_file)
+                except (IOError, ValueError) as e:
+                    log.get_logger('log').error('%s', str(e))
+            signal.signal(signal.SIGHUP, on_sighup)
+
+        server = make_server()
+        serve_metrics(options.admin_port)
+        server.listen()
+    else:
+        Supervisor(options.workers, run_worker,
+                   drain_timeout=options.drain_timeout,
+                   max_wait=options.max_wait,
+                   log_levels_file=options.log_levels_file,
+                   admin_port=options.admin_port).run()
 
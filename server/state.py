@@ -0,0 +1,440 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# The game as an immutable value, for trying actions out.
+#
+# A GameState holds the same boards and invis masks as a game.Game, but
+# every board is kept as one int mask per tile value, and apply() returns
+# a new state rather than changing the one it was given. Boards an action
+# doesn't touch are shared with the state it came from, and the ones it
+# does are a handful of ints, so branching off to look ahead costs about
+# as much as the action itself rather than a copy of every board.
+#
+# Game stays the engine live sessions run on, since their updates are
+# built from its per-board change logs; from_game() and to_game() convert
+# between the two. The rules here mirror Game's and must be kept in step
+# with them.
+#
+
+from collections import namedtuple
+
+from game import (Board, Game, Grid, PlayerType, OFF_BOARD, bresenham,
+                  mask_positions)
+import journal
+
+# Board indexes in GameState.boards
+MASTER = 0
+
+# TILE_CLEAR has no mask of its own
+TILES = range(1, Board.NUM_TILES)
+
+BLOCK_TILE = (Board.TILE_BLOCK_WHITE, Board.TILE_BLOCK_BLACK)
+PLAYER_TILE = (Board.TILE_PLAYER_WHITE, Board.TILE_PLAYER_BLACK)
+
+# masks is a tuple with the mask of each tile value, indexed by value (the
+# TILE_CLEAR entry is always 0); white_pos and black_pos are where the board
+# last put each player, which stays put when their tile is cleared
+BoardState = namedtuple('BoardState', ['masks', 'white_pos', 'black_pos'])
+
+# boards is (master, white's, black's), invis is (white's, black's)
+GameState = namedtuple('GameState', ['width', 'boards', 'invis'])
+
+_zone_masks = {}
+
+# (width, end, master opaque mask) -> mask of the positions whose lines to
+# end are blocked, for at most MAX_SWEEPS keys
+_sweeps = {}
+MAX_SWEEPS = 4096
+
+def zone_mask(width):
+    """Returns the placement zone mask both players share."""
+    try:
+        return _zone_masks[width]
+    except KeyError:
+        mask = Game(width)._players[PlayerType.WHITE].zone_mask
+        _zone_masks[width] = mask
+        return mask
+
+def new_state(width=None):
+    """Returns the state of a new game."""
+    return from_game(Game(width))
+
+def from_game(game):
+    """Returns the state game is in."""
+    boards = [game._board] + [player.board for player in game._players]
+    return GameState(
+        game._grid.width,
+        tuple(BoardState(tuple(board._masks), board._white_pos,
+                         board._black_pos) for board in boards),
+        tuple(player.invis for player in game._players))
+
+def to_game(state, game=None):
+    """Returns a game.Game in state, which is game if one is given."""
+    if game is None:
+        game = Game(state.width)
+    boards = [game._board] + [player.board for player in game._players]
+    for board, board_state in zip(boards, state.boards):
+        for pos in xrange(board.grid.size):
+            board.set_at(pos, tile_at(board_state.masks, pos))
+        board._white_pos = board_state.white_pos
+        board._black_pos = board_state.black_pos
+
+    for player, invis in zip(game._players, state.invis):
+        player.invis = invis
+    return game
+
+def tile_at(masks, pos):
+    bit = 1 << pos
+    for tile in TILES:
+        if masks[tile] & bit:
+            return tile
+    return Board.TILE_CLEAR
+
+def apply(state, player_type, action):
+    """Runs action for player_type on state. action is a tuple as journaled
+    by GameSession: (journal.MOVE, direction), (journal.PLACE,
+    shape_index, x, y), (journal.SHOOT, direction) or (journal.PING,).
+
+    Returns (new state, result), result being what the Game method returns:
+    whether a move or placement was allowed, whether a shot hit or whether
+    a ping saw the opponent. Raises KeyError or ValueError, leaving state as
+    it was, where the Game method would raise.
+    """
+    step = Step(state)
+    kind = action[0]
+    if kind == journal.MOVE:
+        result = step.move_player(player_type, action[1])
+    elif kind == journal.PLACE:
+        result = step.place_shape(Game.SHAPES[action[1]], action[2],
+                                  action[3], player_type)
+    elif kind == journal.SHOOT:
+        result = step.shoot(player_type, action[1])
+    elif kind == journal.PING:
+        result = step.ping(player_type)
+    else:
+        raise ValueError('unknown action kind %r' % (kind,))
+    return step.result(), result
+
+class DraftBoard(object):
+    """A board being changed by one Step, copied from its BoardState the
+    first time it is written to."""
+    __slots__ = ('state', 'masks', 'white_pos', 'black_pos')
+
+    def __init__(self, board_state):
+        self.state = board_state
+        self.masks = None
+        self.white_pos = board_state.white_pos
+        self.black_pos = board_state.black_pos
+
+    def get_masks(self):
+        if self.masks is None:
+            return self.state.masks
+        return self.masks
+
+    def get_at(self, pos):
+        return tile_at(self.get_masks(), pos)
+
+    def is_block_at(self, pos):
+        masks = self.get_masks()
+        return bool((masks[Board.TILE_BLOCK_BLACK] |
+                     masks[Board.TILE_BLOCK_WHITE]) >> pos & 1)
+
+    def is_player_at(self, pos):
+        masks = self.get_masks()
+        return bool((masks[Board.TILE_PLAYER_BLACK] |
+                     masks[Board.TILE_PLAYER_WHITE] |
+                     masks[Board.TILE_PLAYER_BOTH]) >> pos & 1)
+
+    def get_player_pos(self, player_type):
+        if player_type == PlayerType.WHITE:
+            return self.white_pos
+        else:
+            return self.black_pos
+
+    def set_at(self, pos, value):
+        if self.masks is None:
+            self.masks = list(self.state.masks)
+        bit = 1 << pos
+        for tile in TILES:
+            if self.masks[tile] & bit:
+                self.masks[tile] ^= bit
+                break
+        if value != Board.TILE_CLEAR:
+            self.masks[value] |= bit
+
+    def set_mask(self, mask, value):
+        """set_at(pos, value) for every position in mask."""
+        if self.masks is None:
+            self.masks = list(self.state.masks)
+        keep = ~mask
+        for tile in TILES:
+            self.masks[tile] &= keep
+        if value != Board.TILE_CLEAR:
+            self.masks[value] |= mask
+
+    def copy_mask(self, other, mask):
+        """Gives every position in mask the value it has on other."""
+        if self.masks is None:
+            self.masks = list(self.state.masks)
+        keep = ~mask
+        other_masks = other.get_masks()
+        for tile in TILES:
+            self.masks[tile] = ((self.masks[tile] & keep) |
+                                (other_masks[tile] & mask))
+
+    def set_player_pos(self, player_type, new_pos, old_pos_value):
+        if player_type == PlayerType.WHITE:
+            self.set_at(self.white_pos, old_pos_value)
+            if new_pos == self.black_pos:
+                self.set_at(new_pos, Board.TILE_PLAYER_BOTH)
+            else:
+                self.set_at(new_pos, Board.TILE_PLAYER_WHITE)
+            self.white_pos = new_pos
+        else:
+            self.set_at(self.black_pos, old_pos_value)
+            if new_pos == self.white_pos:
+                self.set_at(new_pos, Board.TILE_PLAYER_BOTH)
+            else:
+                self.set_at(new_pos, Board.TILE_PLAYER_BLACK)
+            self.black_pos = new_pos
+
+    def result(self):
+        state = self.state
+        if (self.masks is None and self.white_pos == state.white_pos and
+                self.black_pos == state.black_pos):
+            return state
+        return BoardState(tuple(self.get_masks()), self.white_pos,
+                          self.black_pos)
+
+class Step(object):
+    """One action being applied to a GameState. Its methods follow the Game
+    methods of the same name."""
+    def __init__(self, state):
+        self.state = state
+        self.grid = Grid.for_width(state.width)
+        self.boards = [DraftBoard(board) for board in state.boards]
+        self.invis = list(state.invis)
+
+    def result(self):
+        boards = self.boards
+        return GameState(self.state.width,
+                         (boards[0].result(), boards[1].result(),
+                          boards[2].result()),
+                         tuple(self.invis))
+
+    def _opaque(self):
+        masks = self.boards[MASTER].get_masks()
+        opaque = 0
+        for tile in TILES:
+            opaque |= masks[tile]
+        return opaque
+
+    def _cast_line(self, start, x1, y1, path=None):
+        master = self.boards[MASTER]
+        masks = master.get_masks()
+
+        if path != None:
+            path.append(start)
+
+        if masks[Board.TILE_PLAYER_BOTH] >> start & 1:
+            return start
+
+        opaque = self._opaque()
+        end = self.grid.pack(x1, y1)
+        if end == OFF_BOARD:
+            return self._cast_off_board(start, x1, y1, opaque, path)
+
+        line, mask = self.grid.line(start, end)
+        if not (mask & opaque):
+            if path != None:
+                path.extend(line)
+            return end
+
+        for pos in line:
+            if path != None:
+                path.append(pos)
+            if opaque >> pos & 1:
+                return pos
+        return end
+
+    def _cast_off_board(self, start, x1, y1, opaque, path):
+        width = self.grid.width
+        pos = start
+        for x, y in bresenham(self.grid.xs[start], self.grid.ys[start],
+                              x1, y1):
+            if x < 0 or x >= width or y < 0 or y >= width:
+                return OFF_BOARD
+
+            pos = y * width + x
+            if path != None:
+                path.append(pos)
+            if opaque >> pos & 1:
+                return pos
+        return pos
+
+    def _visible_from(self, end):
+        # branches off one state mostly share their master board, so the
+        # sweep Game.visible_from does is kept for them all
+        key = (self.grid.width, end, self._opaque())
+        blocked = _sweeps.get(key)
+        if blocked is None:
+            shadows = self.grid.shadows(end)
+            blocked = 0
+            for pos in mask_positions(key[2]):
+                blocked |= shadows[pos]
+            if len(_sweeps) >= MAX_SWEEPS:
+                _sweeps.clear()
+            _sweeps[key] = blocked
+
+        masks = self.boards[MASTER].get_masks()
+        for pos in mask_positions(masks[Board.TILE_PLAYER_BOTH]):
+            if pos != end:
+                blocked |= 1 << pos
+
+        return self.grid.full_mask & ~blocked
+
+    def ping(self, player_type):
+        master = self.boards[MASTER]
+        board = self.boards[1 + player_type]
+        opponent_type = 1 - player_type
+        player_pos = master.get_player_pos(player_type)
+        opponent_pos = master.get_player_pos(opponent_type)
+
+        saw_opponent = False
+        endpoint = self._cast_line(opponent_pos, self.grid.xs[player_pos],
+                                   self.grid.ys[player_pos])
+        if endpoint == player_pos:
+            saw_opponent = True
+            board.set_player_pos(opponent_type, opponent_pos,
+                                 Board.TILE_CLEAR)
+            self.boards[1 + opponent_type].set_player_pos(
+                player_type, player_pos, Board.TILE_CLEAR)
+        else:
+            board.set_at(board.get_player_pos(opponent_type),
+                         Board.TILE_CLEAR)
+
+        invis = self.invis[player_type]
+        if invis:
+            revealed = invis & self._visible_from(player_pos)
+            if revealed:
+                self.invis[player_type] = invis ^ revealed
+                board.copy_mask(master, revealed)
+
+        return saw_opponent
+
+    def place_shape(self, shape, x, y, player_type):
+        master = self.boards[MASTER]
+        board = self.boards[1 + player_type]
+        opponent_type = 1 - player_type
+        block_tile = BLOCK_TILE[player_type]
+        opponent_tile = PLAYER_TILE[opponent_type]
+
+        placed = (self.grid.shape_mask(shape, x, y) &
+                  zone_mask(self.grid.width))
+        if not placed:
+            return False
+
+        masks = master.get_masks()
+        placed &= ~masks[PLAYER_TILE[player_type]]
+        on_opponent = placed & masks[opponent_tile]
+        if on_opponent:
+            placed ^= on_opponent
+            for pos in mask_positions(on_opponent):
+                if board.get_at(pos) != opponent_tile:
+                    # Fake tile!
+                    board.set_at(pos, block_tile)
+                    self.invis[player_type] |= 1 << pos
+
+        if placed:
+            self.invis[opponent_type] |= placed
+            master.set_mask(placed, block_tile)
+            board.set_mask(placed, block_tile)
+
+        return True
+
+    def move_player(self, player_type, direction):
+        master = self.boards[MASTER]
+        board = self.boards[1 + player_type]
+        opponent_type = 1 - player_type
+        cur_pos = master.get_player_pos(player_type)
+        new_pos = self.grid.neighbours[direction][cur_pos]
+        if new_pos == OFF_BOARD:
+            return False
+
+        old_value = Board.TILE_CLEAR
+        if master.get_at(cur_pos) == Board.TILE_PLAYER_BOTH:
+            old_value = PLAYER_TILE[opponent_type]
+        player_old_value = Board.TILE_CLEAR
+        if board.get_at(cur_pos) == Board.TILE_PLAYER_BOTH:
+            player_old_value = PLAYER_TILE[opponent_type]
+
+        value = master.get_at(new_pos)
+        if board.is_block_at(new_pos) and not Board.BLOCK_TILES[value]:
+            board.set_at(new_pos, value)
+            return False
+        elif value == BLOCK_TILE[opponent_type]:
+            board.set_at(new_pos, value)
+            return False
+        elif value == BLOCK_TILE[player_type]:
+            return False
+
+        master.set_player_pos(player_type, new_pos, old_value)
+        board.set_player_pos(player_type, new_pos, player_old_value)
+        return True
+
+    def shoot(self, player_type, direction):
+        offset = Game.DIRECTION_OFFSETS[direction]
+        master = self.boards[MASTER]
+        board = self.boards[1 + player_type]
+        player_pos = master.get_player_pos(player_type)
+
+        path = []
+        endpoint = self._cast_line(
+            player_pos,
+            self.grid.xs[player_pos] + offset.x * Game.SHOOT_RADIUS,
+            self.grid.ys[player_pos] + offset.y * Game.SHOOT_RADIUS,
+            path=path
+        )
+
+        # clear out any fake tiles we passed through
+        for pos in path:
+            if board.is_block_at(pos) and not master.is_block_at(pos):
+                board.set_at(pos, master.get_at(pos))
+                self.invis[player_type] &= ~(1 << pos)
+
+        if endpoint == OFF_BOARD:
+            return False
+        if master.is_player_at(endpoint):
+            return True
+        elif master.is_block_at(endpoint):
+            master.set_at(endpoint, Board.TILE_CLEAR)
+            board.set_at(endpoint, Board.TILE_CLEAR)
+            self.invis[1 - player_type] |= 1 << endpoint
+        return False
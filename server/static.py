@@ -0,0 +1,247 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Serves the browser client's files, so no separate web server is needed.
+#
+# Every file under the directory is read into memory at startup, along
+# with a gzipped copy when that is smaller, and its headers are made then
+# too, so a request costs a dict lookup and a write. Each response has a
+# strong ETag and may be cached for max_age seconds, except HTML pages,
+# which are checked again each time so a new client is picked up; a
+# request whose If-None-Match still matches gets a 304.
+#
+# Assets answers requests for whatever HTTP server is at hand: serve()
+# runs one on a port of its own, and the asyncio transport can answer
+# plain GETs on the game's own port from it.
+#
+
+import BaseHTTPServer
+import SocketServer
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+import urllib
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import log
+import metrics
+
+static_log = log.get_logger('static')
+
+responses = metrics.REGISTRY.counter(
+    'ping_static_responses_total',
+    'Responses to requests for client files, by status code.', ('status',))
+
+# don't bother compressing files smaller than this
+MIN_GZIP_SIZE = 256
+
+class Asset(object):
+    __slots__ = ('content_type', 'body', 'gzipped', 'etag', 'gzip_etag',
+                 'cache_control')
+
+    def __init__(self, path, body, max_age):
+        content_type = mimetypes.guess_type(path)[0]
+        if content_type is None:
+            content_type = 'application/octet-stream'
+        elif content_type.startswith('text/') or content_type.endswith(
+                'javascript'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        self.body = body
+
+        self.gzipped = None
+        if len(body) >= MIN_GZIP_SIZE:
+            out = StringIO()
+            with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=9,
+                               mtime=0) as f:
+                f.write(body)
+            if out.tell() < len(body):
+                self.gzipped = out.getvalue()
+
+        # each encoding is its own representation, so needs its own tag
+        digest = hashlib.sha1(body).hexdigest()[:20]
+        self.etag = '"%s"' % (digest,)
+        self.gzip_etag = '"%s-gz"' % (digest,)
+
+        if content_type.startswith('text/html'):
+            self.cache_control = 'no-cache'
+        else:
+            self.cache_control = 'public, max-age=%d' % (max_age,)
+
+class Assets(object):
+    """The files under directory, as served at the paths below /. A path
+    ending in / serves the index.html in it."""
+    def __init__(self, directory, max_age=86400):
+        self.directory = directory
+        self.max_age = max_age
+        self.assets = {}
+        self.size = 0
+        self.load()
+
+    def load(self):
+        assets = {}
+        size = 0
+        for root, dirs, files in os.walk(self.directory):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    body = f.read()
+                url = '/' + os.path.relpath(path, self.directory).replace(
+                    os.sep, '/')
+                assets[url] = Asset(path, body, self.max_age)
+                size += len(body) + len(assets[url].gzipped or '')
+        self.assets = assets
+        self.size = size
+        static_log.info('loaded %d files, %d bytes, from %s', len(assets),
+                        size, self.directory)
+
+    def respond(self, method, path, headers):
+        """Returns (status, [(header, value)], body) answering a request.
+        headers has the request's header values by lower case name."""
+        if method not in ('GET', 'HEAD'):
+            return self._error(405, [('Allow', 'GET, HEAD')])
+
+        path = urllib.unquote(path.split('?', 1)[0].split('#', 1)[0])
+        if path.endswith('/'):
+            path += 'index.html'
+        asset = self.assets.get(path)
+        if asset is None:
+            return self._error(404)
+
+        gzipped = asset.gzipped is not None and accepts_gzip(
+            headers.get('accept-encoding', ''))
+        if gzipped:
+            body, etag = asset.gzipped, asset.gzip_etag
+        else:
+            body, etag = asset.body, asset.etag
+        response_headers = [
+            ('ETag', etag),
+            ('Cache-Control', asset.cache_control),
+            ('Vary', 'Accept-Encoding')
+        ]
+
+        if etag_matches(headers.get('if-none-match'), etag):
+            responses.labels('304').inc()
+            return 304, response_headers, ''
+
+        if gzipped:
+            response_headers.append(('Content-Encoding', 'gzip'))
+        response_headers.extend([
+            ('Content-Type', asset.content_type),
+            ('Content-Length', str(len(body)))
+        ])
+        responses.labels('200').inc()
+        if method == 'HEAD':
+            body = ''
+        return 200, response_headers, body
+
+    def _error(self, status, headers=()):
+        responses.labels(str(status)).inc()
+        body = '%d %s\n' % (status, BaseHTTPServer.BaseHTTPRequestHandler
+                            .responses[status][0])
+        return status, list(headers) + [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(body)))
+        ], body
+
+def accepts_gzip(accept_encoding):
+    """Returns whether an Accept-Encoding header allows gzip."""
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', '*'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # weak comparison, as If-None-Match calls for
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+class AssetServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, assets):
+        BaseHTTPServer.HTTPServer.__init__(self, address, AssetHandler)
+        self.assets = assets
+
+class AssetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        headers = dict((name.lower(), value)
+                       for name, value in self.headers.items())
+        status, response_headers, body = self.server.assets.respond(
+            self.command, self.path, headers)
+        self.send_response(status)
+        for name, value in response_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, fmt, *args):
+        static_log.debug(fmt, *args)
+
+def serve(port, assets, host=''):
+    """Serves assets at http://host:port/ from background threads. Returns
+    the HTTP server."""
+    httpd = AssetServer((host, port), assets)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    static_log.info('serving client files on port %d', port)
+    return httpd
@@ -0,0 +1,123 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import random
+import unittest
+
+from game import Game, Location, mask_positions
+
+try:
+    import numpy as np
+    import batch
+except ImportError:
+    batch = None
+
+GAMES = 48
+STEPS = 250
+# games are compared every this many steps, results after every one
+CHECK_EVERY = 5
+
+MOVE, PLACE, SHOOT, PING = range(4)
+
+def game_state(game):
+    boards = [game._board] + [player.board for player in game._players]
+    return ([(bytes(board._tiles), board._white_pos, board._black_pos)
+             for board in boards] +
+            [mask_positions(player.invis) for player in game._players])
+
+@unittest.skipIf(batch is None, 'numpy is not available')
+class GameBatchTest(unittest.TestCase):
+    """Steps a GameBatch and a Game per game in it side by side, with each
+    game taking its own random action each step, checking every result and,
+    every few steps, every game."""
+    def play(self, width):
+        rnd = random.Random(width)
+        games = [Game(width) for i in xrange(GAMES)]
+        game_batch = batch.GameBatch(GAMES, width)
+        # games that haven't ended by a shot hitting
+        alive = [True] * GAMES
+
+        for step in xrange(STEPS):
+            player_type = step % 2
+            kinds = [(MOVE, MOVE, MOVE, MOVE, PLACE, PLACE, PLACE, SHOOT,
+                      PING, PING)[rnd.randrange(10)] for i in xrange(GAMES)]
+            for kind in (MOVE, PLACE, SHOOT, PING):
+                indexes = [i for i in xrange(GAMES)
+                           if alive[i] and kinds[i] == kind]
+                if not indexes:
+                    continue
+
+                if kind in (MOVE, SHOOT):
+                    directions = [rnd.randrange(4) for i in indexes]
+                    fn = (game_batch.move_player if kind == MOVE
+                          else game_batch.shoot)
+                    results = fn(player_type, np.array(directions),
+                                 np.array(indexes))
+                    expected = [(games[i].move_player if kind == MOVE
+                                 else games[i].shoot)(player_type, direction)
+                                for i, direction in zip(indexes, directions)]
+                elif kind == PLACE:
+                    xs = [rnd.randrange(-1, width) for i in indexes]
+                    ys = [rnd.randrange(-1, width) for i in indexes]
+                    shapes = [rnd.randrange(len(Game.SHAPES))
+                              for i in indexes]
+                    results = game_batch.place_shape(
+                        np.array(xs), np.array(ys), np.array(shapes),
+                        player_type, np.array(indexes))
+                    expected = [games[i].place_shape(Location(x, y),
+                                                     Game.SHAPES[shape],
+                                                     player_type)
+                                for i, x, y, shape
+                                in zip(indexes, xs, ys, shapes)]
+                else:
+                    results = game_batch.ping(player_type, np.array(indexes))
+                    expected = [games[i].ping(player_type) for i in indexes]
+
+                for i, result, want in zip(indexes, results, expected):
+                    self.assertEqual(bool(result), want,
+                                     'width %d step %d game %d' %
+                                     (width, step, i))
+                    if kind == SHOOT and want:
+                        alive[i] = False
+
+            if step % CHECK_EVERY and step != STEPS - 1:
+                continue
+            for i in xrange(GAMES):
+                if alive[i]:
+                    self.assertEqual(game_state(game_batch.to_game(i)),
+                                     game_state(games[i]),
+                                     'width %d step %d game %d' %
+                                     (width, step, i))
+
+    def test_random_games(self):
+        for width in (7, 14):
+            self.play(width)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import random
+import unittest
+
+from game import Board, Game, Grid, Location, PlayerType, mask_positions
+import game_reference
+
+SEEDS = 30
+STEPS = 300
+
+def board_state(board):
+    """Returns board.for_json() in a form that doesn't depend on the order
+    its lists were built in."""
+    return sorted((key, sorted(map(list, value)) if key.endswith('block')
+                        else list(value))
+                  for key, value in board.for_json().iteritems())
+
+def game_state(game):
+    boards = [game._board] + [player.board for player in game._players]
+    return ([board_state(board) for board in boards] +
+            [sorted((pos % game._grid.width, pos // game._grid.width)
+                    for pos in mask_positions(player.invis))
+             for player in game._players])
+
+def reference_state(game):
+    boards = [game._board] + [player.board for player in game._players]
+    return ([board_state(board) for board in boards] +
+            [sorted((loc.x, loc.y) for loc in player.invis_tiles)
+             for player in game._players])
+
+class GridTest(unittest.TestCase):
+    def test_shadows(self):
+        grid = Grid(8)
+        for end in (0, 27, 63):
+            shadows = grid.shadows(end)
+            for pos in xrange(grid.size):
+                starts = 0
+                for start in xrange(grid.size):
+                    line, mask = grid.line(start, end)
+                    if mask >> pos & 1:
+                        starts |= 1 << start
+                self.assertEqual(shadows[pos], starts)
+
+    def test_tables_are_bounded(self):
+        grid = Grid(8)
+        grid._max_shadows = 3
+        grid._max_line_rows = 5
+        for end in xrange(grid.size):
+            grid.shadows(end)
+            grid.line(end, 0)
+        self.assertEqual(len(grid._shadows), 3)
+        self.assertEqual(list(grid._shadows), [61, 62, 63])
+        self.assertTrue(
+            sum(row is not None for row in grid._lines) <= 5)
+
+        # the most recently used ends are kept
+        grid.shadows(61)
+        grid.shadows(0)
+        self.assertEqual(list(grid._shadows), [63, 61, 0])
+
+def stale_block_game():
+    """Returns a Game where white's board shows a block just north of white
+    that isn't there, and that white doesn't have marked as hidden, and
+    where it is."""
+    game = Game()
+    white_pos = game._board.get_player_pos(PlayerType.WHITE)
+    pos = game._grid.neighbours[Game.DIRECTION_NORTH][white_pos]
+    game._players[PlayerType.WHITE].board.set_at(pos, Board.TILE_BLOCK_BLACK)
+    return game, pos
+
+class GameTest(unittest.TestCase):
+    def test_shoot_through_stale_block(self):
+        game, pos = stale_block_game()
+        player = game._players[PlayerType.WHITE]
+        self.assertFalse(game.shoot(PlayerType.WHITE, Game.DIRECTION_NORTH))
+        self.assertEqual(player.board.get_at(pos), Board.TILE_CLEAR)
+        self.assertEqual(player.invis, 0)
+
+class ReferenceRulesTest(unittest.TestCase):
+    """Plays random games on Game and on game_reference.Game side by side,
+    checking every result and board after every action."""
+    def play(self, seed):
+        rnd = random.Random(seed)
+        width = Game.BOARD_WIDTH
+        game = Game()
+        reference = game_reference.Game()
+        for step in xrange(STEPS):
+            player_type = step % 2
+            kind = rnd.randrange(10)
+            if kind < 4:
+                direction = rnd.randrange(4)
+                args = ('move_player', player_type, direction)
+                result = game.move_player(player_type, direction)
+                expected = reference.move_player(player_type, direction)
+            elif kind < 7:
+                index = rnd.randrange(len(Game.SHAPES))
+                x = rnd.randrange(-1, width)
+                y = rnd.randrange(-1, width)
+                args = ('place_shape', x, y, index, player_type)
+                result = game.place_shape(Location(x, y), Game.SHAPES[index],
+                                          player_type)
+                expected = reference.place_shape(
+                    game_reference.Location(x, y),
+                    game_reference.Game.SHAPES[index], player_type)
+            elif kind < 8:
+                direction = rnd.randrange(4)
+                args = ('shoot', player_type, direction)
+                result = game.shoot(player_type, direction)
+                expected = reference.shoot(player_type, direction)
+            else:
+                args = ('ping', player_type)
+                result = game.ping(player_type)
+                expected = reference.ping(player_type)
+
+            where = 'seed %d step %d %r' % (seed, step, args)
+            self.assertEqual(result, expected, where)
+            self.assertEqual(game_state(game), reference_state(reference),
+                             where)
+            if args[0] == 'shoot' and result is True:
+                # game over
+                return
+
+    def test_random_games(self):
+        for seed in xrange(SEEDS):
+            self.play(seed)
+
+if __name__ == '__main__':
+    unittest.main()
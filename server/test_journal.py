@@ -0,0 +1,121 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+from collections import deque
+import os
+import shutil
+import tempfile
+import unittest
+
+from game import Game, PlayerType
+import journal
+import log
+import server
+
+try:
+    import ujson as json
+except:
+    import json
+
+class StubConn(object):
+    """Stands in for a GameClient connection, keeping what's sent."""
+    get_type_and_parse = server.GameClient.__dict__['get_type_and_parse']
+    send_message = server.GameClient.__dict__['send_message']
+    send_encoded = server.GameClient.__dict__['send_encoded']
+
+    def __init__(self, name):
+        self.name = name
+        self.protocol = server.PROTOCOLS['json']
+        self.sent = []
+        self.closed = None
+
+    def send(self, msg, is_text):
+        self.sent.append(json.loads(msg))
+
+    def send_close(self, code, reason=''):
+        self.closed = (code, reason)
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        log.set_levels('error')
+        self.directory = tempfile.mkdtemp()
+        self.journal = journal.Journal(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def play(self, *messages):
+        white, black = StubConn('white'), StubConn('black')
+        session = server.GameSession(
+            white, black, journal=self.journal.session('white', 'black'))
+        session.start()
+        for msg in messages:
+            session.handle(session.current_player, json.dumps(msg), True)
+        self.journal.flush()
+        return session
+
+    def test_replays_a_game(self):
+        session = self.play({'type': 'move', 'direction': 'N'},
+                            {'type': 'ping'},
+                            {'type': 'shoot', 'direction': 'E'})
+        path, = [os.path.join(self.directory, name)
+                 for name in os.listdir(self.directory)]
+        replay = journal.Replay(path)
+        self.assertEqual(len(replay), 3)
+        self.assertEqual(str(replay.game_at(3)), str(session.game))
+
+    def test_negative_shape_index_is_invalid(self):
+        session = self.play({'type': 'place', 'shape_index': -1,
+                             'origin': [3, 3]})
+        self.assertTrue(session.game_over)
+        self.assertEqual(session.white.sent[-1]['reason'], 'invalid data')
+        # nothing was placed
+        fresh = Game()
+        for player_type in (PlayerType.WHITE, PlayerType.BLACK):
+            self.assertEqual(str(session.game.get_board(player_type)),
+                             str(fresh.get_board(player_type)))
+
+    def test_unwritable_directory_drops_records(self):
+        shutil.rmtree(self.directory)
+        # keep what's logged from being written out
+        sink = log._sink
+        buffer = sink.buffer
+        sink.buffer = deque(maxlen=sink.capacity)
+        try:
+            self.play({'type': 'ping'})
+        finally:
+            logged, sink.buffer = sink.buffer, buffer
+
+        self.assertEqual(len(self.journal.queue), 0)
+        self.assertEqual(self.journal._files, {})
+        self.assertEqual([level for when, level, category, fmt, args in logged
+                          if category == 'journal'], [log.ERROR])
+
+if __name__ == '__main__':
+    unittest.main()
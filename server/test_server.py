@@ -0,0 +1,94 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import time
+import types
+import unittest
+
+import log
+import server
+from transport import CloseCode
+
+try:
+    import ujson as json
+except:
+    import json
+
+class StubServer(object):
+    def __init__(self, port, connection_class, **kwargs):
+        self.port = port
+        self.connection_class = connection_class
+
+class StubConn(object):
+    def __init__(self, server):
+        self.server = server
+        self.sent = []
+        self.closed = None
+
+    def send(self, msg, is_text=True):
+        self.sent.append(msg)
+
+    def send_close(self, code, reason=''):
+        self.closed = (code, reason)
+
+# a backend that, like heelhook, can't be called into from other threads
+stub_backend = types.ModuleType('stub_backend')
+stub_backend.Server = StubServer
+stub_backend.ServerConn = StubConn
+stub_backend.SERVES_ASSETS = False
+stub_backend.SHARES_PORT = False
+stub_backend.THREADSAFE = False
+
+class TimersTest(unittest.TestCase):
+    def setUp(self):
+        log.set_levels('error')
+        ServerClass, self.ClientClass = server.make_classes(stub_backend)
+        self.server = ServerClass(port=0, connection_class=self.ClientClass,
+                                  idle_timeout=0.3)
+
+    def connect(self):
+        client = self.ClientClass(self.server)
+        client.on_connect()
+        client.on_open()
+        return client
+
+    def test_timers_run_from_callbacks(self):
+        idle = self.connect()
+        time.sleep(0.6)
+        # nothing runs the timers off the transport's thread
+        self.assertIsNone(self.server._timer_thread)
+        self.assertIsNone(idle.closed)
+
+        other = self.connect()
+        other.on_message(json.dumps({'type': 'join', 'name': 'a'}), True)
+        self.assertEqual(idle.closed, (CloseCode.NORMAL, 'idle'))
+        self.assertIsNone(other.closed)
+
+if __name__ == '__main__':
+    unittest.main()
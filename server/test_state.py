@@ -0,0 +1,100 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import random
+import unittest
+
+from game import Game, Location, PlayerType
+import journal
+import state
+from test_game import stale_block_game
+
+SEEDS = 30
+STEPS = 400
+
+class ApplyTest(unittest.TestCase):
+    """Runs random actions through state.apply and on a Game side by side,
+    checking every result and state after every action."""
+    def play(self, seed):
+        rnd = random.Random(seed)
+        width = rnd.choice([5, 7, 10, 14, 20])
+        game = Game(width)
+        current = state.new_state(width)
+        self.assertEqual(state.from_game(game), current)
+        history = []
+
+        for step in xrange(STEPS):
+            player_type = rnd.randrange(2)
+            kind = rnd.randrange(10)
+            if kind < 3:
+                action = (journal.MOVE, rnd.randrange(4))
+                run = lambda: game.move_player(player_type, action[1])
+            elif kind < 6:
+                action = (journal.PLACE, rnd.randrange(len(Game.SHAPES)),
+                          rnd.randrange(-3, width + 2),
+                          rnd.randrange(-3, width + 2))
+                run = lambda: game.place_shape(Location(action[2], action[3]),
+                                               Game.SHAPES[action[1]],
+                                               player_type)
+            elif kind < 8:
+                action = (journal.SHOOT, rnd.randrange(4))
+                run = lambda: game.shoot(player_type, action[1])
+            else:
+                action = (journal.PING,)
+                run = lambda: game.ping(player_type)
+
+            where = 'seed %d step %d %r' % (seed, step, action)
+            result = run()
+            history.append(current)
+            current, expected = state.apply(current, player_type, action)
+            self.assertEqual(result, expected, where)
+            self.assertEqual(state.from_game(game), current, where)
+
+        return history, current
+
+    def test_random_games(self):
+        for seed in xrange(SEEDS):
+            self.play(seed)
+
+    def test_shoot_through_stale_block(self):
+        game, pos = stale_block_game()
+        before = state.from_game(game)
+        result = game.shoot(PlayerType.WHITE, Game.DIRECTION_NORTH)
+        after, expected = state.apply(before, PlayerType.WHITE,
+                                      (journal.SHOOT, Game.DIRECTION_NORTH))
+        self.assertEqual(result, expected)
+        self.assertEqual(state.from_game(game), after)
+
+    def test_round_trip(self):
+        history, current = self.play(2)
+        for past in history[::40] + [current]:
+            self.assertEqual(state.from_game(state.to_game(past)), past)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,234 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Runs a game server on the asyncio transport and talks to it over real
+# sockets. Skipped without asyncio (or trollius on Python 2).
+#
+
+import base64
+import errno
+import os
+import socket
+import struct
+import threading
+import unittest
+
+import log
+import server
+
+try:
+    import transport_asyncio
+except ImportError:
+    transport_asyncio = None
+
+try:
+    import ujson as json
+except:
+    import json
+
+TIMEOUT = 5
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class Client(object):
+    """A blocking WebSocket client, just enough to play."""
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), TIMEOUT)
+        self.sock.settimeout(TIMEOUT)
+        self.buffer = ''
+        self.status = None
+
+    def handshake(self):
+        key = base64.b64encode(os.urandom(16))
+        self.sock.sendall('GET / HTTP/1.1\r\n'
+                          'Host: localhost\r\n'
+                          'Upgrade: websocket\r\n'
+                          'Connection: Upgrade\r\n'
+                          'Sec-WebSocket-Key: %s\r\n'
+                          'Sec-WebSocket-Version: 13\r\n\r\n' % (key,))
+        while '\r\n\r\n' not in self.buffer:
+            self._recv()
+        head, self.buffer = self.buffer.split('\r\n\r\n', 1)
+        self.status = int(head.split(' ')[1])
+
+    def _recv(self):
+        data = self.sock.recv(4096)
+        if not data:
+            raise EOFError('connection closed')
+        self.buffer += data
+
+    def _take(self, size):
+        while len(self.buffer) < size:
+            self._recv()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send(self, msg):
+        mask = os.urandom(4)
+        masked = ''.join(chr(ord(c) ^ ord(mask[i % 4]))
+                         for i, c in enumerate(msg))
+        if len(msg) < 126:
+            head = struct.pack('!BB', 0x81, 0x80 | len(msg))
+        else:
+            head = struct.pack('!BBH', 0x81, 0x80 | 126, len(msg))
+        self.sock.sendall(head + mask + masked)
+
+    def receive(self):
+        """Returns the next text message as a dict. Raises EOFError once the
+        server closes the connection."""
+        first, second = struct.unpack('!BB', self._take(2))
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self._take(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._take(8))[0]
+        payload = self._take(length)
+        if first & 0x0f == 0x8:
+            raise EOFError('closed')
+        return json.loads(payload)
+
+    def close(self):
+        self.sock.close()
+
+@unittest.skipIf(transport_asyncio is None, 'asyncio is not available')
+class AsyncioServerTest(unittest.TestCase):
+    def setUp(self):
+        log.set_levels('error')
+        self.port = free_port()
+        self.servers = []
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for game_server, thread in self.servers:
+            if game_server.loop is not None and thread.is_alive():
+                game_server.loop.call_soon_threadsafe(game_server.loop.stop)
+                thread.join(TIMEOUT)
+
+    def make_server(self, connection_class=None, **kwargs):
+        ServerClass, ClientClass = server.make_classes(transport_asyncio)
+        return ServerClass(port=self.port, host='127.0.0.1',
+                           connection_class=connection_class or ClientClass,
+                           **kwargs)
+
+    def start(self, game_server):
+        thread = threading.Thread(target=game_server.listen)
+        thread.daemon = True
+        thread.start()
+        self.servers.append((game_server, thread))
+
+    def connect(self):
+        for i in xrange(50):
+            try:
+                client = Client(self.port)
+                break
+            except socket.error:
+                threading.Event().wait(0.05)
+        else:
+            self.fail('server never started listening')
+        self.clients.append(client)
+        client.handshake()
+        return client
+
+    def join(self, name):
+        client = self.connect()
+        self.assertEqual(client.status, 101)
+        client.send(json.dumps({'type': 'join', 'name': name}))
+        self.assertEqual(client.receive()['type'], 'joined')
+        return client
+
+    def test_answers_after_a_join(self):
+        # every kind of game timer pending from the first join on
+        self.start(self.make_server(max_wait=30, turn_timeout=60,
+                                    idle_timeout=60,
+                                    heartbeat_interval_ms=1000,
+                                    heartbeat_ttl_ms=1000))
+        white = self.join('a')
+        # the game server's timers and the transport's heartbeats run on
+        # separate wheels; sharing one stalled the server once a game
+        # timer was pending
+        threading.Event().wait(2 * server.GameServer.TIMER_INTERVAL)
+        black = self.join('b')
+        self.assertEqual(white.receive()['type'], 'start')
+        self.assertEqual(black.receive()['type'], 'start')
+
+    def test_timers_run_on_the_loop_thread(self):
+        ServerClass, ClientClass = server.make_classes(transport_asyncio)
+        idled = []
+
+        class IdleClient(ClientClass):
+            def on_idle(self):
+                idled.append(threading.current_thread())
+                ClientClass.on_idle(self)
+
+        game_server = self.make_server(connection_class=IdleClient,
+                                       idle_timeout=0.3)
+        self.start(game_server)
+        client = self.connect()
+        # closed for idling
+        self.assertRaises(EOFError, client.receive)
+        self.assertEqual(idled, [self.servers[0][1]])
+
+    def test_port_in_use(self):
+        self.start(self.make_server())
+        self.connect()
+        second = self.make_server()
+        errors = []
+
+        def listen():
+            try:
+                second.listen()
+            except socket.error as e:
+                errors.append(e.errno)
+        thread = threading.Thread(target=listen)
+        thread.daemon = True
+        thread.start()
+        self.servers.append((second, thread))
+        thread.join(TIMEOUT)
+        self.assertEqual(errors, [errno.EADDRINUSE])
+
+    @unittest.skipIf(not hasattr(socket, 'SO_REUSEPORT'),
+                     'SO_REUSEPORT is not available')
+    def test_reuse_port(self):
+        self.start(self.make_server(reuse_port=True))
+        self.connect()
+        self.start(self.make_server(reuse_port=True))
+        # the second would have stopped listening if it couldn't bind
+        threading.Event().wait(0.2)
+        self.assertTrue(self.servers[1][1].is_alive())
+
+if __name__ == '__main__':
+    unittest.main()
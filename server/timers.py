@@ -0,0 +1,174 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Hierarchical timing wheel.
+#
+# Time is cut into ticks of resolution seconds. The wheel has LEVELS rings
+# of SLOTS slots each; a slot on level n holds the timers due in one span of
+# SLOTS ** n ticks, so the first ring covers the next SLOTS ticks, the
+# second the next SLOTS ** 2, and so on. Each time the first ring comes
+# round, the next slot of the ring above is emptied into the rings below,
+# cascading further up when that ring comes round too. Timers further out
+# than the whole wheel wait in its last slot and are put back each time
+# they cascade.
+#
+# Scheduling and cancelling are O(1) set operations, and advancing costs
+# O(1) per tick plus the timers that fire or cascade, however many timers
+# are waiting. It isn't thread safe: the server only touches its wheel with
+# its lock held.
+#
+
+import time
+import traceback
+
+import log
+
+timer_log = log.get_logger('timers')
+
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+MAX_TICKS = (1 << (SLOT_BITS * LEVELS)) - 1
+
+class Timer(object):
+    """A callback scheduled on a TimingWheel."""
+    __slots__ = ('wheel', 'expires', 'callback', 'args', 'slot')
+
+    def __init__(self, wheel, callback, args):
+        self.wheel = wheel
+        self.expires = 0
+        self.callback = callback
+        self.args = args
+        # the set it's waiting in, None once it has fired or been cancelled
+        self.slot = None
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.remove(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+class TimingWheel(object):
+    """Runs callbacks some time from now, in the thread calling advance().
+    A timer fires on the first advance() at or after its deadline, rounded
+    up to the next tick."""
+    def __init__(self, resolution=0.1, clock=time.time):
+        self.resolution = resolution
+        self.clock = clock
+        self.origin = clock()
+        # the next tick to run
+        self.tick = 0
+        self.count = 0
+        self.levels = [[set() for i in range(SLOTS)]
+                       for level in range(LEVELS)]
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) delay seconds from now. Returns a Timer
+        that can be cancelled."""
+        timer = Timer(self, callback, args)
+        self.restart(timer, delay)
+        return timer
+
+    def restart(self, timer, delay):
+        """Reschedules timer, which may have fired or been cancelled, for
+        delay seconds from now."""
+        timer.cancel()
+        when = self.clock() + delay - self.origin
+        # never a tick that has already run
+        timer.expires = max(-int(-when // self.resolution), self.tick)
+        self._place(timer)
+        self.count += 1
+
+    def advance(self, now=None):
+        """Fires the timers due by now. Returns how many did."""
+        if now is None:
+            now = self.clock()
+        target = int((now - self.origin) // self.resolution)
+        if not self.count:
+            self.tick = max(self.tick, target + 1)
+            return 0
+
+        fired = 0
+        ring = self.levels[0]
+        while self.tick <= target:
+            index = self.tick & SLOT_MASK
+            if index == 0:
+                self._cascade(1)
+
+            slot = ring[index]
+            if slot:
+                # timers scheduled while these fire go in the new set
+                ring[index] = set()
+            self.tick += 1
+
+            while slot:
+                timer = slot.pop()
+                timer.slot = None
+                self.count -= 1
+                fired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    timer_log.error('error in timer %r:\n%s', timer.callback,
+                                    traceback.format_exc())
+        return fired
+
+    def _place(self, timer):
+        at = min(timer.expires, self.tick + MAX_TICKS)
+
+        delta = at - self.tick
+        level = 0
+        while delta >> (SLOT_BITS * (level + 1)):
+            level += 1
+
+        slot = self.levels[level][(at >> (SLOT_BITS * level)) & SLOT_MASK]
+        slot.add(timer)
+        timer.slot = slot
+
+    def _cascade(self, level):
+        """Moves the timers in level's slot for the current tick down the
+        wheel."""
+        index = (self.tick >> (SLOT_BITS * level)) & SLOT_MASK
+        if index == 0 and level + 1 < LEVELS:
+            self._cascade(level + 1)
+
+        slot = self.levels[level][index]
+        if slot:
+            self.levels[level][index] = set()
+            for timer in slot:
+                self._place(timer)
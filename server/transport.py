@@ -0,0 +1,82 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# What the game server needs from a WebSocket server, and the backends that
+# provide it.
+#
+# A backend module has a Server and a ServerConn. Server(port=...,
+# connection_class=...) takes connections on port and makes a
+# connection_class, a ServerConn subclass, for each. listen() serves them
+# until the process exits. Given heartbeat_interval_ms and
+# heartbeat_ttl_ms, it pings connections it hasn't heard from in
+# heartbeat_interval_ms and drops those that don't answer within
+# heartbeat_ttl_ms. A ServerConn has the server it belongs to in
+# .server and calls these on itself, always from the server's thread:
+#
+#     on_connect()                a client connected
+#     on_open()                   the WebSocket handshake is done
+#     on_message(msg, is_text)    a whole message arrived
+#     on_close(code, reason)      the connection is gone, called once
+#
+# Its send(msg, is_text) and send_close(code, reason) are called from those
+# callbacks, on the server's thread. Codes are the CloseCode values below
+# whatever the backend.
+#
+# A backend whose THREADSAFE is true lets send() and send_close() be called
+# from any thread, and its Server has call_soon_threadsafe(callback, *args)
+# to run callback on the server's thread.
+#
+# A backend whose SHARES_PORT is true takes reuse_port. Given it, other
+# processes may listen on the same port (SO_REUSEPORT) and the kernel
+# spreads connections across them; otherwise listening on a port in use
+# fails.
+#
+# A backend whose SERVES_ASSETS is true also takes assets, a static.Assets,
+# and answers plain HTTP requests on the port from it. Those connections
+# make a connection_class too, which sees on_connect and on_close only.
+#
+
+class CloseCode(object):
+    NORMAL = 1000
+    GOING_AWAY = 1001
+    PROTOCOL = 1002
+    ABNORMAL = 1006
+    INVALID_DATA = 1007
+    TOO_BIG = 1009
+
+BACKENDS = {
+    'heelhook': 'transport_heelhook',
+    'asyncio': 'transport_asyncio'
+}
+
+def load(name):
+    """Returns the backend module called name. Raises ImportError if what it
+    needs isn't installed."""
+    return __import__(BACKENDS[name])
@@ -0,0 +1,483 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Transport backend on asyncio, with the WebSocket protocol (RFC 6455)
+# written out here. On Python 2 it needs the trollius backport.
+#
+# Messages sent in one pass of the event loop, from any thread, are framed
+# into a per-connection buffer and written with a single call. When the
+# kernel stops taking a connection's data and its write buffer passes
+# WRITE_HIGH_WATER, the connection stops being read from and its
+# write_paused is set until it drains below WRITE_LOW_WATER; one that
+# gets past MAX_BUFFERED is dropped.
+#
+# Heartbeats run on a timers.TimingWheel driven by the event loop.
+#
+# Given a static.Assets, plain HTTP requests on the port are answered from
+# it, one per connection.
+#
+
+import base64
+import binascii
+import hashlib
+import socket
+import struct
+import threading
+import traceback
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import log
+from timers import TimingWheel
+from transport import CloseCode
+
+transport_log = log.get_logger('transport')
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+MAX_HEADER = 8192
+MAX_MESSAGE = 1 << 20
+
+WRITE_HIGH_WATER = 256 * 1024
+WRITE_LOW_WATER = 64 * 1024
+MAX_BUFFERED = 4 * 1024 * 1024
+
+HEARTBEAT_RESOLUTION = 0.5
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+HTTP_REASONS = {200: 'OK', 304: 'Not Modified', 404: 'Not Found',
+                405: 'Method Not Allowed'}
+
+BAD_REQUEST = (b'HTTP/1.1 400 Bad Request\r\n'
+               b'Content-Length: 0\r\n'
+               b'Connection: close\r\n\r\n')
+
+def unmask(data, mask):
+    """XORs data with the repeated 4 byte mask, as one big integer rather
+    than a byte at a time."""
+    length = len(data)
+    if not length:
+        return data
+    key = (mask * (length // 4 + 1))[:length]
+    value = (int(binascii.hexlify(data), 16) ^
+             int(binascii.hexlify(key), 16))
+    return binascii.unhexlify('%0*x' % (length * 2, value))
+
+def encode_frame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+
+class ProtocolError(Exception):
+    def __init__(self, code, reason):
+        Exception.__init__(self, reason)
+        self.code = code
+        self.reason = reason
+
+class ServerConn(object):
+    def __init__(self, server):
+        self.server = server
+        self.write_paused = False
+        self._ws = None
+
+    def on_connect(self):
+        pass
+
+    def on_open(self):
+        pass
+
+    def on_message(self, msg, is_text):
+        pass
+
+    def on_close(self, code, reason):
+        pass
+
+    def send(self, msg, is_text=True):
+        if not isinstance(msg, bytes):
+            msg = msg.encode('utf-8')
+        self._ws.queue(encode_frame(OP_TEXT if is_text else OP_BINARY, msg))
+
+    def send_close(self, code, reason=''):
+        payload = struct.pack('!H', code) + reason.encode('utf-8')[:123]
+        self._ws.queue(encode_frame(OP_CLOSE, payload), close=(code, reason))
+
+class WebSocketProtocol(asyncio.Protocol):
+    """Speaks WebSocket on one connection for a ServerConn."""
+    def __init__(self, server):
+        self.server = server
+        self.loop = server.loop
+        self.transport = None
+        self.conn = None
+        self.open = False
+        self.buffer = bytearray()
+        self.fragments = None
+        self.fragments_text = False
+        self.fragments_size = 0
+        # code and reason the connection is closing with, once it is
+        self.close_status = None
+        self.lost = False
+
+        # whether anything arrived since the last heartbeat, and whether
+        # it was answered with a ping
+        self.heard = False
+        self.pinged = False
+        self.heartbeat = None
+
+        # guards what other threads touch: the outgoing buffer and whether
+        # a flush is due or nothing more may be sent
+        self.lock = threading.Lock()
+        self.outgoing = []
+        self.flush_scheduled = False
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=WRITE_HIGH_WATER,
+                                          low=WRITE_LOW_WATER)
+        self.conn = self.server.connection_class(self.server)
+        self.conn._ws = self
+        if self.server.heartbeat_interval:
+            self.heartbeat = self.server._heartbeat_timers.schedule(
+                self.server.heartbeat_interval, self._on_heartbeat)
+        call_logged(self.conn.on_connect)
+
+    def connection_lost(self, exc):
+        self.lost = True
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        with self.lock:
+            self.closing = True
+            self.outgoing = []
+        code, reason = self.close_status or (CloseCode.ABNORMAL, '')
+        call_logged(self.conn.on_close, code, reason)
+
+    def pause_writing(self):
+        self.conn.write_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.conn.write_paused = False
+        if not self.lost:
+            self.transport.resume_reading()
+
+    def data_received(self, data):
+        self.heard = True
+        self.buffer.extend(data)
+        try:
+            if not self.open:
+                self._handshake()
+            if self.open:
+                self._read_frames()
+        except ProtocolError as e:
+            transport_log.debug('closing connection: %s', e.reason)
+            self.conn.send_close(e.code, e.reason)
+
+    def _handshake(self):
+        end = self.buffer.find(b'\r\n\r\n')
+        if end == -1:
+            if len(self.buffer) > MAX_HEADER:
+                self._reject()
+            return
+
+        lines = bytes(self.buffer[:end]).split(b'\r\n')
+        del self.buffer[:end + 4]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+
+        if (self.server.assets is not None and
+                headers.get(b'upgrade', b'').lower() != b'websocket'):
+            self._serve_asset(lines[0], headers)
+            return
+
+        key = headers.get(b'sec-websocket-key')
+        if (not lines[0].startswith(b'GET ') or not key or
+                headers.get(b'upgrade', b'').lower() != b'websocket' or
+                headers.get(b'sec-websocket-version') != b'13'):
+            self._reject()
+            return
+
+        self.transport.write(b'HTTP/1.1 101 Switching Protocols\r\n'
+                             b'Upgrade: websocket\r\n'
+                             b'Connection: Upgrade\r\n'
+                             b'Sec-WebSocket-Accept: ' + accept_key(key) +
+                             b'\r\n\r\n')
+        self.open = True
+        call_logged(self.conn.on_open)
+
+    def _serve_asset(self, request_line, headers):
+        """Answers a plain HTTP request from the server's static.Assets and
+        closes the connection."""
+        parts = request_line.split(b' ')
+        if len(parts) != 3:
+            self._reject()
+            return
+
+        status, response_headers, body = self.server.assets.respond(
+            parts[0].decode('latin-1'), parts[1].decode('latin-1'),
+            dict((name.decode('latin-1'), value.decode('latin-1'))
+                 for name, value in headers.items()))
+        head = ['HTTP/1.1 %d %s' % (status, HTTP_REASONS.get(status, ''))]
+        head.extend('%s: %s' % header for header in response_headers)
+        head.append('Connection: close\r\n\r\n')
+
+        with self.lock:
+            self.closing = True
+        self.close_status = (CloseCode.NORMAL, 'http')
+        self.transport.write('\r\n'.join(head).encode('latin-1') + body)
+        self.transport.close()
+
+    def _reject(self):
+        with self.lock:
+            self.closing = True
+        self.close_status = (CloseCode.PROTOCOL, 'bad handshake')
+        self.transport.write(BAD_REQUEST)
+        self.transport.close()
+
+    def _read_frames(self):
+        buf = self.buffer
+        while len(buf) >= 2 and not self.lost:
+            first, second = buf[0], buf[1]
+            fin = first & 0x80
+            opcode = first & 0x0f
+            length = second & 0x7f
+            offset = 2
+            if length == 126:
+                if len(buf) < 4:
+                    return
+                length = struct.unpack_from('!H', buf, 2)[0]
+                offset = 4
+            elif length == 127:
+                if len(buf) < 10:
+                    return
+                length = struct.unpack_from('!Q', buf, 2)[0]
+                offset = 10
+
+            if not second & 0x80:
+                raise ProtocolError(CloseCode.PROTOCOL, 'unmasked frame')
+            if length > MAX_MESSAGE:
+                raise ProtocolError(CloseCode.TOO_BIG, 'message too big')
+            if len(buf) < offset + 4 + length:
+                return
+
+            mask = bytes(buf[offset:offset + 4])
+            payload = unmask(bytes(buf[offset + 4:offset + 4 + length]), mask)
+            del buf[:offset + 4 + length]
+            self._on_frame(fin, opcode, payload)
+
+    def _on_frame(self, fin, opcode, payload):
+        if opcode >= OP_CLOSE:
+            if not fin or len(payload) > 125:
+                raise ProtocolError(CloseCode.PROTOCOL, 'bad control frame')
+            if opcode == OP_CLOSE:
+                self._on_close_frame(payload)
+            elif opcode == OP_PING:
+                self.queue(encode_frame(OP_PONG, payload))
+            return
+
+        if opcode == OP_CONTINUATION:
+            if self.fragments is None:
+                raise ProtocolError(CloseCode.PROTOCOL, 'bad continuation')
+            self.fragments.append(payload)
+            self.fragments_size += len(payload)
+            if self.fragments_size > MAX_MESSAGE:
+                raise ProtocolError(CloseCode.TOO_BIG, 'message too big')
+            if fin:
+                payload = b''.join(self.fragments)
+                is_text = self.fragments_text
+                self.fragments = None
+                self._deliver(payload, is_text)
+        elif opcode in (OP_TEXT, OP_BINARY):
+            if self.fragments is not None:
+                raise ProtocolError(CloseCode.PROTOCOL,
+                                    'expected continuation')
+            if fin:
+                self._deliver(payload, opcode == OP_TEXT)
+            else:
+                self.fragments = [payload]
+                self.fragments_text = opcode == OP_TEXT
+                self.fragments_size = len(payload)
+        else:
+            raise ProtocolError(CloseCode.PROTOCOL, 'unknown opcode')
+
+    def _deliver(self, payload, is_text):
+        if is_text:
+            try:
+                payload = payload.decode('utf-8')
+            except UnicodeDecodeError:
+                raise ProtocolError(CloseCode.INVALID_DATA, 'invalid utf-8')
+        call_logged(self.conn.on_message, payload, is_text)
+
+    def _on_close_frame(self, payload):
+        if len(payload) >= 2:
+            code = struct.unpack_from('!H', payload)[0]
+            reason = payload[2:].decode('utf-8', 'replace')
+        else:
+            code = CloseCode.NORMAL
+            reason = ''
+        if self.close_status is None:
+            self.close_status = (code, reason)
+        # answers with the same code, unless this end already closed
+        self.conn.send_close(code, reason)
+
+    def queue(self, data, close=None):
+        """Adds data to what goes out on the next flush, from any thread.
+        Given close, nothing more is sent after it and the connection is
+        closed once it has been written."""
+        with self.lock:
+            if self.closing:
+                return
+            self.outgoing.append(data)
+            if close is not None:
+                self.closing = True
+                if self.close_status is None:
+                    self.close_status = close
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+
+        if threading.current_thread() is self.server.thread:
+            self.loop.call_soon(self._flush)
+        else:
+            self.loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        with self.lock:
+            data = b''.join(self.outgoing)
+            self.outgoing = []
+            self.flush_scheduled = False
+            closing = self.closing
+
+        if self.lost:
+            return
+        if data:
+            self.transport.write(data)
+        if closing:
+            self.transport.close()
+        elif self.transport.get_write_buffer_size() > MAX_BUFFERED:
+            transport_log.warning('dropping a connection that is not '
+                                  'keeping up')
+            self.close_status = (CloseCode.GOING_AWAY, 'too slow')
+            self.transport.abort()
+
+    def _on_heartbeat(self):
+        timers = self.server._heartbeat_timers
+        if self.heard:
+            self.heard = False
+            self.pinged = False
+            timers.restart(self.heartbeat, self.server.heartbeat_interval)
+        elif not self.pinged:
+            self.pinged = True
+            self.queue(encode_frame(OP_PING, b''))
+            timers.restart(self.heartbeat, self.server.heartbeat_ttl)
+        else:
+            transport_log.debug('dropping a connection that stopped '
+                                'answering pings')
+            self.close_status = (CloseCode.GOING_AWAY, 'heartbeat timeout')
+            self.transport.abort()
+
+def call_logged(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        transport_log.error('error in %s:\n%s', callback.__name__,
+                            traceback.format_exc())
+
+SERVES_ASSETS = True
+SHARES_PORT = True
+THREADSAFE = True
+
+class Server(object):
+    """Serves WebSocket connections on port from an asyncio event loop run
+    by listen(). Given reuse_port, the listening socket has SO_REUSEPORT
+    set, where there is one, so several processes can share the port."""
+    def __init__(self, port, connection_class, host='', backlog=128,
+                 heartbeat_interval_ms=None, heartbeat_ttl_ms=None,
+                 assets=None, reuse_port=False):
+        self.port = port
+        self.connection_class = connection_class
+        self.host = host
+        self.backlog = backlog
+        self.heartbeat_interval = (heartbeat_interval_ms or 0) / 1000.0
+        self.heartbeat_ttl = (heartbeat_ttl_ms or 0) / 1000.0
+        self.assets = assets
+        self.reuse_port = reuse_port
+        self.loop = None
+        self.thread = None
+        self._heartbeat_timers = None
+
+    def listen(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.thread = threading.current_thread()
+        # not .timers: the class this is mixed into may have a wheel of its
+        # own, on another clock and thread
+        self._heartbeat_timers = TimingWheel(HEARTBEAT_RESOLUTION,
+                                             self.loop.time)
+        self.loop.call_later(HEARTBEAT_RESOLUTION, self._advance_timers)
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port and hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+
+        self.loop.run_until_complete(self.loop.create_server(
+            lambda: WebSocketProtocol(self), sock=sock))
+        transport_log.info('listening on port %d', self.port)
+        self.loop.run_forever()
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Calls callback(*args) on the event loop's thread."""
+        self.loop.call_soon_threadsafe(call_logged, callback, *args)
+
+    def _advance_timers(self):
+        self._heartbeat_timers.advance()
+        self.loop.call_later(HEARTBEAT_RESOLUTION, self._advance_timers)
@@ -0,0 +1,66 @@
+"""
+Copyright (c) 2013, Alex O'Konski
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+* Redistributions of source code must retain the above copyright
+  notice, this list of conditions and the following disclaimer.
+* Redistributions in binary form must reproduce the above copyright
+  notice, this list of conditions and the following disclaimer in the
+  documentation and/or other materials provided with the distribution.
+* Neither the name of ping nor the
+  names of its contributors may be used to endorse or promote products
+  derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#
+# Transport backend on the heelhook C extension.
+#
+
+import heelhook
+
+from transport import CloseCode
+
+# heelhook only speaks WebSocket
+SERVES_ASSETS = False
+# nothing says its listening socket can be shared, or that its connections
+# can be sent to from outside its loop, which has no way in from other
+# threads
+SHARES_PORT = False
+THREADSAFE = False
+
+Server = heelhook.Server
+
+class ServerConn(heelhook.ServerConn):
+    # transport.CloseCode values to heelhook's
+    CLOSE_CODES = {
+        CloseCode.NORMAL: heelhook.CloseCode.NORMAL,
+        CloseCode.PROTOCOL: heelhook.CloseCode.PROTOCOL
+    }
+
+    def send_close(self, code, reason=''):
+        heelhook.ServerConn.send_close(
+            self, ServerConn.CLOSE_CODES.get(code, code), reason=reason)
+
+def configure(log_level):
+    """Sets heelhook's own logging to the LogLevel called log_level, or
+    raises ValueError."""
+    try:
+        level = getattr(heelhook.LogLevel, log_level)
+    except AttributeError:
+        raise ValueError('heelhook has no log level %s' % (log_level,))
+    heelhook.set_opts(loglevel=level, log_to_stdout=True)